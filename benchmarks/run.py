@@ -0,0 +1,172 @@
+'''
+Benchmark of the preprocessing stages, of the training and of predict_tow on synthetic flights (benchmarks/synthetic.py)
+
+For each size (number of flights):
+    - fit: PreprocessingPipeline.fit_transform of a synthetic challenge set, stage by stage
+      (the groupings need enough flights, sizes below MIN_FIT_ROWS are fitted on MIN_FIT_ROWS flights and not timed)
+    - transform: PreprocessingPipeline.transform of a synthetic submission set, stage by stage
+    - train: train_models on the preprocessed challenge set (at most --train-rows flights, with --n-estimators trees)
+    - predict_tow: prediction of the preprocessed submission set
+Each stage reports its wall time, CPU time, peak memory increase and rows/sec (see preprocessing/profiling.py).
+
+The results are saved in benchmarks/results/{commit}.json, so that two commits can be compared:
+    python -m benchmarks.run --sizes 10000 100000 1000000
+    python -m benchmarks.run --compare benchmarks/results/<before>.json benchmarks/results/<after>.json
+
+Everything runs offline and on CPU.
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import sklearn
+import xgboost
+
+from benchmarks.synthetic import generate_flights
+from models.xgboost_agregation import train_models, predict_tow, DEFAULT_PARAMS_SET
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.profiling import StageProfiler
+
+RESULTS_DIR = "benchmarks/results"
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+MIN_FIT_ROWS = 100_000
+
+# a wall time ratio (after / before) above this is reported as a regression by --compare
+REGRESSION_THRESHOLD = 1.2
+
+
+def commit_id() -> str:
+    '''
+    Short hash of the current commit, with a -dirty suffix if the tree has uncommitted changes ('unknown' outside git)
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f"{commit}-dirty" if dirty else commit
+
+def environment() -> dict:
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+            'xgboost': xgboost.__version__}
+
+def benchmark_size(n_rows: int, n_estimators: int, train_rows: int, seed: int = 0) -> dict:
+    '''
+    Timings of the stages of the pipeline, of the training and of the prediction on n_rows synthetic flights
+    '''
+    result = {}
+
+    train_df = generate_flights(n_rows, seed)
+    pipeline = PreprocessingPipeline()
+    if n_rows >= MIN_FIT_ROWS:
+        pipeline.profiler = StageProfiler()
+        train_df = pipeline.fit_transform(train_df)
+        result['fit'] = pipeline.profiler.report()['stages']
+    else:
+        pipeline.fit(generate_flights(MIN_FIT_ROWS, seed))
+        train_df = pipeline.transform(train_df)
+        result['fit'] = None
+
+    test_df = generate_flights(n_rows, seed + 1, with_tow=False)
+    pipeline.profiler = StageProfiler()
+    test_df = pipeline.transform(test_df)
+    result['transform'] = pipeline.profiler.report()['stages']
+
+    params_set = {name: dict(params, n_estimators=n_estimators) for name, params in DEFAULT_PARAMS_SET.items()}
+    profiler = StageProfiler()
+    train_df = train_df.iloc[:train_rows]
+    with profiler.stage('train_models', len(train_df)):
+        model_list = train_models(train_df, params_set)
+    with profiler.stage('predict_tow', len(test_df)):
+        predict_tow(test_df, model_list)
+    result.update(profiler.report()['stages'])
+
+    return result
+
+def run(sizes: list, n_estimators: int, train_rows: int, results_dir: str = RESULTS_DIR) -> str:
+    results = {'commit': commit_id(),
+               'environment': environment(),
+               'n_estimators': n_estimators,
+               'train_rows': train_rows,
+               'sizes': {}}
+
+    for n_rows in sizes:
+        print("-"*100)
+        print(f"Benchmark on {n_rows} flights")
+        print("-"*100)
+        results['sizes'][str(n_rows)] = benchmark_size(n_rows, n_estimators, train_rows)
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{results['commit']}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=4)
+    return path
+
+def flatten(results: dict) -> dict:
+    '''
+    {(size, section, stage): wall time} of a results file (train_models and predict_tow are their own section)
+    '''
+    walls = {}
+    for size, sections in results['sizes'].items():
+        for section, stages in sections.items():
+            if stages is None:
+                continue
+            if 'wall_sec' in stages:
+                walls[(size, section, section)] = stages['wall_sec']
+            else:
+                walls.update({(size, section, stage): timing['wall_sec'] for stage, timing in stages.items()})
+    return walls
+
+def compare(before_path: str, after_path: str, threshold: float = REGRESSION_THRESHOLD) -> list:
+    '''
+    Prints the wall times of two results files side by side, returns the (size, section, stage) slower by more than threshold
+    '''
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    before_walls, after_walls = flatten(before), flatten(after)
+
+    print("-"*100)
+    print(f"{'size':>10}  {'section':<12}{'stage':<35}{before['commit']:>14}{after['commit']:>14}{'ratio':>8}")
+    regressions = []
+    for key in before_walls:
+        if key not in after_walls:
+            continue
+        ratio = after_walls[key] / before_walls[key] if before_walls[key] else float('nan')
+        flag = ' <-- regression' if ratio > threshold else ''
+        print(f"{key[0]:>10}  {key[1]:<12}{key[2]:<35}{before_walls[key]:>13.3f}s{after_walls[key]:>13.3f}s{ratio:>8.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(key)
+    print("-"*100)
+    return regressions
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline, the training and the prediction on synthetic flights")
+    parser.add_argument("--sizes", type=int, nargs='*', default=SIZES, help="numbers of flights")
+    parser.add_argument("--n-estimators", type=int, default=50, help="trees of each model in the training benchmark")
+    parser.add_argument("--train-rows", type=int, default=1_000_000, help="maximum number of flights of the training benchmark")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", nargs=2, metavar=('BEFORE', 'AFTER'), default=None, help="compare two results files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = compare(*args.compare)
+        sys.exit(1 if regressions else 0)
+
+    path = run(args.sizes, args.n_estimators, args.train_rows, args.results_dir)
+    print(f"Benchmark results saved to {path}")
+
+if __name__ == "__main__":
+    main()
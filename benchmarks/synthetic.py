@@ -0,0 +1,156 @@
+'''
+Synthetic flights with the schema of the challenge set, to benchmark the pipeline without the challenge csv files
+
+    - real ICAO codes, names and countries from airportsdata; departures and arrivals are mostly European airports with an
+      IATA code, with a long-tailed (Zipf) traffic so that the groupings see big, small and tiny airports
+    - aircraft types with their wtc and a share of the traffic close to the one of the challenge set, airlines and
+      callsigns as 32-character hashes with long-tailed frequencies
+    - UTC off-block/arrival times over 2022, durations and flown distances consistent with the great-circle distance,
+      and a tow that depends on the aircraft type and on the distance
+
+The generated frame has the types of preprocessing.ingestion.load_flights (categoricals, UTC datetimes, int32/float32),
+flight_id as index. Everything is drawn from a seeded numpy generator: the same (n_rows, seed) gives the same flights.
+
+Usage:
+    python -m benchmarks.synthetic data/synthetic_challenge_set.csv --rows 100000
+'''
+
+import argparse
+from functools import lru_cache
+
+import airportsdata
+import numpy as np
+import pandas as pd
+
+EUROPE = ['AL', 'AT', 'BA', 'BE', 'BG', 'CH', 'CY', 'CZ', 'DE', 'DK', 'EE', 'ES', 'FI', 'FR', 'GB', 'GR', 'HR', 'HU', 'IE', 'IS',
+          'IT', 'LT', 'LU', 'LV', 'MD', 'ME', 'MK', 'MT', 'NL', 'NO', 'PL', 'PT', 'RO', 'RS', 'SE', 'SI', 'SK', 'TR', 'UA']
+
+# aircraft type: (wtc, share of the flights, typical tow in kg)
+AIRCRAFT_TYPES = {'A320': ('M', 0.22, 64000), 'B738': ('M', 0.16, 65000), 'A20N': ('M', 0.10, 65000), 'A321': ('M', 0.08, 76000),
+                  'A21N': ('M', 0.06, 78000), 'A319': ('M', 0.05, 57000), 'B38M': ('M', 0.04, 67000), 'E190': ('M', 0.03, 43000),
+                  'E195': ('M', 0.02, 46000), 'CRJ9': ('M', 0.02, 33000), 'AT76': ('M', 0.02, 21000), 'DH8D': ('M', 0.01, 26000),
+                  'BCS3': ('M', 0.02, 58000), 'B77W': ('H', 0.04, 300000), 'B789': ('H', 0.04, 220000), 'B788': ('H', 0.02, 195000),
+                  'A333': ('H', 0.02, 205000), 'A359': ('H', 0.03, 240000), 'A332': ('H', 0.01, 195000), 'B763': ('H', 0.01, 165000)}
+
+N_AIRLINES = 30
+FIRST_FLIGHT_ID = 248753821
+CRUISE_SPEED_KMH = 780
+
+
+@lru_cache(maxsize=1)
+def airports_table() -> pd.DataFrame:
+    '''
+    Airports with an IATA code of the airportsdata database (icao, name, country, lat, lon), European ones first
+    (overseas territories of European countries are not counted as European)
+    '''
+    airports = pd.DataFrame.from_dict(airportsdata.load(), orient='index')
+    airports = airports[airports['iata'] != ''][['icao', 'name', 'country', 'lat', 'lon']]
+    airports['is_europe'] = airports['country'].isin(EUROPE) & airports['lat'].between(34, 72) & airports['lon'].between(-25, 45)
+    return airports.sort_values(['is_europe', 'icao'], ascending=[False, True]).reset_index(drop=True)
+
+def zipf_shares(n: int, exponent: float = 1.1) -> np.ndarray:
+    shares = 1.0 / np.arange(1, n + 1) ** exponent
+    return shares / shares.sum()
+
+def random_hashes(rng: np.random.Generator, n: int) -> np.ndarray:
+    return np.array([f'{value:032x}' for value in rng.integers(0, 2**63, n)], dtype=object)
+
+def great_circle_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * 6371 * np.arcsin(np.sqrt(a))
+
+def categorical(indices: np.ndarray, values) -> pd.Categorical:
+    '''
+    Categorical of values[indices], built without materializing the strings of every row
+
+    Only the values actually drawn are categories, sorted (as load_flights returns them), values may contain duplicates.
+    '''
+    used, codes = np.unique(indices, return_inverse=True)
+    categories, used_codes = np.unique(np.asarray(values, dtype=object)[used].astype(str), return_inverse=True)
+    return pd.Categorical.from_codes(used_codes[codes], categories)
+
+def generate_flights(n_rows: int, seed: int = 0, with_tow: bool = True) -> pd.DataFrame:
+    '''
+    n_rows synthetic flights with the schema of the challenge set (of the submission set if not with_tow)
+    '''
+    rng = np.random.default_rng(seed)
+    airports = airports_table()
+    n_europe = int(airports['is_europe'].sum())
+
+    # departures and arrivals: one end in Europe (long-tailed traffic), the other one in Europe for 90% of the flights
+    # the traffic rank of the airports is drawn at random (the table is sorted by icao)
+    europe_shares = rng.permutation(zipf_shares(n_europe))
+    world_shares = rng.permutation(zipf_shares(len(airports) - n_europe))
+    europe_end = rng.choice(n_europe, n_rows, p=europe_shares)
+    other_end = np.where(rng.random(n_rows) < 0.9,
+                         rng.choice(n_europe, n_rows, p=europe_shares),
+                         n_europe + rng.choice(len(airports) - n_europe, n_rows, p=world_shares))
+    outbound = rng.random(n_rows) < 0.5
+    adep = np.where(outbound, europe_end, other_end)
+    ades = np.where(outbound, other_end, europe_end)
+
+    lat, lon = airports['lat'].to_numpy(), airports['lon'].to_numpy()
+    distance = great_circle_km(lat[adep], lon[adep], lat[ades], lon[ades]) + rng.uniform(50, 150, n_rows)
+
+    # aircraft: heavy types on the long flights, mostly medium ones on the others
+    types = list(AIRCRAFT_TYPES)
+    wtc = np.array([AIRCRAFT_TYPES[t][0] for t in types])
+    shares = np.array([AIRCRAFT_TYPES[t][1] for t in types])
+    typical_tow = np.array([AIRCRAFT_TYPES[t][2] for t in types], dtype=np.float64)
+    heavy_shares = np.where(wtc == 'H', shares, 0) / shares[wtc == 'H'].sum()
+    short_shares = np.where(wtc == 'H', shares * 0.2, shares)
+    aircraft = np.where(distance > 4000,
+                        rng.choice(len(types), n_rows, p=heavy_shares),
+                        rng.choice(len(types), n_rows, p=short_shares / short_shares.sum()))
+
+    airline = rng.choice(N_AIRLINES, n_rows, p=zipf_shares(N_AIRLINES))
+    n_callsigns = max(100, n_rows // 20)
+    callsign = rng.choice(n_callsigns, n_rows, p=zipf_shares(n_callsigns, 0.8))
+
+    days = pd.date_range('2022-01-01', periods=365, freq='D', tz='UTC')
+    offblock = days[0].value + rng.integers(0, 365 * 86400, n_rows, dtype=np.int64) * 10**9
+    flight_duration = (distance / CRUISE_SPEED_KMH * 60 + rng.normal(25, 8, n_rows)).clip(20).astype(np.int32)
+    taxiout_time = rng.gamma(4, 4, n_rows).astype(np.int32) + 3
+    arrival = offblock + (flight_duration.astype(np.int64) + taxiout_time) * 60 * 10**9
+
+    d_frame = pd.DataFrame({
+        'date': categorical((offblock - days[0].value) // (86400 * 10**9), days.strftime('%Y-%m-%d')),
+        'callsign': categorical(callsign, random_hashes(rng, n_callsigns)),
+        'adep': categorical(adep, airports['icao']),
+        'name_adep': categorical(adep, airports['name']),
+        'country_code_adep': categorical(adep, airports['country']),
+        'ades': categorical(ades, airports['icao']),
+        'name_ades': categorical(ades, airports['name']),
+        'country_code_ades': categorical(ades, airports['country']),
+        'actual_offblock_time': pd.to_datetime(offblock, utc=True),
+        'arrival_time': pd.to_datetime(arrival, utc=True),
+        'aircraft_type': categorical(aircraft, types),
+        'wtc': categorical(aircraft, wtc),
+        'airline': categorical(airline, random_hashes(rng, N_AIRLINES)),
+        'flight_duration': flight_duration,
+        'taxiout_time': taxiout_time.astype(np.int32),
+        'flown_distance': (distance / 1.852).astype(np.int32),
+    }, index=pd.Index(np.arange(FIRST_FLIGHT_ID, FIRST_FLIGHT_ID + n_rows), name='flight_id'))
+
+    if with_tow:
+        # fuel for the distance on top of a load factor of the typical tow
+        load = rng.normal(0.9, 0.05, n_rows)
+        d_frame['tow'] = (typical_tow[aircraft] * (load + 0.00004 * distance)).astype(np.float32)
+
+    return d_frame
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Write a synthetic challenge (or submission) set")
+    parser.add_argument("output", help="csv file to write")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--submission", action="store_true", help="without the tow column, as the submission set")
+    args = parser.parse_args(argv)
+
+    d_frame = generate_flights(args.rows, args.seed, with_tow=not args.submission)
+    d_frame.to_csv(args.output, date_format='%Y-%m-%dT%H:%M:%SZ')
+    print(f"{len(d_frame)} synthetic flights written to {args.output}")
+
+if __name__ == "__main__":
+    main()
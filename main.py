@@ -17,17 +17,115 @@
 
 #################################################################################
 
-import sklearn
-import pandas
-import pickle
-import os
 import sys
-from preprocessing.country_and_airports_codes import compute_lon_lat,group_and_rename_countries, group_and_rename_airports, group_and_rename_aircraft_types
-from preprocessing.encoding import one_hot_encoding,string_to_value_count, string_to_int_hashing
-from preprocessing.local_time import add_localtime_to_train_and_test
-from models.xgboost_agregation import predict_tow, load_model
-
-def main():
+import argparse
+from preprocessing.profiling import StageProfiler, StartupProfiler, initialization
+
+# installed before the other imports, so that --profile-startup also reports them
+STARTUP_PROFILER = StartupProfiler().install() if '--profile-startup' in sys.argv else None
+
+# the heavy modules (xgboost, sklearn, airportsdata, timezonefinder) and the reference data are loaded on first use
+from preprocessing.pipeline import PreprocessingPipeline, preprocessing_state_exists
+from preprocessing.ingestion import load_flights, iter_flights
+from models.compiled_trees import CompiledEnsemble
+from models.prediction_cache import PredictionCache, STORE_PATH as CACHE_STORE_PATH, MAX_ENTRIES as CACHE_ENTRIES
+from preprocessing.parallel import ShardExecutor
+
+MODEL_PATH = "models/xgboost_agregation"
+INPUT_PATH = "data/submission_set.csv"
+OUTPUT_PATH = "data/results/submission_result.csv"
+REPORT_DIR = "data/results/reports"
+
+def load_preprocessing_pipeline(model_path: str = MODEL_PATH) -> PreprocessingPipeline:
+    '''
+    Loads the preprocessing state saved with the models.
+    The training set is only read (to fit the state, then saved) when this state has not been saved yet.
+    '''
+    if preprocessing_state_exists(model_path):
+        with initialization('load_preprocessing_state'):
+            return PreprocessingPipeline.load(model_path)
+
+    train_df = load_flights('data/challenge_set.csv')
+    pipeline = PreprocessingPipeline().fit(train_df)
+    pipeline.save(model_path)
+    return pipeline
+
+def load_predictor(model_path: str = MODEL_PATH, compiled: bool = False, cache: PredictionCache = None):
+    '''
+    predict(d_frame) of the saved models: with compiled, the compiled ensemble exported by models/compiled_trees.py
+    ({model_path}_compiled.bin, no xgboost needed), the XGBoost models and their blend weights otherwise.
+    With a cache (see models/prediction_cache.py), only the flights whose features are not cached are predicted.
+    '''
+    if compiled:
+        with initialization('load_compiled_models'):
+            ensemble = CompiledEnsemble.load(model_path)
+        predict, feature_names = ensemble.predict_tow, ensemble.feature_names
+    else:
+        from models.xgboost_agregation import predict_tow, load_model, load_blend_weights, model_features
+        models_list = load_model(model_path)
+        weights = load_blend_weights(model_path, models_list)
+        predict, feature_names = (lambda d_frame: predict_tow(d_frame, models_list, weights)), model_features(models_list[0])
+
+    if cache is None:
+        return predict
+    return lambda d_frame: cache.predict(d_frame, predict, feature_names)
+
+def open_prediction_cache(args: argparse.Namespace, model_path: str = MODEL_PATH) -> PredictionCache:
+    '''
+    Cache of the current models of model_path if --prediction-cache is set (None otherwise)
+    '''
+    if not args.prediction_cache:
+        return None
+    with initialization('open_prediction_cache'):
+        return PredictionCache.for_models(model_path, args.cache_entries, args.cache_store or None)
+
+def score_in_chunks(input_path: str, output_path: str, chunksize: int, model_path: str = MODEL_PATH, profiler: StageProfiler = None, executor: ShardExecutor = None, compiled: bool = False, cache: PredictionCache = None) -> int:
+    '''
+    Streaming inference: reads input_path by chunks of chunksize rows, preprocesses and predicts each chunk
+    with the saved preprocessing state and models, and appends the flight_id,tow rows to output_path.
+
+    The peak memory is bounded by the chunk size (the state and models are loaded once).
+    Returns the number of flights scored.
+    '''
+    profiler = profiler or StageProfiler()
+    pipeline = load_preprocessing_pipeline(model_path)
+    pipeline.profiler = profiler
+    pipeline.executor = executor
+    predict = load_predictor(model_path, compiled, cache)
+
+    n_scored = 0
+    for i, chunk in enumerate(iter_flights(input_path, chunksize)):
+        chunk = pipeline.transform(chunk)
+        with profiler.stage('predict', len(chunk)):
+            chunk['tow'] = predict(chunk)
+        with profiler.stage('save', len(chunk)):
+            chunk[['tow']].to_csv(output_path, mode='w' if i == 0 else 'a', header=(i == 0))
+
+        n_scored += len(chunk)
+        print(f"{n_scored} flights scored and saved to {output_path}")
+
+    return n_scored
+
+def main(argv: list = None):
+
+    parser = argparse.ArgumentParser(description="Predict the TOW of the flights of a submission set")
+    parser.add_argument("--input", default=INPUT_PATH, help="csv file of the flights to score")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="csv file where the flight_id,tow predictions are written")
+    parser.add_argument("--chunksize", type=int, default=None, help="stream the input by chunks of this number of rows (default: whole file in memory)")
+    parser.add_argument("--model-path", default=MODEL_PATH, help="prefix of the saved models and preprocessing state (e.g. a distilled student, see models/distillation.py)")
+    parser.add_argument("--report-dir", default=REPORT_DIR, help="directory of the JSON timing report of each run")
+    parser.add_argument("--workers", type=int, default=1, help="processes computing the per-row preprocessing stages (local times) by shards of rows")
+    parser.add_argument("--compiled", action="store_true", help="predict with the compiled models (python -m models.compiled_trees) instead of XGBoost")
+    parser.add_argument("--prediction-cache", action="store_true", help="reuse the predictions of the flights whose features and models did not change")
+    parser.add_argument("--cache-store", default=CACHE_STORE_PATH, help="sqlite file of the prediction cache kept between runs (\"\" for an in-memory cache only)")
+    parser.add_argument("--cache-entries", type=int, default=CACHE_ENTRIES, help="maximum number of predictions of the in-memory cache")
+    parser.add_argument("--profile-stage", default=None, help="run this stage (e.g. add_localtime, predict) under cProfile, its stats are saved next to the report")
+    parser.add_argument("--profile-startup", action="store_true", help="report the import and initialization time of each module")
+    args = parser.parse_args(argv)
+
+    profiler = StageProfiler(args.profile_stage)
+    executor = ShardExecutor(args.workers) if args.workers > 1 else None
+    cache = open_prediction_cache(args, args.model_path)
 
     ########################## GNU LICENCE #########################
 
@@ -58,8 +156,19 @@ def main():
     print("Start of the pipeline ! ")
     print("-"*100)
 
-    train_df = pandas.read_csv('data/challenge_set.csv',index_col=0)	
-    test_df = pandas.read_csv('data/submission_set.csv',index_col=0)
+    if args.chunksize:
+        print(f"Streaming mode, chunks of {args.chunksize} rows")
+        score_in_chunks(args.input, args.output, args.chunksize, args.model_path, profiler=profiler, executor=executor, compiled=args.compiled, cache=cache)
+        if executor is not None:
+            executor.close()
+        if cache is not None:
+            cache.close()
+        print("Prediction done and saved ! ")
+        save_report(profiler, args.report_dir, STARTUP_PROFILER, cache)
+        return
+
+    with profiler.stage('load'):
+        test_df = load_flights(args.input)
       
     ########################## PREPROCESSING ########################
 
@@ -67,39 +176,20 @@ def main():
     print("Start of the preprocessing ! ")
     print("-"*100)
 
-    add_localtime_to_train_and_test(train_df,test_df) #add localtime features (departures & arrival hours, day of years, weeks, month)
-    compute_lon_lat(train_df, test_df) # computes lon, lat for each airport
-    group_and_rename_countries(train_df, test_df) # simplify country_codes by group and rename countries
-    group_and_rename_airports(train_df, test_df) # simplify airport codes by group and rename airport
-    group_and_rename_aircraft_types(train_df, test_df) #regroup less used airlines and create "XXXX" category for unknown ones.
-
-
-    ########################## ENCODING #########################
-
-    print("-"*100)
-    print("Start of the encoding ! ")
-    print("-"*100)
-
-    # encoding the data
-    columns_to_ohe = [] # A changer
-    one_hot_encoding(train_df, test_df, columns_to_ohe)
-
-    columns_to_hash = ['callsign','country_code_ades', 'country_code_adep', 'adep', 'ades', 'airline','aircraft_type','wtc'] # A changer
-    string_to_int_hashing(train_df, test_df, columns_to_hash)
-
-    columns_to_vc = [] # A changer
-    string_to_value_count(train_df, test_df, columns_to_vc)
-
-    # drop unusefull column:
-    to_drop = ['date','name_adep','name_ades','name_adep','actual_offblock_time','arrival_time','local_departure_time','local_arrival_time']
-    train_df = train_df.drop(columns= to_drop)
-    test_df = test_df.drop(columns= to_drop)
+    # the preprocessing state (groupings, vocabularies, timezones) is fitted with the models
+    pipeline = load_preprocessing_pipeline(args.model_path)
+    pipeline.profiler = profiler
+    pipeline.executor = executor
 
+    # preprocessing and encoding the data (localtime features, lon/lat, countries/airports/aircraft types grouping, string to int hashing)
+    test_df = pipeline.transform(test_df)
+    if executor is not None:
+        executor.close()
 
 
     ############################# MODEL #############################
 
-    models_list = load_model("models/xgboost_agregation")
+    predict = load_predictor(args.model_path, args.compiled, cache)
     
     ########################## PREDICT AND SAVE #####################
 
@@ -107,17 +197,33 @@ def main():
 
     print("Start of the prediction ! ")
 
-    y_pred = predict_tow(test_df, models_list)
+    with profiler.stage('predict', len(test_df)):
+        y_pred = predict(test_df)
+    if cache is not None:
+        cache.close()
 
     test_df['tow'] = y_pred
 
     submission_df = test_df[['tow']]
 
-    submission_df.to_csv("data/results/submission_result.csv")
+    with profiler.stage('save', len(submission_df)):
+        submission_df.to_csv(args.output)
 
     print("Prediction done and saved ! ")
 
-    pass
+    save_report(profiler, args.report_dir, STARTUP_PROFILER, cache)
+
+
+def save_report(profiler: StageProfiler, report_dir: str, startup_profiler: StartupProfiler = None, cache: PredictionCache = None) -> None:
+    if cache is not None:
+        profiler.metrics['prediction_cache'] = cache.stats()
+    profiler.print_summary()
+    if cache is not None:
+        cache.print_summary()
+    print(f"Timing report saved to {profiler.save_report(report_dir)}")
+    if startup_profiler is not None:
+        startup_profiler.print_summary()
+        print(f"Startup report saved to {startup_profiler.save_report(report_dir)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+'''
+Benchmark of the model backends (models/backends.py: xgboost, lightgbm) on the same data
+
+The preprocessing is fitted once on 80% of the challenge set. Each backend trains the three models of train_models
+(with its default or exported params) on it, and is evaluated on the remaining 20%:
+training time, prediction throughput (rows/sec of predict_tow), size of the saved models on disk and RMSE are reported.
+With --max-rmse, the backend with the fastest prediction among the ones under this RMSE is reported.
+
+The backends that are not installed are skipped.
+
+Usage:
+    python -m models.backend_benchmark --n-estimators 200 --max-rmse 3000
+'''
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from sklearn.model_selection import train_test_split
+
+from models.backends import BACKENDS, get_backend
+from models.xgboost_agregation import train_models, predict_tow, evaluate_model, save_model, load_params_set
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+
+def saved_size(model_list: list) -> int:
+    '''
+    Bytes on disk of the models of model_list saved by save_model
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        save_model(model_list, os.path.join(directory, "model"))
+        return sum(os.path.getsize(os.path.join(directory, file)) for file in os.listdir(directory))
+
+def benchmark_backend(backend: str, train_df, test_df, params_set: dict, early_stopping_rounds: int = None, predict_repeats: int = 3) -> dict:
+    start = time.perf_counter()
+    model_list = train_models(train_df, params_set, early_stopping_rounds, backend=backend)
+    training_time = time.perf_counter() - start
+
+    # best of predict_repeats runs
+    predict_time = float('inf')
+    for _ in range(predict_repeats):
+        start = time.perf_counter()
+        predict_tow(test_df, model_list)
+        predict_time = min(predict_time, time.perf_counter() - start)
+
+    rmse, rel_error = evaluate_model(test_df, model_list)
+    return {'training_sec': training_time,
+            'predict_sec': predict_time,
+            'predict_rows_per_sec': len(test_df) / predict_time,
+            'model_size_bytes': saved_size(model_list),
+            'rmse': float(rmse),
+            'relative_error': float(rel_error)}
+
+def fastest_backend(results: dict, max_rmse: float) -> str:
+    '''
+    Backend with the highest prediction throughput among the ones with an RMSE under max_rmse (None if there is none)
+    '''
+    eligible = [backend for backend, result in results.items() if result['rmse'] <= max_rmse]
+    return max(eligible, key=lambda backend: results[backend]['predict_rows_per_sec'], default=None)
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Compare the training time, prediction throughput, model size and RMSE of the model backends")
+    parser.add_argument("--train", default="data/challenge_set.csv")
+    parser.add_argument("--backends", nargs='*', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--n-estimators", type=int, default=None, help="overrides the number of trees of the three models")
+    parser.add_argument("--max-depth", type=int, default=None, help="overrides the depth of the trees of the three models")
+    parser.add_argument("--early-stopping-rounds", type=int, default=None, help="hold out a validation split of the training rows and stop each model on its rmse")
+    parser.add_argument("--max-rmse", type=float, default=None, help="report the fastest backend with an RMSE under this value")
+    parser.add_argument("--model-path", default="models/xgboost_agregation", help="prefix of the exported params of each backend")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    raw_train, raw_test = train_test_split(load_flights(args.train), test_size=0.2, random_state=42)
+    pipeline = PreprocessingPipeline()
+    train_df = pipeline.fit_transform(raw_train)
+    test_df = pipeline.transform(raw_test)
+
+    results = {}
+    for backend in args.backends:
+        if not get_backend(backend).available():
+            print(f"Backend {backend} is not installed, skipped")
+            continue
+        params_set = load_params_set(args.model_path, backend)
+        for params in params_set.values():
+            if args.n_estimators is not None:
+                params['n_estimators'] = args.n_estimators
+            if args.max_depth is not None:
+                params['max_depth'] = args.max_depth
+        results[backend] = benchmark_backend(backend, train_df, test_df, params_set, args.early_stopping_rounds)
+
+    print("-"*100)
+    print(f"{'backend':<12}{'training':>12}{'predict rows/sec':>18}{'model size':>14}{'rmse':>12}{'rel. error':>12}")
+    for backend, result in results.items():
+        print(f"{backend:<12}{result['training_sec']:>11.1f}s{result['predict_rows_per_sec']:>18.0f}{result['model_size_bytes']/1e6:>11.1f} MB"
+              f"{result['rmse']:>12.1f}{result['relative_error']:>12.4f}")
+    print("-"*100)
+
+    if args.max_rmse is not None:
+        fastest = fastest_backend(results, args.max_rmse)
+        if fastest is None:
+            print(f"No backend has an RMSE under {args.max_rmse}")
+        else:
+            print(f"Fastest backend with an RMSE under {args.max_rmse}: {fastest} ({results[fastest]['predict_rows_per_sec']:.0f} rows/sec)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
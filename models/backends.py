@@ -0,0 +1,250 @@
+'''
+Model backends: the gradient boosting libraries the base models of models/xgboost_agregation.py can be trained with
+
+A backend fits a base model on a float32 matrix (see FeatureMatrix), predicts with it, saves and loads it,
+and records its route (name of the base model, wtc of the rows it is trained on and predicts) in the saved model.
+train_models, predict_tow, save_model and load_model work with the models of any backend (even mixed in one blend):
+the backend of a model is found from its type (backend_of), the one of a saved model from its file name (model_file).
+
+    - xgboost: XGBRegressor, saved in {path}_model_{i}.json, the route is stored in the booster attributes
+    - lightgbm (optional, pip install lightgbm): LightGBMModel, a lightgbm Booster and its route,
+      saved in {path}_model_{i}.lightgbm.json (the route and the model string of the booster)
+
+Only the XGBoost models can be continued (models/incremental.py), stacked (models/stacking.py) or compiled (models/compiled_trees.py).
+'''
+
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+def iteration_range(model) -> tuple:
+    '''
+    Trees of an XGBoost model used for prediction: up to the best iteration for the models trained with early stopping, all of them otherwise
+    '''
+    best_iteration = model.get_booster().attr('best_iteration')
+    return (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+
+class XGBoostBackend:
+    '''
+    XGBRegressor base models
+    '''
+
+    name = 'xgboost'
+    extension = 'json'
+
+    def available(self) -> bool:
+        return True
+
+    def owns(self, model) -> bool:
+        return type(model).__module__.split('.')[0] == 'xgboost'
+
+    def fit(self, X: np.ndarray, y: np.ndarray, params: dict, eval_set: list = None, early_stopping_rounds: int = None,
+            feature_names: list = None, feature_types: list = None, n_jobs: int = -1, xgb_model=None) -> 'XGBRegressor':
+        '''
+        Trains an XGBRegressor with params. With eval_set and early_stopping_rounds, the training stops
+        when the rmse on the last eval set has not improved for early_stopping_rounds trees (n_estimators is then a maximum).
+        feature_names names the columns when X is a numpy array.
+        With xgb_model (a booster), n_estimators trees are added to it instead of training from scratch.
+        feature_types marks the categorical columns of a numpy X ('c'), they are then split natively by the hist tree method.
+        '''
+        from xgboost import XGBRegressor
+
+        categorical = {}
+        if feature_types is not None and 'c' in feature_types:
+            categorical = dict(enable_categorical=True, tree_method='hist', feature_types=list(feature_types))
+
+        model = XGBRegressor(colsample_bytree=params['colsample_bytree'],
+                            gamma=params['gamma'],
+                            learning_rate=params['learning_rate'],
+                            max_depth=int(params['max_depth']),
+                            min_child_weight=int(params['min_child_weight']),
+                            n_estimators=int(params['n_estimators']),
+                            reg_alpha=params['reg_alpha'],
+                            reg_lambda=params['reg_lambda'],
+                            subsample=params['subsample'],
+                            seed=42,
+                            objective="reg:squarederror",
+                            early_stopping_rounds=early_stopping_rounds if eval_set else None,
+                            eval_metric="rmse",
+                            n_jobs=n_jobs,
+                            **categorical)
+
+        model.fit(X, y, eval_set=eval_set, verbose=False, xgb_model=xgb_model)
+        if feature_names is not None:
+            model.get_booster().feature_names = list(feature_names)
+
+        return model
+
+    def predict(self, model, X: np.ndarray) -> np.ndarray:
+        return model.get_booster().inplace_predict(X, iteration_range=iteration_range(model))
+
+    def save(self, model, path: str) -> None:
+        model.save_model(path)
+
+    def load(self, path: str):
+        from xgboost import XGBRegressor
+
+        model = XGBRegressor()
+        model.load_model(path)
+        return model
+
+    def set_route(self, model, name: str, wtc) -> None:
+        model.get_booster().set_attr(name=name, wtc='all' if wtc is None else str(wtc))
+
+    def route(self, model):
+        '''
+        (name, wtc) recorded in the model, None for the models saved without them
+        '''
+        booster = model.get_booster()
+        if booster.attr('wtc') is None:
+            return None
+        return booster.attr('name'), None if booster.attr('wtc') == 'all' else int(booster.attr('wtc'))
+
+    def features(self, model) -> list:
+        return model.get_booster().feature_names
+
+    def n_trees(self, model) -> int:
+        return model.get_booster().num_boosted_rounds()
+
+    def validation_summary(self, model) -> tuple:
+        '''
+        (best iteration, validation rmse at the best iteration) of a model trained with early stopping
+        '''
+        return model.best_iteration, model.evals_result()['validation_0']['rmse'][model.best_iteration]
+
+
+@lru_cache(maxsize=None)
+def _lightgbm():
+    try:
+        import lightgbm
+    except ImportError:
+        return None
+    return lightgbm
+
+
+class LightGBMModel:
+    '''
+    A LightGBM booster and the route of its base model (name, wtc of its rows, None for all the rows)
+    '''
+
+    def __init__(self, booster, name: str = None, wtc=None, evals_result: dict = None):
+        self.booster = booster
+        self.name = name
+        self.wtc = wtc
+        self.evals_result = evals_result or {}
+
+
+class LightGBMBackend:
+    '''
+    LightGBM base models (lightgbm.train), the params are LightGBM parameters, n_estimators is the number of boosting rounds
+    '''
+
+    name = 'lightgbm'
+    extension = 'lightgbm.json'
+
+    def available(self) -> bool:
+        return _lightgbm() is not None
+
+    def _module(self):
+        if _lightgbm() is None:
+            raise ImportError("The lightgbm backend needs LightGBM (pip install lightgbm)")
+        return _lightgbm()
+
+    def owns(self, model) -> bool:
+        return isinstance(model, LightGBMModel)
+
+    def fit(self, X: np.ndarray, y: np.ndarray, params: dict, eval_set: list = None, early_stopping_rounds: int = None,
+            feature_names: list = None, feature_types: list = None, n_jobs: int = -1) -> LightGBMModel:
+        '''
+        Trains a LightGBM booster with params, stopped on the rmse of the last eval set as XGBoostBackend.fit.
+        The categorical columns (feature_types 'c', their codes) are split natively by LightGBM.
+        '''
+        lgb = self._module()
+
+        params = dict(params)
+        n_rounds = int(params.pop('n_estimators'))
+        params.update(objective=params.get('objective', 'regression'), metric='rmse', seed=42, verbose=-1,
+                      num_threads=0 if n_jobs == -1 else n_jobs)
+
+        categorical = [j for j, feature_type in enumerate(feature_types or []) if feature_type == 'c']
+        train_set = lgb.Dataset(X, y, feature_name=list(feature_names) if feature_names is not None else 'auto',
+                                categorical_feature=categorical or 'auto', free_raw_data=False)
+
+        valid_sets, callbacks, evals_result = [], [], {}
+        if eval_set:
+            valid_sets = [lgb.Dataset(X_val, y_val, reference=train_set) for X_val, y_val in eval_set]
+            callbacks.append(lgb.record_evaluation(evals_result))
+            if early_stopping_rounds:
+                callbacks.append(lgb.early_stopping(early_stopping_rounds, first_metric_only=True, verbose=False))
+
+        booster = lgb.train(params, train_set, num_boost_round=n_rounds, valid_sets=valid_sets, callbacks=callbacks)
+        return LightGBMModel(booster, evals_result=evals_result)
+
+    def predict(self, model: LightGBMModel, X: np.ndarray) -> np.ndarray:
+        # up to the best iteration for the boosters trained with early stopping
+        return model.booster.predict(X).astype(np.float32)
+
+    def save(self, model: LightGBMModel, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'backend': self.name,
+                       'name': model.name,
+                       'wtc': 'all' if model.wtc is None else str(model.wtc),
+                       'model': model.booster.model_to_string()}, f)
+
+    def load(self, path: str) -> LightGBMModel:
+        lgb = self._module()
+        with open(path) as f:
+            saved = json.load(f)
+        return LightGBMModel(lgb.Booster(model_str=saved['model']), saved['name'], None if saved['wtc'] == 'all' else int(saved['wtc']))
+
+    def set_route(self, model: LightGBMModel, name: str, wtc) -> None:
+        model.name, model.wtc = name, wtc
+
+    def route(self, model: LightGBMModel):
+        return (model.name, model.wtc) if model.name is not None else None
+
+    def features(self, model: LightGBMModel) -> list:
+        return model.booster.feature_name()
+
+    def n_trees(self, model: LightGBMModel) -> int:
+        return model.booster.num_trees()
+
+    def validation_summary(self, model: LightGBMModel) -> tuple:
+        # the best iteration of LightGBM counts the rounds from 1
+        best_iteration = (model.booster.best_iteration or model.booster.current_iteration()) - 1
+        rmse = list(model.evals_result.values())[-1]['rmse']
+        return best_iteration, rmse[best_iteration]
+
+
+BACKENDS = {backend.name: backend for backend in [XGBoostBackend(), LightGBMBackend()]}
+
+
+def get_backend(name: str):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown model backend {name}, available backends: {', '.join(BACKENDS)}")
+    return BACKENDS[name]
+
+def backend_of(model):
+    '''
+    Backend of a trained or loaded base model
+    '''
+    for backend in BACKENDS.values():
+        if backend.owns(model):
+            return backend
+    raise ValueError(f"No model backend for {type(model).__name__}")
+
+def model_file(path: str, i: int, backend) -> str:
+    return f"{path}_model_{i}.{backend.extension}"
+
+def saved_backend(path: str, i: int):
+    '''
+    Backend of the i-th saved model of path (None if there is no such model)
+    '''
+    for backend in BACKENDS.values():
+        if os.path.exists(model_file(path, i, backend)):
+            return backend
+    return None
@@ -0,0 +1,257 @@
+'''
+Compiled tree ensembles: the saved XGBoost base models flattened in numpy arrays, predicted without xgboost
+
+export_compiled turns the models saved by save_model (up to their best iteration), their blend weights
+and their routing (wtc) into one binary file, {model path}_compiled.bin:
+    - a small JSON header: version of the saved models and blend weights it was compiled from, feature names,
+      and for each base model its name, wtc, blend weight, base score, range of trees and maximum depth
+    - the nodes of all the trees of all the models, as flat arrays (global node ids):
+      split feature, threshold, left child (the right one is next to it), default direction of the missing values,
+      categorical flag, leaf value, and the (node, category) keys of the categorical splits
+
+CompiledEnsemble.load memory-maps the file (no parsing of the trees, no xgboost import), and refuses a file compiled
+from other models or blend weights than the saved ones (a training since the export). predict_tow walks
+all the trees of a block of rows at once with numpy: one step per level of depth. Trees are summed in their order,
+in float32 from the base score, as xgboost does, so the predictions are the ones of models.xgboost_agregation.predict_tow.
+
+Usage:
+    python -m models.compiled_trees   # export models/xgboost_agregation_compiled.bin
+'''
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from models.feature_matrix import FeatureMatrix
+from models.prediction_cache import model_version
+
+MODEL_PATH = "models/xgboost_agregation"
+MAGIC = b'ATOWTREE'
+COMPILED_FORMAT = 2
+ALIGNMENT = 64
+# artifacts the compiled file is made from (see models/prediction_cache.py)
+COMPILED_FROM = ('models', 'blend')
+
+# rows x trees walked at once by predict (bounds the memory of the node index matrix)
+BLOCK_CELLS = 2**21
+
+NODE_ARRAYS = {'feature': np.int32, 'threshold': np.float32, 'left': np.int32, 'default_left': np.bool_,
+               'is_categorical': np.bool_, 'value': np.float32}
+
+
+def compiled_path(path: str) -> str:
+    return f"{path}_compiled.bin"
+
+def breadth_first_order(left: np.ndarray, right: np.ndarray) -> list:
+    '''
+    Nodes of a tree (xgboost numbering) in breadth first order, the two children of a node next to each other
+    '''
+    order = [0]
+    for node in order:
+        if left[node] != -1:
+            order.extend((left[node], right[node]))
+    return order
+
+def flatten_trees(trees: list, offset: int) -> tuple:
+    '''
+    Node arrays of the trees of one booster (xgboost JSON format), numbered from offset
+
+    The nodes are renumbered so that the right child of a node is next to its left child: the next node is then
+    left + (not go_left). A leaf has a NaN threshold (x < NaN is False) and no default left, its left is the node
+    before it so that it is its own next node. Its value is in value (0 for the split nodes).
+
+    Returns the arrays, the root of each tree, the (node, category) keys of the categorical splits and the maximum depth
+    '''
+    arrays = {name: [] for name in NODE_ARRAYS}
+    roots, category_keys, depth = [], [], 0
+    for tree in trees:
+        left = np.asarray(tree['left_children'], dtype=np.int64)
+        right = np.asarray(tree['right_children'], dtype=np.int64)
+        order = np.asarray(breadth_first_order(left, right))
+        new_ids = np.empty(len(order), dtype=np.int64)
+        new_ids[order] = np.arange(len(order)) + offset
+
+        is_leaf = left[order] == -1
+        node_depth = np.zeros(len(left), dtype=np.int64)
+        for node in order:
+            if left[node] != -1:
+                node_depth[left[node]] = node_depth[right[node]] = node_depth[node] + 1
+        depth = max(depth, int(node_depth.max()))
+
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)[order]
+        arrays['feature'].append(np.where(is_leaf, 0, np.asarray(tree['split_indices'])[order]))
+        arrays['threshold'].append(np.where(is_leaf, np.float32(np.nan), conditions))
+        arrays['left'].append(np.where(is_leaf, new_ids[order] - 1, new_ids[np.where(is_leaf, 0, left[order])]))
+        arrays['default_left'].append(np.asarray(tree['default_left'], dtype=bool)[order] & ~is_leaf)
+        arrays['is_categorical'].append(np.asarray(tree['split_type'])[order] == 1)
+        arrays['value'].append(np.where(is_leaf, conditions, np.float32(0)))
+
+        # the categories of a categorical split go to the right child
+        for node, start, size in zip(tree['categories_nodes'], tree['categories_segments'], tree['categories_sizes']):
+            categories = np.asarray(tree['categories'][start:start + size], dtype=np.int64)
+            category_keys.append((int(new_ids[node]) << 32) + categories)
+
+        roots.append(offset)
+        offset += len(left)
+
+    arrays = {name: np.concatenate(values).astype(NODE_ARRAYS[name]) for name, values in arrays.items()}
+    return arrays, roots, category_keys, depth
+
+def export_compiled(path: str = MODEL_PATH) -> str:
+    '''
+    Writes the compiled version of the saved base models of path (with their blend weights) in {path}_compiled.bin
+    '''
+    # xgboost is only needed to export, not to predict
+    from models.xgboost_agregation import load_model, load_blend_weights, model_route, model_features
+    from models.backends import backend_of, iteration_range
+
+    model_list = load_model(path)
+    weights = load_blend_weights(path, model_list)
+
+    node_arrays, roots, category_keys, models = [], [], [], []
+    n_nodes = 0
+    for i, (model, weight) in enumerate(zip(model_list, weights)):
+        if backend_of(model).name != 'xgboost':
+            raise ValueError(f"Model {model_route(model, i)[0]} is a {backend_of(model).name} model, only the XGBoost models can be compiled")
+        booster = model.get_booster()
+        stop = iteration_range(model)[1] or booster.num_boosted_rounds()
+        raw = json.loads(booster[:stop].save_raw('json'))['learner']
+        trees = raw['gradient_booster']['model']['trees']
+
+        arrays, model_roots, model_keys, depth = flatten_trees(trees, n_nodes)
+        name, wtc = model_route(model, i)
+        models.append({'name': name,
+                       'wtc': wtc,
+                       'weight': float(weight),
+                       'base_score': float(raw['learner_model_param']['base_score'].strip('[]')),
+                       'trees': [len(roots), len(roots) + len(model_roots)],
+                       'depth': depth,
+                       'categorical': bool(model_keys)})
+        node_arrays.append(arrays)
+        roots.extend(model_roots)
+        category_keys.extend(model_keys)
+        n_nodes += len(arrays['feature'])
+
+    data = {name: np.concatenate([arrays[name] for arrays in node_arrays]) for name in NODE_ARRAYS}
+    data['roots'] = np.asarray(roots, dtype=np.int32)
+    data['category_keys'] = np.sort(np.concatenate(category_keys)) if category_keys else np.zeros(0, dtype=np.int64)
+
+    header = {'format': COMPILED_FORMAT,
+              'model_version': model_version(path, COMPILED_FROM),
+              'feature_names': model_features(model_list[0]),
+              'models': models,
+              'arrays': {}}
+    offset = 0
+    for name, array in data.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    with open(compiled_path(path), 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in data.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    return compiled_path(path)
+
+
+class CompiledEnsemble:
+    '''
+    Base models of a compiled file (see export_compiled), memory-mapped
+    '''
+
+    def __init__(self, header: dict, arrays: dict):
+        self.feature_names = header['feature_names']
+        self.models = header['models']
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, path: str = MODEL_PATH):
+        raw = np.memmap(compiled_path(path), dtype=np.uint8, mode='r')
+        if raw[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError(f"{compiled_path(path)} is not a compiled tree ensemble")
+        header_size = int(raw[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header = json.loads(raw[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].tobytes())
+        if header['format'] != COMPILED_FORMAT:
+            raise ValueError(f"Unsupported compiled format in {compiled_path(path)}, export the models again")
+        if header['model_version'] != model_version(path, COMPILED_FROM):
+            raise ValueError(f"{compiled_path(path)} was compiled from other models or blend weights than the ones saved in {path}, "
+                             f"export the models again (python -m models.compiled_trees)")
+
+        data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            arrays[name] = np.asarray(raw[start:start + dtype.itemsize * int(np.prod(spec['shape']))]).view(dtype).reshape(spec['shape'])
+        return cls(header, arrays)
+
+    def predict_model(self, model: dict, X: np.ndarray) -> np.ndarray:
+        '''
+        Prediction (float32) of one base model on the float32 rows of X
+        '''
+        a = self.arrays
+        roots = a['roots'][model['trees'][0]:model['trees'][1]]
+        y_pred = np.empty(len(X), dtype=np.float32)
+        block_rows = max(1, BLOCK_CELLS // max(1, len(roots)))
+        for start in range(0, len(X), block_rows):
+            X_block = np.ascontiguousarray(X[start:start + block_rows])
+            # position of the first feature of the row of each (row, tree) cell in the flattened block
+            row_offsets = (np.arange(len(X_block), dtype=np.int64) * X.shape[1])[:, None]
+            has_missing = np.isnan(X_block).any()
+            nodes = np.repeat(roots[None, :], len(X_block), axis=0)
+            for _ in range(model['depth']):
+                x = np.take(X_block, row_offsets + np.take(a['feature'], nodes))
+                go_left = x < np.take(a['threshold'], nodes)
+                if model['categorical']:
+                    categorical = np.take(a['is_categorical'], nodes)
+                    codes = np.nan_to_num(x[categorical], nan=-1).astype(np.int64)
+                    keys = (nodes[categorical].astype(np.int64) << 32) + codes
+                    positions = np.searchsorted(a['category_keys'], keys).clip(max=len(a['category_keys']) - 1)
+                    # the categories of the split go right, the other (and invalid) ones left
+                    go_left[categorical] = (a['category_keys'][positions] != keys) | (codes < 0)
+                if has_missing:
+                    missing = np.isnan(x)
+                    go_left[missing] = np.take(a['default_left'], nodes[missing])
+                nodes = np.take(a['left'], nodes) + ~go_left
+
+            # trees summed one after the other in float32, from the base score
+            sums = np.empty((len(X_block), len(roots) + 1), dtype=np.float32)
+            sums[:, 0] = model['base_score']
+            sums[:, 1:] = np.take(a['value'], nodes)
+            y_pred[start:start + block_rows] = np.add.accumulate(sums, axis=1)[:, -1]
+        return y_pred
+
+    def predict_tow(self, data: pd.DataFrame) -> np.array:
+        '''
+        Same as models.xgboost_agregation.predict_tow with the saved models and blend weights
+        '''
+        try:
+            data[["local_departure_hour","local_arrival_hour","lon_adep"]]
+        except:
+            raise ValueError("The data is not in the right format (missing preprocessing)")
+
+        matrix = FeatureMatrix.from_frame(data, self.feature_names)
+
+        # blended in float64 as models.xgboost_agregation.predict_tow
+        y_pred = np.zeros(len(matrix.values), dtype=np.float64)
+        for model in self.models:
+            block = matrix.block(model['wtc'])
+            if model['weight'] and block.stop > block.start:
+                y_pred[block] += model['weight']*self.predict_model(model, matrix.values[block]).astype(np.float64)
+
+        return matrix.restore_order(y_pred.astype(np.float32))
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Export the saved base models as a compiled tree ensemble")
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    args = parser.parse_args(argv)
+    print(f"Compiled models written to {export_compiled(args.model_path)}")
+
+if __name__ == "__main__":
+    main()
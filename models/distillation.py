@@ -0,0 +1,199 @@
+'''
+Compression of the blend of the base models: distillation into one student booster with a budget of trees and depth
+
+The three production models hold about 2,600 trees of depth 9-10, and the prediction time of a row grows with the number
+of trees. A student is one XGBoost model (on all the wtc) trained to reproduce the blended predict_tow output of the
+teacher models (the saved ones, or any list of train_models), with at most n_trees trees of depth max_depth:
+    - the challenge set (and optionally unlabeled flights, e.g. the submission set) is preprocessed with the saved state
+      and labeled with the predictions of the teacher
+    - a fraction of the challenge flights is held out: the students are trained on the other flights only
+    - each (trees, depth) budget is reported on the held-out flights: rmse to the true tow and its increase over the
+      teacher rmse (the teacher has seen these flights in its training, so the increase is an upper bound),
+      rmse to the teacher predictions, rows/sec of predict_tow and speedup over the teacher
+    - the most accurate student (or, with --max-rmse-increase, the fastest one under this loss of accuracy) is saved
+      in {model path}_student_model_0.json, with the preprocessing state and a blend of weight 1, so that it is
+      deployed like the teacher models: load_model, predict_tow, main.py --model-path, scoring_service.py --model-path
+
+Usage:
+    python -m models.distillation --trees 100 200 400 --max-depth 6 8 --unlabeled data/submission_set.csv
+    python main.py --model-path models/xgboost_agregation_student
+'''
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from models.feature_matrix import FeatureMatrix
+from models.manifest import dataset_record, record_version
+from models.xgboost_agregation import train_model, predict_tow, load_model, save_model, load_blend_weights, load_params_set
+from models.xgboost_agregation import blend_path, blended_models_version, model_features, set_route
+from models.backends import backend_of
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+MODEL_PATH = "models/xgboost_agregation"
+TRAIN_PATH = "./data/challenge_set.csv"
+STUDENT_NAME = "student"
+TREES = [100, 200, 400]
+DEPTHS = [6, 8]
+
+
+def student_path(path: str) -> str:
+    return f"{path}_student"
+
+def rmse(y_pred: np.ndarray, y: np.ndarray) -> float:
+    return float(np.sqrt(np.mean((np.asarray(y_pred, dtype=np.float64) - np.asarray(y, dtype=np.float64))**2)))
+
+def rows_per_sec(data, model_list: list, weights: list, repeats: int = 3) -> float:
+    '''
+    Throughput of predict_tow on data (best of repeats runs)
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict_tow(data, model_list, weights)
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best
+
+def train_student(X: np.ndarray, y_teacher: np.ndarray, params: dict, n_trees: int, max_depth: int, feature_names: list, feature_types: list):
+    '''
+    Student model (all the wtc) of n_trees trees of depth max_depth fitted on the teacher predictions y_teacher
+    '''
+    model = train_model(X, y_teacher, {**params, 'n_estimators': n_trees, 'max_depth': max_depth},
+                        feature_names=feature_names, feature_types=feature_types)
+    set_route(model, STUDENT_NAME, None)
+    return model
+
+def distill(data, teacher_list: list, teacher_weights: list, budgets: list, params: dict, validation_fraction: float = 0.2, unlabeled: list = None) -> tuple:
+    '''
+    Trains a student for each (n_trees, max_depth) of budgets on the predictions of the teacher blend on data
+    (and on the unlabeled frames), evaluated on validation_fraction of the rows of data.
+
+    Returns the report of the teacher and of each student, and the students
+    '''
+    features = model_features(teacher_list[0])
+    matrix = FeatureMatrix.from_frame(data, features, validation_fraction=validation_fraction)
+    validation_df = data.iloc[matrix.order[matrix.block(validation=True)]]
+    y_true = validation_df['tow'].to_numpy()
+
+    # teacher predictions in the (sorted) row order of matrix
+    start = time.perf_counter()
+    y_teacher = predict_tow(data, teacher_list, teacher_weights)[matrix.order]
+    X, y = matrix.values[matrix.block()], y_teacher[matrix.block()]
+    n_unlabeled = 0
+    for d_frame in unlabeled or []:
+        unlabeled_matrix = FeatureMatrix.from_frame(d_frame, features)
+        X = np.concatenate([X, unlabeled_matrix.values])
+        y = np.concatenate([y, predict_tow(d_frame, teacher_list, teacher_weights)[unlabeled_matrix.order]])
+        n_unlabeled += len(d_frame)
+    print(f"Teacher predictions of {len(data)} flights (and {n_unlabeled} unlabeled ones) computed in {time.perf_counter() - start:.1f}s")
+
+    y_teacher_validation = y_teacher[matrix.block(validation=True)]
+    teacher_rows_per_sec = rows_per_sec(validation_df, teacher_list, teacher_weights)
+    teacher_rmse = rmse(y_teacher_validation, y_true)
+    report = {'teacher': {'trees': sum(backend_of(model).n_trees(model) for model in teacher_list),
+                          'rmse': teacher_rmse,
+                          'rows_per_sec': teacher_rows_per_sec},
+              'students': []}
+
+    students = []
+    for n_trees, max_depth in budgets:
+        start = time.perf_counter()
+        student = train_student(X, y, params, n_trees, max_depth, matrix.columns, matrix.feature_types)
+        training_time = time.perf_counter() - start
+
+        y_student = predict_tow(validation_df, [student])
+        student_rows_per_sec = rows_per_sec(validation_df, [student], [1.0])
+        report['students'].append({'trees': n_trees,
+                                   'max_depth': max_depth,
+                                   'training_sec': training_time,
+                                   'rmse': rmse(y_student, y_true),
+                                   'rmse_increase': rmse(y_student, y_true) - teacher_rmse,
+                                   'teacher_rmse': rmse(y_student, y_teacher_validation),
+                                   'rows_per_sec': student_rows_per_sec,
+                                   'speedup': student_rows_per_sec / teacher_rows_per_sec})
+        students.append(student)
+        print(f"Student of {n_trees} trees of depth {max_depth} trained in {training_time:.1f}s")
+
+    return report, students
+
+def select_student(report: dict, max_rmse_increase: float = None) -> int:
+    '''
+    Position of the student to deploy: the most accurate one, or the fastest one with an rmse increase under
+    max_rmse_increase (None if there is none)
+    '''
+    students = report['students']
+    if max_rmse_increase is None:
+        return min(range(len(students)), key=lambda i: students[i]['rmse'])
+    eligible = [i for i, student in enumerate(students) if student['rmse_increase'] <= max_rmse_increase]
+    return max(eligible, key=lambda i: students[i]['rows_per_sec'], default=None)
+
+def print_report(report: dict) -> None:
+    teacher = report['teacher']
+    print("-"*100)
+    print(f"{'model':<22}{'rmse':>10}{'rmse +':>10}{'to teacher':>12}{'rows/sec':>12}{'speedup':>10}")
+    print(f"{'teacher (' + str(teacher['trees']) + ' trees)':<22}{teacher['rmse']:>10.1f}{'-':>10}{'-':>12}{teacher['rows_per_sec']:>12.0f}{1:>9.1f}x")
+    for student in report['students']:
+        name = f"student {student['trees']}x{student['max_depth']}"
+        print(f"{name:<22}{student['rmse']:>10.1f}{student['rmse_increase']:>10.1f}{student['teacher_rmse']:>12.1f}"
+              f"{student['rows_per_sec']:>12.0f}{student['speedup']:>9.1f}x")
+    print("-"*100)
+
+def save_student(student, path: str, teacher_path: str, report: dict, records: list) -> dict:
+    '''
+    Saves the student as the only model of path, with the preprocessing state of the teacher and a blend of weight 1
+    '''
+    save_model([student], path)
+    PreprocessingPipeline.load(teacher_path).save(path)
+    with open(blend_path(path), 'w') as f:
+        json.dump({'models': [STUDENT_NAME], 'weights': [1.0], 'model_version': blended_models_version(path), 'teacher': teacher_path, 'distillation': report}, f, indent=4)
+    return record_version(path, 'distillation', records, [student], teacher=teacher_path)
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Distill the blend of the saved models into one smaller student model")
+    parser.add_argument("--model-path", default=MODEL_PATH, help="prefix of the teacher models")
+    parser.add_argument("--train-path", default=TRAIN_PATH)
+    parser.add_argument("--unlabeled", nargs='*', default=[], help="csv files of flights without tow also labeled by the teacher (e.g. the submission set)")
+    parser.add_argument("--trees", type=int, nargs='*', default=TREES, help="tree budgets of the students")
+    parser.add_argument("--max-depth", type=int, nargs='*', default=DEPTHS, help="depth budgets of the students")
+    parser.add_argument("--learning-rate", type=float, default=None, help="learning rate of the students (default: the one of the basic model)")
+    parser.add_argument("--validation-fraction", type=float, default=0.2, help="fraction of the challenge flights held out to evaluate the students")
+    parser.add_argument("--max-rmse-increase", type=float, default=None, help="save the fastest student under this rmse increase (default: the most accurate one)")
+    parser.add_argument("--output", default=None, help="prefix of the saved student (default: {model path}_student)")
+    args = parser.parse_args(argv)
+
+    teacher_list = load_model(args.model_path)
+    teacher_weights = load_blend_weights(args.model_path, teacher_list)
+    pipeline = PreprocessingPipeline.load(args.model_path)
+
+    train_df = load_flights(args.train_path)
+    records = [dataset_record(train_df, args.train_path)]
+    train_df = pipeline.transform(train_df)
+    unlabeled = []
+    for unlabeled_path in args.unlabeled:
+        d_frame = load_flights(unlabeled_path)
+        records.append(dataset_record(d_frame, unlabeled_path))
+        unlabeled.append(pipeline.transform(d_frame))
+
+    params = dict(load_params_set(args.model_path)['params_basic'])
+    if args.learning_rate is not None:
+        params['learning_rate'] = args.learning_rate
+
+    budgets = [(n_trees, max_depth) for n_trees in args.trees for max_depth in args.max_depth]
+    report, students = distill(train_df, teacher_list, teacher_weights, budgets, params, args.validation_fraction, unlabeled)
+    print_report(report)
+
+    selected = select_student(report, args.max_rmse_increase)
+    if selected is None:
+        print(f"No student has an rmse increase under {args.max_rmse_increase}, nothing saved")
+        return
+    path = args.output or student_path(args.model_path)
+    version = save_student(students[selected], path, args.model_path, report['students'][selected], records)
+    student = report['students'][selected]
+    print(f"Student of {student['trees']} trees of depth {student['max_depth']} (rmse +{student['rmse_increase']:.1f}, "
+          f"{student['speedup']:.1f}x faster) saved to {path}, version {version['version']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+'''
+Benchmark of the encodings of the categorical columns (callsign, adep, ades, airline...):
+    - hashing: int codes, split by XGBoost as ordinal numbers (the default)
+    - categorical: pandas categoricals, split natively by XGBoost (enable_categorical, hist tree method)
+    - categorical+stats: categorical, plus the out-of-fold frequency and mean tow of the high-cardinality columns
+
+Each variant fits the preprocessing and trains the three models on the same 80% of the challenge set,
+and is evaluated on the remaining 20%: preprocessing and training times, size of the models and RMSE are reported.
+
+Usage:
+    python -m models.encoding_benchmark --n-estimators 200
+'''
+
+import argparse
+import json
+import time
+
+from sklearn.model_selection import train_test_split
+
+from models.xgboost_agregation import train_models, evaluate_model, load_params_set
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+STATS_COLUMNS = ['callsign', 'adep', 'ades', 'airline', 'aircraft_type']
+
+VARIANTS = {'hashing': dict(encoding='hashing'),
+            'categorical': dict(encoding='categorical'),
+            'categorical+stats': dict(encoding='categorical', stats_columns=STATS_COLUMNS, target_stats=True)}
+
+
+def benchmark_encoding(raw_train, raw_test, pipeline_kwargs: dict, params_set: dict) -> dict:
+    start = time.perf_counter()
+    pipeline = PreprocessingPipeline(**pipeline_kwargs)
+    train_df = pipeline.fit_transform(raw_train.copy())
+    test_df = pipeline.transform(raw_test.copy())
+    preprocessing_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model_list = train_models(train_df, params_set)
+    training_time = time.perf_counter() - start
+
+    rmse, rel_error = evaluate_model(test_df, model_list)
+    return {'preprocessing_sec': preprocessing_time,
+            'training_sec': training_time,
+            'model_size_bytes': sum(len(model.get_booster().save_raw('ubj')) for model in model_list),
+            'n_features': train_df.shape[1] - 1,
+            'rmse': float(rmse),
+            'relative_error': float(rel_error)}
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Compare int hashing and native categorical encoding of the TOW models")
+    parser.add_argument("--train", default="data/challenge_set.csv")
+    parser.add_argument("--variants", nargs='*', choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument("--n-estimators", type=int, default=None, help="overrides the number of trees of the three models")
+    parser.add_argument("--max-depth", type=int, default=None, help="overrides the depth of the trees of the three models")
+    parser.add_argument("--model-path", default="models/xgboost_agregation", help="prefix of the tuned params (see models/tuning.py)")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    params_set = load_params_set(args.model_path)
+    for params in params_set.values():
+        if args.n_estimators is not None:
+            params['n_estimators'] = args.n_estimators
+        if args.max_depth is not None:
+            params['max_depth'] = args.max_depth
+
+    raw_train, raw_test = train_test_split(load_flights(args.train), test_size=0.2, random_state=42)
+
+    results = {variant: benchmark_encoding(raw_train, raw_test, VARIANTS[variant], params_set) for variant in args.variants}
+
+    print("-"*100)
+    print(f"{'encoding':<20}{'preprocessing':>15}{'training':>12}{'model size':>14}{'features':>10}{'rmse':>12}{'rel. error':>12}")
+    for variant, result in results.items():
+        print(f"{variant:<20}{result['preprocessing_sec']:>14.1f}s{result['training_sec']:>11.1f}s{result['model_size_bytes']/1e6:>11.1f} MB"
+              f"{result['n_features']:>10}{result['rmse']:>12.1f}{result['relative_error']:>12.4f}")
+    print("-"*100)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+
+class FeatureMatrix:
+    '''
+    Memory-compact input of the models: one C-contiguous float32 array (rows x features) with its column names
+
+    The rows are sorted by (validation flag, wtc), so that every subset the models are trained or evaluated on
+    (all training rows, training rows of a wtc, validation rows of a wtc...) is a contiguous block,
+    i.e. a numpy view of the array, not a copy. order maps the sorted rows back to the rows of the source frame.
+
+    Categorical columns are stored as their category codes (NaN for missing values),
+    feature_types marks them 'c' (and the numerical ones 'q') for the native categorical support of XGBoost.
+    '''
+
+    def __init__(self, values: np.ndarray, columns: list, wtc: np.ndarray, is_validation: np.ndarray, order: np.ndarray, target: np.ndarray = None, feature_types: list = None):
+        self.values = values
+        self.columns = list(columns)
+        self.feature_types = list(feature_types or ['q'] * len(self.columns))
+        self.wtc = wtc
+        self.is_validation = is_validation
+        self.order = order
+        self.target = target
+
+    @classmethod
+    def from_frame(cls, data: pd.DataFrame, columns: list = None, target: str = 'tow', validation_fraction: float = 0.0, random_state: int = 42):
+        '''
+        Builds the matrix column by column from data (no intermediate float64 frame)
+
+        columns defaults to all the columns but the target. With validation_fraction, a random fraction of the rows
+        is flagged as validation rows.
+        '''
+        if columns is None:
+            columns = [column for column in data.columns if column not in (target, 'Unnamed: 0')]
+
+        n_rows = len(data)
+        wtc = data['wtc'].cat.codes.to_numpy() if isinstance(data['wtc'].dtype, pd.CategoricalDtype) else data['wtc'].to_numpy()
+        is_validation = np.zeros(n_rows, dtype=bool)
+        if validation_fraction:
+            rng = np.random.default_rng(random_state)
+            is_validation[rng.choice(n_rows, int(round(n_rows * validation_fraction)), replace=False)] = True
+
+        order = np.lexsort((wtc, is_validation))
+
+        values = np.empty((n_rows, len(columns)), dtype=np.float32)
+        feature_types = []
+        for j, column in enumerate(columns):
+            series = data[column]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                codes = series.cat.codes.to_numpy()
+                values[:, j] = np.where(codes >= 0, codes, np.nan)[order]
+                feature_types.append('c')
+            else:
+                values[:, j] = series.to_numpy()[order]
+                feature_types.append('q')
+
+        y = data[target].to_numpy(dtype=np.float32)[order] if target in data.columns else None
+
+        return cls(values, columns, wtc[order], is_validation[order], order, y, feature_types)
+
+    def block(self, wtc=None, validation: bool = False) -> slice:
+        '''
+        Slice of the sorted rows of one wtc (all of them if wtc is None), in the training or validation rows
+        '''
+        # is_validation is sorted (training rows first), and wtc is sorted within the training and the validation rows
+        lo = np.searchsorted(self.is_validation, validation, side='left')
+        hi = np.searchsorted(self.is_validation, validation, side='right')
+        if wtc is not None:
+            part = self.wtc[lo:hi]
+            lo, hi = lo + np.searchsorted(part, wtc, side='left'), lo + np.searchsorted(part, wtc, side='right')
+        return slice(int(lo), int(hi))
+
+    def subset(self, wtc=None, validation: bool = False) -> tuple:
+        '''
+        Views (X, y) of the training (or validation) rows, of one wtc or of all of them
+        '''
+        block = self.block(wtc, validation)
+        y = self.target[block] if self.target is not None else None
+        return self.values[block], y
+
+    def n_validation(self) -> int:
+        return int(self.is_validation.sum())
+
+    def restore_order(self, y_sorted: np.ndarray) -> np.ndarray:
+        '''
+        Puts values computed on the sorted rows back in the row order of the source frame
+        '''
+        y = np.empty_like(y_sorted)
+        y[self.order] = y_sorted
+        return y
@@ -0,0 +1,106 @@
+'''
+Incremental training of the base models on a batch of newly arrived flights
+
+Instead of retraining from scratch on the full challenge set:
+    - the saved preprocessing state is updated with PreprocessingPipeline.partial_fit (new airports and countries are
+      mapped to their nearest existing group, new categories are appended to the vocabularies)
+    - each saved model keeps its trees (up to its best iteration) and n_trees trees are boosted on top of them,
+      fitted on the new flights only
+    - the new version and the data it has seen are recorded in the manifest ({model path}_manifest.json)
+
+Usage:
+    python -m models.incremental data/new_flights.csv --trees 100
+'''
+
+import argparse
+import time
+
+from models.feature_matrix import FeatureMatrix
+from models.manifest import dataset_record, record_version, seen_fingerprints
+from models.xgboost_agregation import train_model, load_model, save_model, load_params_set, model_features, model_route, set_route
+from models.backends import backend_of
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+MODEL_PATH = "models/xgboost_agregation"
+
+
+def base_booster(model):
+    '''
+    Copy of the booster of a saved model, cut at its best iteration if it was trained with early stopping
+
+    Its feature names are removed, the new trees are fitted on a numpy matrix (train_model names the features again).
+    '''
+    booster = model.get_booster()
+    best_iteration = booster.attr('best_iteration')
+    booster = booster[:int(best_iteration) + 1 if best_iteration is not None else booster.num_boosted_rounds()]
+    booster.feature_names = None
+    return booster
+
+def continue_models(data, model_list: list, params_set: dict, n_trees: int, early_stopping_rounds: int = None, validation_fraction: float = 0.2) -> list:
+    '''
+    Adds (at most) n_trees trees to each of the base models, fitted on data (preprocessed with the updated pipeline)
+    '''
+    matrix = FeatureMatrix.from_frame(data, model_features(model_list[0]), validation_fraction=validation_fraction if early_stopping_rounds else 0.0)
+
+    new_model_list = []
+    for i, model in enumerate(model_list):
+        name, wtc = model_route(model, i)
+        if backend_of(model).name != 'xgboost':
+            raise ValueError(f"Model {name} is a {backend_of(model).name} model, only the XGBoost models can be continued")
+        params = params_set[f"params_{name}"]
+        X, y = matrix.subset(wtc)
+        if len(y) == 0:
+            print(f"No new flight for model {name}, kept as is")
+            new_model_list.append(model)
+            continue
+
+        eval_set = [matrix.subset(wtc, validation=True)] if early_stopping_rounds else None
+
+        start = time.perf_counter()
+        booster = base_booster(model)
+        n_base = booster.num_boosted_rounds()
+        new_model = train_model(X, y, {**params, 'n_estimators': n_trees}, eval_set=eval_set, early_stopping_rounds=early_stopping_rounds,
+                                feature_names=matrix.columns, xgb_model=booster, feature_types=matrix.feature_types)
+        duration = time.perf_counter() - start
+
+        print("-"*100)
+        print(f"Model {name} continued in {duration:.1f}s on {len(y)} flights: {n_base} -> {new_model.get_booster().num_boosted_rounds()} trees")
+        print("-"*100)
+
+        set_route(new_model, name, wtc)
+        new_model_list.append(new_model)
+
+    return new_model_list
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Continue the training of the saved TOW models on a batch of new flights")
+    parser.add_argument("new_flights", help="csv of the new flights, in the format of the challenge set")
+    parser.add_argument("--trees", type=int, default=100, help="number of trees added to each model (a maximum with early stopping)")
+    parser.add_argument("--early-stopping-rounds", type=int, default=None)
+    parser.add_argument("--validation-fraction", type=float, default=0.2)
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--force", action="store_true", help="train even if the models have already seen these flights")
+    args = parser.parse_args(argv)
+
+    new_df = load_flights(args.new_flights)
+    record = dataset_record(new_df, args.new_flights)
+    if record['fingerprint'] in seen_fingerprints(args.model_path) and not args.force:
+        print(f"The models of {args.model_path} have already been trained on {args.new_flights}, use --force to train again")
+        return
+
+    pipeline = PreprocessingPipeline.load(args.model_path)
+    added = pipeline.partial_fit(new_df)
+    print(f"Preprocessing state updated: {added['airports']} new airports, {added['countries']} new countries, {added['categories']} new categories")
+    new_df = pipeline.transform(new_df)
+
+    model_list = continue_models(new_df, load_model(args.model_path), load_params_set(args.model_path), args.trees,
+                                 args.early_stopping_rounds, args.validation_fraction)
+
+    save_model(model_list, args.model_path)
+    pipeline.save(args.model_path)
+    version = record_version(args.model_path, 'incremental', [record], model_list, added=added)
+    print(f"Model version {version['version']} saved to {args.model_path}")
+
+if __name__ == "__main__":
+    main()
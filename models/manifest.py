@@ -0,0 +1,78 @@
+'''
+Manifest of the trained model versions: {model path}_manifest.json
+
+Every training (full, incremental or of a stacked base model) appends a version recording the data it has seen:
+dataset path, number of rows, first and last flight date and a fingerprint of the flight ids,
+so that the flights each saved model has been trained on can be traced back.
+'''
+
+import datetime
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from models.backends import backend_of
+
+
+def manifest_path(path: str) -> str:
+    return f"{path}_manifest.json"
+
+def load_manifest(path: str) -> dict:
+    if not os.path.exists(manifest_path(path)):
+        return {'versions': []}
+    with open(manifest_path(path)) as f:
+        return json.load(f)
+
+def flights_fingerprint(d_frame: pd.DataFrame) -> str:
+    '''
+    sha1 of the sorted flight ids (the index) of d_frame
+    '''
+    flight_ids = d_frame.index.astype(str).sort_values()
+    return hashlib.sha1('\n'.join(flight_ids).encode()).hexdigest()
+
+def dataset_record(d_frame: pd.DataFrame, dataset: str) -> dict:
+    record = {'dataset': dataset,
+              'rows': len(d_frame),
+              'fingerprint': flights_fingerprint(d_frame)}
+    if 'date' in d_frame.columns and len(d_frame):
+        dates = pd.Series(d_frame['date'].astype(str))
+        record['first_date'], record['last_date'] = dates.min(), dates.max()
+    return record
+
+def record_version(path: str, mode: str, datasets: list, model_list: list = None, **extra) -> dict:
+    '''
+    Appends a version to the manifest of path: mode is 'full' (trained from scratch), 'incremental'
+    (continued from the previous version), 'stacking' (a base model added to the previous ones, see models/stacking.py)
+    or 'distillation' (a student model distilled from the blend of the saved ones, see models/distillation.py),
+    datasets the dataset records of the data it was trained on
+    '''
+    manifest = load_manifest(path)
+    previous = manifest['versions'][-1]['version'] if manifest['versions'] else 0
+    version = {'version': previous + 1,
+               'mode': mode,
+               'base_version': previous if mode == 'incremental' else None,
+               'trained_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+               'datasets': datasets}
+    if model_list is not None:
+        version['n_trees'] = [backend_of(model).n_trees(model) for model in model_list]
+    version.update(extra)
+    manifest['versions'].append(version)
+
+    tmp_path = f"{manifest_path(path)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path(path))
+    return version
+
+def seen_fingerprints(path: str) -> set:
+    '''
+    Fingerprints of all the datasets the current model version has been trained on (back to the last full training)
+    '''
+    fingerprints = set()
+    for version in reversed(load_manifest(path)['versions']):
+        fingerprints.update(dataset['fingerprint'] for dataset in version['datasets'])
+        if version['mode'] == 'full':
+            break
+    return fingerprints
@@ -0,0 +1,212 @@
+'''
+Prediction cache: the tow of the flights whose model input did not change since they were last scored
+
+The key of a row is a 128-bit hash of its final feature vector (its float32 row in the FeatureMatrix of the models,
+bit for bit, in the column order of the models) and of the version of the model artifacts (model_version: sha256 of
+the content of the saved models, blend weights and compiled ensemble, by their role, not their path). Training, adding
+a base model, blending or exporting again changes the version, so the predictions of the previous models are never
+returned, while a copy of the models (another directory, a new checkout) keeps it.
+
+PredictionCache.predict looks the keys up in a bounded in-memory LRU (max_entries rows), then in an optional on-disk
+store (a sqlite file kept from one run to the next), and predicts all the misses in one call of the predictor.
+The store only keeps the predictions of one model version: it is emptied when it is opened with other models.
+
+Usage:
+    python main.py --prediction-cache                          # store in data/cache/predictions.sqlite
+    python scoring_service.py --prediction-cache --cache-store ""   # in-memory LRU only
+'''
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from models.feature_matrix import FeatureMatrix
+
+MODEL_PATH = "models/xgboost_agregation"
+STORE_PATH = "data/cache/predictions.sqlite"
+MAX_ENTRIES = 1_000_000
+ARTIFACTS = ('models', 'blend', 'compiled')
+
+# bytes of an artifact read at once to hash it
+HASH_CHUNK_BYTES = 2**24
+
+# keys per SELECT ... IN (...) of the store (below the default SQLITE_MAX_VARIABLE_NUMBER of old sqlite versions)
+STORE_QUERY_KEYS = 900
+
+
+def model_artifacts(path: str = MODEL_PATH, artifacts: tuple = ARTIFACTS) -> list:
+    '''
+    Files of the saved models of path whose change changes the predictions: base models, blend weights, compiled ensemble
+    (only the kinds of artifacts listed in artifacts)
+    '''
+    files = []
+    if 'models' in artifacts:
+        files += glob.glob(f"{path}_model_*.json")
+    if 'blend' in artifacts:
+        files.append(f"{path}_blend.json")
+    if 'compiled' in artifacts:
+        files.append(f"{path}_compiled.bin")
+    return sorted(file for file in files if os.path.exists(file))
+
+@lru_cache(maxsize=None)
+def _file_digest(file: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_digest(file: str) -> str:
+    '''
+    sha256 of the content of file (hashed once per process while its size and modification time do not change)
+    '''
+    stat = os.stat(file)
+    return _file_digest(file, stat.st_size, stat.st_mtime_ns)
+
+def model_version(path: str = MODEL_PATH, artifacts: tuple = ARTIFACTS) -> str:
+    '''
+    Hex digest of the content of the model artifacts of path, each one by its role (model_{i}.json, blend.json,
+    compiled.bin): the same models copied to another path or saved again with the same content have the same version.
+    The blend weights record the version of the base models they were fitted for (artifacts ('models',)),
+    the compiled ensemble the one of the base models and blend weights it was compiled from (('models', 'blend'))
+    '''
+    contents = [(file[len(path) + 1:], file_digest(file)) for file in model_artifacts(path, artifacts)]
+    if not contents:
+        raise FileNotFoundError(f"No saved models in {path}_model_*.json")
+    return hashlib.sha256(json.dumps(contents).encode()).hexdigest()
+
+def row_keys(values: np.ndarray, version: str) -> list:
+    '''
+    128-bit key (16 bytes) of each float32 row of values and of the model version
+    '''
+    bits = pd.DataFrame(np.ascontiguousarray(values, dtype=np.float32).view(np.uint32), copy=False)
+    keys = np.empty((len(bits), 2), dtype=np.uint64)
+    # the two halves of the key are hashed with two keys derived from the version
+    keys[:, 0] = pd.util.hash_pandas_object(bits, index=False, hash_key=version[:16]).to_numpy()
+    keys[:, 1] = pd.util.hash_pandas_object(bits, index=False, hash_key=version[16:32]).to_numpy()
+    return keys.view('V16').ravel().tolist()
+
+
+class PredictionCache:
+    '''
+    Predictions of the models of one version, by row key: in-memory LRU of max_entries rows,
+    in front of an optional sqlite store (store_path, None for the in-memory cache only)
+    '''
+
+    def __init__(self, version: str, max_entries: int = MAX_ENTRIES, store_path: str = None):
+        self.version = version
+        self.max_entries = max_entries
+        self.store_path = store_path
+        self._memory = OrderedDict()
+        self._store = self._open_store(store_path) if store_path else None
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_models(cls, path: str = MODEL_PATH, max_entries: int = MAX_ENTRIES, store_path: str = None):
+        '''
+        Cache of the models currently saved in path
+        '''
+        return cls(model_version(path), max_entries, store_path)
+
+    def _open_store(self, path: str) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # the scoring service creates the cache in the main thread and predicts in its batching thread
+        store = sqlite3.connect(path, check_same_thread=False)
+        store.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        store.execute('CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, tow REAL NOT NULL) WITHOUT ROWID')
+        row = store.execute("SELECT value FROM meta WHERE name = 'model_version'").fetchone()
+        if row is None or row[0] != self.version:
+            store.execute('DELETE FROM predictions')
+            store.execute("INSERT OR REPLACE INTO meta VALUES ('model_version', ?)", (self.version,))
+        store.commit()
+        return store
+
+    def close(self) -> None:
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _remember(self, keys: list, values: list) -> None:
+        self._memory.update(zip(keys, values))
+        for key in keys:
+            self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup_memory(self, key: bytes):
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)
+        return value
+
+    def _lookup_store(self, keys: list) -> dict:
+        found = {}
+        for start in range(0, len(keys), STORE_QUERY_KEYS):
+            part = keys[start:start + STORE_QUERY_KEYS]
+            query = f"SELECT key, tow FROM predictions WHERE key IN ({','.join('?' * len(part))})"
+            found.update(self._store.execute(query, part).fetchall())
+        return found
+
+    def predict(self, data: pd.DataFrame, predict, feature_names: list = None) -> np.ndarray:
+        '''
+        predict(data) (float32), only computed on the rows of data whose features (feature_names) are not cached
+        '''
+        if len(data) == 0:
+            return predict(data)
+
+        matrix = FeatureMatrix.from_frame(data, feature_names)
+        sorted_keys = np.empty(len(data), dtype=object)
+        sorted_keys[:] = row_keys(matrix.values, self.version)
+        keys = matrix.restore_order(sorted_keys).tolist()
+
+        values = [self._lookup_memory(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.hits += len(keys) - len(missing)
+
+        if missing and self._store is not None:
+            stored = self._lookup_store([keys[i] for i in missing])
+            if stored:
+                for i in missing:
+                    values[i] = stored.get(keys[i])
+                self._remember(list(stored), list(stored.values()))
+                self.store_hits += sum(values[i] is not None for i in missing)
+                missing = [i for i in missing if values[i] is None]
+
+        if missing:
+            y_missing = np.asarray(predict(data.iloc[missing]), dtype=np.float32)
+            missing_keys = [keys[i] for i in missing]
+            for i, value in zip(missing, y_missing.tolist()):
+                values[i] = value
+            self._remember(missing_keys, y_missing.tolist())
+            if self._store is not None:
+                self._store.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?)', zip(missing_keys, y_missing.tolist()))
+                self._store.commit()
+            self.misses += len(missing)
+
+        return np.asarray(values, dtype=np.float32)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.store_hits + self.misses
+        return {'model_version': self.version[:12],
+                'lookups': lookups,
+                'memory_hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.store_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory)}
+
+    def print_summary(self) -> None:
+        stats = self.stats()
+        print("-"*100)
+        print(f"Prediction cache (models {stats['model_version']}): {stats['lookups']} flights, "
+              f"{stats['memory_hits']} memory hits, {stats['store_hits']} store hits, {stats['misses']} predicted, "
+              f"hit rate {stats['hit_rate']:.1%}")
@@ -0,0 +1,307 @@
+'''
+Stacking of the base models: out-of-fold predictions and blend weights
+
+predict_tow sums the predictions of the base models (each one on the rows of its wtc) times their blend weights.
+Instead of tuning these weights in a notebook:
+    - oof: every base model is retrained on n_folds - 1 folds of the challenge set and predicts the remaining fold,
+      these out-of-fold predictions are cached as float32 arrays (one .npy per model, NaN outside the rows of its wtc)
+      in {model path}_oof/, with the folds, the target and the flight ids they are aligned on, and the version of the
+      preprocessing state they were computed with (the cache is started again when the state is fitted again)
+    - blend: non-negative weights minimizing the squared error of the blend are fitted on the cached predictions
+      (a least squares problem with one column per model, milliseconds) and saved in {model path}_blend.json,
+      with the version of the base models they were fitted for: load_blend_weights picks them up until the models are saved again
+    - add: a new base model (its params and the wtc of its rows) is added without retraining the existing ones:
+      only its out-of-fold predictions are computed, it is trained on the whole challenge set, saved after the
+      other models, and the blend is fitted again
+
+Usage:
+    python -m models.stacking oof --folds 5
+    python -m models.stacking blend
+    python -m models.stacking add basic_shallow --wtc all --params shallow_params.json
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from scipy.optimize import nnls
+
+from models.feature_matrix import FeatureMatrix
+from models.manifest import dataset_record, record_version
+from models.xgboost_agregation import train_model, load_model, save_model, load_params_set, params_set_path, model_route, set_route
+from models.xgboost_agregation import blend_path, blended_models_version, model_features
+from models.backends import backend_of
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+MODEL_PATH = "models/xgboost_agregation"
+TRAIN_PATH = "./data/challenge_set.csv"
+N_FOLDS = 5
+
+
+def oof_dir(path: str) -> str:
+    return f"{path}_oof"
+
+def assign_folds(n_rows: int, n_folds: int, seed: int = 42) -> np.ndarray:
+    '''
+    Fold of each row (int8), the folds have the same size (up to one row)
+    '''
+    return (np.random.default_rng(seed).permutation(n_rows) % n_folds).astype(np.int8)
+
+
+class OofCache:
+    '''
+    Out-of-fold predictions of the base models on the challenge set, in directory:
+        flight_id.npy, folds.npy, target.npy: the rows, their fold and their tow
+        {model name}.npy: float32 out-of-fold predictions of the model (NaN on the rows of other wtc)
+        meta.json: number of folds, version of the preprocessing state (preprocessing_version), and the params and wtc
+        of each cached model
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.meta = {'n_folds': None, 'preprocessing': None, 'models': {}}
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json')) as f:
+                self.meta = json.load(f)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _save_meta(self) -> None:
+        with open(self._path('meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=4)
+
+    def is_valid_for(self, flight_ids: np.ndarray, n_folds: int, preprocessing: str) -> bool:
+        '''
+        Whether the cache holds the same rows (in the same order), the same number of folds,
+        and predictions on the features of the same preprocessing state
+        '''
+        if self.meta['n_folds'] != n_folds or self.meta.get('preprocessing') != preprocessing:
+            return False
+        if not os.path.exists(self._path('flight_id.npy')):
+            return False
+        return np.array_equal(np.load(self._path('flight_id.npy'), mmap_mode='r'), flight_ids)
+
+    def reset(self, flight_ids: np.ndarray, target: np.ndarray, n_folds: int, preprocessing: str) -> None:
+        '''
+        Starts a new cache on these rows: draws the folds and removes the predictions of previous rows
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        for name in self.meta['models']:
+            if os.path.exists(self._path(f"{name}.npy")):
+                os.remove(self._path(f"{name}.npy"))
+        np.save(self._path('flight_id.npy'), flight_ids)
+        np.save(self._path('target.npy'), target.astype(np.float32))
+        np.save(self._path('folds.npy'), assign_folds(len(flight_ids), n_folds))
+        self.meta = {'n_folds': n_folds, 'preprocessing': preprocessing, 'models': {}}
+        self._save_meta()
+
+    def folds(self) -> np.ndarray:
+        return np.load(self._path('folds.npy'))
+
+    def target(self) -> np.ndarray:
+        return np.load(self._path('target.npy'), mmap_mode='r')
+
+    def has(self, name: str, params: dict, wtc) -> bool:
+        return self.meta['models'].get(name) == {'params': params, 'wtc': wtc}
+
+    def predictions(self, name: str) -> np.ndarray:
+        return np.load(self._path(f"{name}.npy"), mmap_mode='r')
+
+    def save_predictions(self, name: str, predictions: np.ndarray, params: dict, wtc) -> None:
+        np.save(self._path(f"{name}.npy"), predictions.astype(np.float32))
+        self.meta['models'][name] = {'params': params, 'wtc': wtc}
+        self._save_meta()
+
+
+def preprocessing_version(path: str = MODEL_PATH) -> str:
+    '''
+    sha256 of the saved preprocessing state of the models of path (the features the out-of-fold predictions are computed on)
+    '''
+    state = PreprocessingPipeline.load(path).state_dict()
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+def training_frame(path: str = MODEL_PATH, train_path: str = TRAIN_PATH):
+    '''
+    Challenge set preprocessed with the saved preprocessing state of the models (the codes of the values are the ones
+    the models were trained on, even after PreprocessingPipeline.partial_fit updated the state)
+    '''
+    pipeline = PreprocessingPipeline.load(path)
+    train_df = load_flights(train_path)
+    record = dataset_record(train_df, train_path)
+    return pipeline.transform(train_df), record
+
+def oof_predictions(matrix: FeatureMatrix, folds: np.ndarray, wtc, params: dict) -> np.ndarray:
+    '''
+    Out-of-fold predictions of a base model (trained on the rows of wtc, all of them if None) in the row order of the
+    frame of matrix, folds being the fold of each of these rows. The rows of other wtc are NaN.
+    '''
+    block = matrix.block(wtc)
+    X, y = matrix.subset(wtc)
+    block_folds = folds[matrix.order][block]
+
+    y_sorted = np.full(len(matrix.values), np.nan, dtype=np.float32)
+    for fold in np.unique(block_folds):
+        held_out = block_folds == fold
+        model = train_model(X[~held_out], y[~held_out], params, feature_names=matrix.columns, feature_types=matrix.feature_types)
+        y_sorted[block.start:block.stop][held_out] = model.get_booster().inplace_predict(X[held_out])
+    return matrix.restore_order(y_sorted)
+
+def compute_oof(data, model_list: list, params_set: dict, cache: OofCache, preprocessing: str, n_folds: int = N_FOLDS, refresh: bool = False) -> list:
+    '''
+    Caches the out-of-fold predictions of the base models of model_list missing from the cache
+    (or trained with other params), returns the names of the models computed.
+    data is preprocessed with the state of version preprocessing, the cache is started again if it was computed with another one
+    '''
+    flight_ids = data.index.to_numpy()
+    if not cache.is_valid_for(flight_ids, n_folds, preprocessing):
+        cache.reset(flight_ids, data['tow'].to_numpy(), n_folds, preprocessing)
+
+    matrix = FeatureMatrix.from_frame(data, model_features(model_list[0]))
+    folds = cache.folds()
+    computed = []
+    for i, model in enumerate(model_list):
+        name, wtc = model_route(model, i)
+        if backend_of(model).name != 'xgboost':
+            raise ValueError(f"Model {name} is a {backend_of(model).name} model, the out-of-fold predictions are only computed for the XGBoost models")
+        params = params_set[f"params_{name}"]
+        if cache.has(name, params, wtc) and not refresh:
+            continue
+        start = time.perf_counter()
+        cache.save_predictions(name, oof_predictions(matrix, folds, wtc, params), params, wtc)
+        print(f"Out-of-fold predictions of model {name} computed in {time.perf_counter() - start:.1f}s ({n_folds} folds)")
+        computed.append(name)
+    return computed
+
+def fit_blend_weights(predictions: np.ndarray, target: np.ndarray) -> np.ndarray:
+    '''
+    Non-negative weights of the columns of predictions (rows x models, NaN where a model does not predict)
+    minimizing the squared error of their weighted sum to target
+    '''
+    predictions = np.nan_to_num(np.asarray(predictions, dtype=np.float64))
+    weights, _ = nnls(predictions, np.asarray(target, dtype=np.float64))
+    return weights
+
+def blend(model_list: list, cache: OofCache, path: str = MODEL_PATH) -> dict:
+    '''
+    Fits the blend weights of the base models of model_list on their cached out-of-fold predictions,
+    saves them in {path}_blend.json and returns the blend (weights, out-of-fold rmse of each model and of the blend)
+    '''
+    names = [model_route(model, i)[0] for i, model in enumerate(model_list)]
+    missing = [name for name in names if name not in cache.meta['models']]
+    if missing:
+        raise Exception(f"No out-of-fold predictions for the models {missing}, run python -m models.stacking oof first")
+    if cache.meta.get('preprocessing') != preprocessing_version(path):
+        raise Exception("The out-of-fold predictions were computed with another preprocessing state, run python -m models.stacking oof first")
+
+    start = time.perf_counter()
+    target = np.asarray(cache.target(), dtype=np.float64)
+    predictions = np.column_stack([cache.predictions(name) for name in names])
+    weights = fit_blend_weights(predictions, target)
+    duration = time.perf_counter() - start
+
+    oof_rmse = {}
+    for name, column in zip(names, predictions.T):
+        rows = ~np.isnan(column)
+        oof_rmse[name] = float(np.sqrt(np.mean((column[rows] - target[rows])**2)))
+    blended = np.nan_to_num(predictions.astype(np.float64)) @ weights
+
+    blend = {'models': names,
+             'weights': weights.tolist(),
+             'model_version': blended_models_version(path),
+             'n_folds': cache.meta['n_folds'],
+             'oof_rmse': oof_rmse,
+             'blend_oof_rmse': float(np.sqrt(np.mean((blended - target)**2)))}
+    with open(blend_path(path), 'w') as f:
+        json.dump(blend, f, indent=4)
+
+    print("-"*100)
+    print(f"Blend weights fitted in {duration*1000:.0f}ms on {len(target)} out-of-fold predictions")
+    for name, weight in zip(names, weights):
+        print(f"    {name:<20} weight {weight:.4f}   out-of-fold rmse {oof_rmse[name]:.1f}")
+    print(f"Blend out-of-fold rmse {blend['blend_oof_rmse']:.1f}")
+    print("-"*100)
+    return blend
+
+def add_base_model(data, model_list: list, name: str, wtc, params: dict, cache: OofCache, preprocessing: str, n_folds: int = N_FOLDS):
+    '''
+    New base model trained on the rows of wtc with params: its out-of-fold predictions are cached,
+    and it is trained on all these rows. The existing models are not retrained.
+    '''
+    if name in [model_route(model, i)[0] for i, model in enumerate(model_list)]:
+        raise Exception(f"There is already a base model named {name}")
+
+    flight_ids = data.index.to_numpy()
+    if not cache.is_valid_for(flight_ids, n_folds, preprocessing):
+        raise Exception("The out-of-fold predictions of the existing models are missing or stale, run python -m models.stacking oof first")
+
+    matrix = FeatureMatrix.from_frame(data, model_features(model_list[0]))
+    start = time.perf_counter()
+    cache.save_predictions(name, oof_predictions(matrix, cache.folds(), wtc, params), params, wtc)
+    X, y = matrix.subset(wtc)
+    model = train_model(X, y, params, feature_names=matrix.columns, feature_types=matrix.feature_types)
+    set_route(model, name, wtc)
+    print(f"Model {name} trained in {time.perf_counter() - start:.1f}s (out-of-fold predictions included)")
+    return model
+
+def save_params(path: str, name: str, params: dict) -> None:
+    '''
+    Adds the params of a base model to {path}_params.json, where load_params_set reads them
+    '''
+    exported = {}
+    if os.path.exists(params_set_path(path)):
+        with open(params_set_path(path)) as f:
+            exported = json.load(f)
+    exported[f"params_{name}"] = params
+    with open(params_set_path(path), 'w') as f:
+        json.dump(exported, f, indent=4)
+
+def parse_wtc(value: str):
+    return None if value == 'all' else int(value)
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Out-of-fold predictions and blend weights of the base models")
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--train-path", default=TRAIN_PATH)
+    parser.add_argument("--folds", type=int, default=N_FOLDS)
+    commands = parser.add_subparsers(dest="command", required=True)
+    oof_parser = commands.add_parser("oof", help="cache the out-of-fold predictions of the saved base models, then fit the blend")
+    oof_parser.add_argument("--refresh", action="store_true", help="compute them again even if they are cached")
+    commands.add_parser("blend", help="fit the blend weights on the cached out-of-fold predictions")
+    add_parser = commands.add_parser("add", help="add a base model, without retraining the existing ones")
+    add_parser.add_argument("name")
+    add_parser.add_argument("--wtc", type=parse_wtc, default=None, help="wtc code of the rows of the model (default: all)")
+    add_parser.add_argument("--params", default=None, help="json file of the XGBoost params of the model (default: the basic model ones)")
+    args = parser.parse_args(argv)
+
+    model_list = load_model(args.model_path)
+    cache = OofCache(oof_dir(args.model_path))
+    if args.command == "blend":
+        blend(model_list, cache, args.model_path)
+        return
+
+    train_df, record = training_frame(args.model_path, args.train_path)
+    params_set = load_params_set(args.model_path)
+    preprocessing = preprocessing_version(args.model_path)
+    if args.command == "oof":
+        compute_oof(train_df, model_list, params_set, cache, preprocessing, args.folds, args.refresh)
+    else:
+        params = params_set['params_basic']
+        if args.params is not None:
+            with open(args.params) as f:
+                params = json.load(f)
+        model = add_base_model(train_df, model_list, args.name, args.wtc, params, cache, preprocessing, args.folds)
+        model_list.append(model)
+        save_model(model_list, args.model_path)
+        save_params(args.model_path, args.name, params)
+        version = record_version(args.model_path, 'stacking', [record], model_list, added_model=args.name)
+        print(f"Model version {version['version']} saved to {args.model_path} with the base model {args.name}")
+
+    blend(model_list, cache, args.model_path)
+
+if __name__ == "__main__":
+    main()
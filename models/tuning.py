@@ -0,0 +1,223 @@
+'''
+Parallel, resumable hyperparameter search of the three models (params_basic, params_wtc0, params_wtc1)
+
+Scripted version of notebooks/tuning.ipynb:
+    - hyperopt TPE proposes a batch of trials at a time, evaluated in a process pool,
+      each trial training with n_jobs capped so that the workers do not oversubscribe the cores
+    - every finished trial is written to a SQLite trial store, a search restarted with the same store resumes from it
+    - the best configuration of each model is exported to {model path}_params.json, read by train_models
+
+Usage:
+    python -m models.tuning --model wtc0 --trials 100 --export
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import hyperopt as hpt
+from hyperopt import base, tpe
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import root_mean_squared_error
+
+from models.xgboost_agregation import train_model, params_set_path
+from preprocessing.pipeline import PreprocessingPipeline
+from preprocessing.ingestion import load_flights
+
+SPACE = {'max_depth': hpt.hp.quniform('max_depth', 2, 10, 1),
+         'gamma': hpt.hp.uniform('gamma', 0.1, 5),
+         'reg_alpha': hpt.hp.uniform('reg_alpha', 0.1, 5),
+         'reg_lambda': hpt.hp.uniform('reg_lambda', 0.1, 5),
+         'learning_rate': hpt.hp.uniform('learning_rate', 0.01, 0.2),
+         'n_estimators': hpt.hp.quniform('n_estimators', 100, 1000, 1),
+         'min_child_weight': hpt.hp.quniform('min_child_weight', 1, 10, 1),
+         'subsample': hpt.hp.uniform('subsample', 0.5, 1),
+         'colsample_bytree': hpt.hp.uniform('colsample_bytree', 0.5, 1)}
+
+# rows each model is trained on
+MODEL_SUBSETS = {'basic': None, 'wtc0': 0, 'wtc1': 1}
+
+STORE_PATH = "models/tuning_trials.sqlite"
+
+
+############################## TRIAL STORE ##############################
+
+def open_store(path: str = STORE_PATH) -> sqlite3.Connection:
+    store = sqlite3.connect(path)
+    store.execute('''CREATE TABLE IF NOT EXISTS trials (
+                        model TEXT NOT NULL,
+                        tid INTEGER NOT NULL,
+                        params TEXT NOT NULL,
+                        loss REAL,
+                        status TEXT NOT NULL,
+                        duration REAL,
+                        PRIMARY KEY (model, tid))''')
+    store.commit()
+    return store
+
+def stored_trials(store: sqlite3.Connection, model: str) -> list:
+    rows = store.execute('SELECT tid, params, loss, status FROM trials WHERE model = ? ORDER BY tid', (model,)).fetchall()
+    return [(tid, json.loads(params), loss, status) for tid, params, loss, status in rows]
+
+def record_trial(store: sqlite3.Connection, model: str, tid: int, params: dict, loss: float, status: str, duration: float) -> None:
+    # a numpy scalar would be stored as a BLOB
+    loss = None if loss is None else float(loss)
+    store.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?)', (model, tid, json.dumps(params), loss, status, float(duration)))
+    store.commit()
+
+def best_params(store: sqlite3.Connection, model: str) -> dict:
+    row = store.execute("SELECT params, loss FROM trials WHERE model = ? AND status = 'ok' ORDER BY loss LIMIT 1", (model,)).fetchone()
+    if row is None:
+        raise ValueError(f"No successful trial for model {model} in the trial store")
+    return json.loads(row[0])
+
+def export_best_params(store: sqlite3.Connection, path: str, models: list = None) -> dict:
+    '''
+    Writes the best params of each tuned model in {path}_params.json (merged with the ones already exported),
+    where load_params_set picks them up for train_models
+    '''
+    exported = {}
+    if os.path.exists(params_set_path(path)):
+        with open(params_set_path(path)) as f:
+            exported = json.load(f)
+
+    for model in (models or MODEL_SUBSETS):
+        exported[f'params_{model}'] = best_params(store, model)
+
+    with open(params_set_path(path), 'w') as f:
+        json.dump(exported, f, indent=4)
+    return exported
+
+
+############################## HYPEROPT ##############################
+
+def _trials_from_store(domain: base.Domain, rows: list) -> hpt.Trials:
+    '''
+    Rebuilds the hyperopt Trials of a search from the stored trials, so that TPE resumes from them
+    '''
+    trials = hpt.Trials()
+    for tid, vals, loss, status in rows:
+        result = {'loss': loss, 'status': hpt.STATUS_OK} if status == 'ok' else {'status': hpt.STATUS_FAIL}
+        misc = {'tid': tid, 'cmd': domain.cmd, 'workdir': domain.workdir,
+                'idxs': {key: [tid] for key in vals}, 'vals': {key: [value] for key, value in vals.items()}}
+        docs = trials.new_trial_docs([tid], [None], [result], [misc])
+        docs[0]['state'] = hpt.JOB_STATE_DONE
+        trials.insert_trial_docs(docs)
+    trials.refresh()
+    return trials
+
+def suggest(domain: base.Domain, trials: hpt.Trials, n: int, seed: int) -> list:
+    '''
+    Asks TPE for n new trials, returns their (tid, vals)
+
+    TPE proposes one trial per call: each proposal is inserted as a pending trial (counted with an infinite loss)
+    before asking the next one, as hyperopt does for asynchronous searches.
+    '''
+    batch = []
+    for i, tid in enumerate(trials.new_trial_ids(n)):
+        docs = tpe.suggest([tid], domain, trials, seed + i)
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+        batch += [(doc['tid'], {key: float(values[0]) for key, values in doc['misc']['vals'].items()}) for doc in docs]
+    return batch
+
+
+############################## WORKERS ##############################
+
+_data = None
+
+def _init_worker(data: tuple, n_threads: int) -> None:
+    global _data
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    _data = data
+
+def _evaluate(vals: dict, n_threads: int):
+    '''
+    Trains and scores one trial: (loss, status, duration, error), error being the type and message of the exception
+    of a failed trial (None for the successful ones)
+    '''
+    X_train, X_val, y_train, y_val = _data
+    start = time.perf_counter()
+    error = None
+    try:
+        model = train_model(X_train, y_train, vals, n_jobs=n_threads)
+        loss = float(root_mean_squared_error(y_val, model.predict(X_val)))
+        status = 'ok'
+    except Exception as e:
+        loss, status, error = None, 'fail', f"{type(e).__name__}: {e}"
+    return loss, status, time.perf_counter() - start, error
+
+def split_for_model(train_df: pd.DataFrame, model: str, test_size: float = 0.2, random_state: int = 42) -> tuple:
+    '''
+    Train/validation split of the rows the model is trained on (all rows, wtc == 0 or wtc == 1)
+    '''
+    subset = MODEL_SUBSETS[model]
+    data = train_df if subset is None else train_df[train_df['wtc'] == subset]
+    X = data.drop(columns=['tow'])
+    y = data['tow']
+    return train_test_split(X, y, test_size=test_size, random_state=random_state)
+
+def tune(train_df: pd.DataFrame, model: str, n_trials: int, store_path: str = STORE_PATH, n_workers: int = None, seed: int = 0) -> dict:
+    '''
+    Runs (or resumes) the search of model until the store holds n_trials trials for it, returns the best params
+    '''
+    n_workers = n_workers or os.cpu_count() or 1
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+    store = open_store(store_path)
+    domain = base.Domain(lambda params: 0, SPACE)
+    trials = _trials_from_store(domain, stored_trials(store, model))
+    if len(trials.trials):
+        print(f"Resuming the search of model {model} from {len(trials.trials)} stored trials")
+
+    data = split_for_model(train_df, model)
+
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(data, n_threads)) as executor:
+        while len(trials.trials) < n_trials:
+            batch = suggest(domain, trials, min(n_workers, n_trials - len(trials.trials)), seed + len(trials.trials))
+            results = executor.map(_evaluate, [vals for _, vals in batch], [n_threads] * len(batch))
+
+            for (tid, vals), (loss, status, duration, error) in zip(batch, results):
+                record_trial(store, model, tid, vals, loss, status, duration)
+                if error is not None:
+                    print(f"model {model} trial {tid} failed: {error} ({duration:.1f}s)")
+                else:
+                    print(f"model {model} trial {tid}: rmse {loss} ({duration:.1f}s)")
+
+            trials = _trials_from_store(domain, stored_trials(store, model))
+
+    best = best_params(store, model)
+    store.close()
+    return best
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Parallel, resumable hyperopt search of the TOW models")
+    parser.add_argument("--model", choices=list(MODEL_SUBSETS) + ['all'], default='all')
+    parser.add_argument("--trials", type=int, default=100, help="total number of trials per model (stored ones included)")
+    parser.add_argument("--workers", type=int, default=None, help="number of trial processes (default: all cores)")
+    parser.add_argument("--store", default=STORE_PATH, help="SQLite trial store")
+    parser.add_argument("--train", default="data/challenge_set.csv")
+    parser.add_argument("--export", action="store_true", help="export the best params to {model path}_params.json")
+    parser.add_argument("--model-path", default="models/xgboost_agregation")
+    args = parser.parse_args(argv)
+
+    train_df = PreprocessingPipeline().fit_transform(load_flights(args.train))
+
+    models = list(MODEL_SUBSETS) if args.model == 'all' else [args.model]
+    for model in models:
+        best = tune(train_df, model, args.trials, args.store, args.workers)
+        print(f"Best params of model {model}: {best}")
+
+    if args.export:
+        store = open_store(args.store)
+        export_best_params(store, args.model_path, models)
+        store.close()
+        print(f"Best params exported to {params_set_path(args.model_path)}")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
 # import usefull libraries
+import argparse
+import json
+import os
+import time
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import root_mean_squared_error
-from xgboost import XGBRegressor
-from preprocessing.country_and_airports_codes import compute_lon_lat,group_and_rename_countries, group_and_rename_airports, group_and_rename_aircraft_types
-from preprocessing.encoding import one_hot_encoding,string_to_value_count, string_to_int_hashing
-from preprocessing.local_time import add_localtime_to_train_and_test
+from preprocessing.pipeline import PreprocessingPipeline, ENCODINGS
+from preprocessing.ingestion import load_flights
+from preprocessing.parallel import ShardExecutor
+from models.feature_matrix import FeatureMatrix
+from models.manifest import dataset_record, record_version
+from models.backends import BACKENDS, get_backend, backend_of, model_file, saved_backend
+from models.prediction_cache import model_version
+from preprocessing.profiling import initialization
+
+# xgboost, lightgbm and sklearn are imported on first use (training, loading the models), so that importing this module is cheap
 
 # Load the data
 def load_data(path: str) -> pd.DataFrame:
@@ -23,114 +31,220 @@ def load_data(path: str) -> pd.DataFrame:
 
 # train the model
 
-def train_model(X:pd.DataFrame, y:pd.DataFrame, params: dict) -> XGBRegressor:
-
-    model = XGBRegressor(colsample_bytree=params['colsample_bytree'],
-                        gamma=params['gamma'],
-                        learning_rate=params['learning_rate'],
-                        max_depth=int(params['max_depth']),
-                        min_child_weight=int(params['min_child_weight']),
-                        n_estimators=int(params['n_estimators']),
-                        reg_alpha=params['reg_alpha'],
-                        reg_lambda=params['reg_lambda'],
-                        subsample=params['subsample'],
-                        seed=42,
-                        objective="reg:squarederror",
-                        #early_stopping_rounds=10,
-                        eval_metric="rmse",
-                        n_jobs=-1)
-    
-    model.fit(X, y)
-
-    return model
-
-def train_models(data: pd.DataFrame) -> XGBRegressor:
-    X = data.drop(columns=['tow'])
-    y = data['tow']
-
-    params_set = {
-        "params_wtc0": {
-                        'colsample_bytree': 0.8497066984064998,
-                        'gamma': 1.8567356656935454,
-                        'learning_rate': 0.041891010160377044,
-                        'max_depth': 9.0,
-                        'min_child_weight': 8.0,
-                        'n_estimators': 859.0,
-                        'reg_alpha': 3.709715865940738,
-                        'reg_lambda': 1.6089032820385571,
-                        'subsample': 0.8005286414941816},
-
-        "params_wtc1": {
-                        'colsample_bytree': 0.9865346417369687,
-                        'gamma': 2.311730004603916,
-                        'learning_rate': 0.1355408626893648,
-                        'max_depth': 9.0,
-                        'min_child_weight': 2.0,
-                        'n_estimators': 890.0,
-                        'reg_alpha': 2.7683944404030436,
-                        'reg_lambda': 0.10259397496527922,
-                        'subsample': 0.6971029355383804
-                        },
-
-        "params_basic":{
-                        'colsample_bytree': 0.9362150768343058,
-                        'gamma': 2.022211195429398,
-                        'learning_rate': 0.07900609044575752,
-                        'max_depth': 10.0,
-                        'min_child_weight': 1.0,
-                        'n_estimators': 862.0,
-                        'reg_alpha': 1.6659492680583492,
-                        'reg_lambda': 4.4589665080717085,
-                        'subsample': 0.7470405034939882,
-                        
-                        }
-    }    
-
-
-    
-    model = train_model(X,y, params_set['params_basic'])
-
-
-    X_wtc0 = data[data['wtc'] == 0].drop(columns=['tow'])
-    y_wtc0 = data[data['wtc'] == 0]['tow']
-
-    model_wtc0 = train_model(X_wtc0,y_wtc0, params_set['params_wtc0'])
-    
-
-    X_wtc1 = data[data['wtc'] == 1].drop(columns=['tow'])
-    y_wtc1 = data[data['wtc'] == 1]['tow']
-
-    model_wtc1 = train_model(X_wtc1,y_wtc1, params_set['params_wtc1'])
-    model_wtc1.fit(X, y)
+def train_model(X:pd.DataFrame, y:pd.DataFrame, params: dict, n_jobs: int = -1, eval_set: list = None, early_stopping_rounds: int = None, feature_names: list = None, xgb_model=None, feature_types: list = None) -> 'XGBRegressor':
+    '''
+    Trains an XGBRegressor with params (see XGBoostBackend.fit in models/backends.py).
+    With xgb_model (a booster), n_estimators trees are added to it instead of training from scratch.
+    '''
+    return get_backend('xgboost').fit(X, y, params, eval_set=eval_set, early_stopping_rounds=early_stopping_rounds,
+                                      feature_names=feature_names, feature_types=feature_types, n_jobs=n_jobs, xgb_model=xgb_model)
+
+# hyperparameters found with hyperopt (see notebooks/tuning.ipynb and models/tuning.py)
+DEFAULT_PARAMS_SET = {
+    "params_wtc0": {
+                    'colsample_bytree': 0.8497066984064998,
+                    'gamma': 1.8567356656935454,
+                    'learning_rate': 0.041891010160377044,
+                    'max_depth': 9.0,
+                    'min_child_weight': 8.0,
+                    'n_estimators': 859.0,
+                    'reg_alpha': 3.709715865940738,
+                    'reg_lambda': 1.6089032820385571,
+                    'subsample': 0.8005286414941816},
+
+    "params_wtc1": {
+                    'colsample_bytree': 0.9865346417369687,
+                    'gamma': 2.311730004603916,
+                    'learning_rate': 0.1355408626893648,
+                    'max_depth': 9.0,
+                    'min_child_weight': 2.0,
+                    'n_estimators': 890.0,
+                    'reg_alpha': 2.7683944404030436,
+                    'reg_lambda': 0.10259397496527922,
+                    'subsample': 0.6971029355383804
+                    },
+
+    "params_basic":{
+                    'colsample_bytree': 0.9362150768343058,
+                    'gamma': 2.022211195429398,
+                    'learning_rate': 0.07900609044575752,
+                    'max_depth': 10.0,
+                    'min_child_weight': 1.0,
+                    'n_estimators': 862.0,
+                    'reg_alpha': 1.6659492680583492,
+                    'reg_lambda': 4.4589665080717085,
+                    'subsample': 0.7470405034939882,
+                    
+                    }
+}
+
+# LightGBM parameters of notebooks/testlighGBM.ipynb (n_estimators: maximum number of boosting rounds)
+LIGHTGBM_PARAMS = {'boosting_type': 'goss',
+                   'num_leaves': 31,
+                   'learning_rate': 0.12389641912229452,
+                   'feature_fraction': 0.9,
+                   'n_estimators': 2000}
+
+DEFAULT_PARAMS_SETS = {'xgboost': DEFAULT_PARAMS_SET,
+                       'lightgbm': {"params_wtc0": LIGHTGBM_PARAMS, "params_wtc1": LIGHTGBM_PARAMS, "params_basic": LIGHTGBM_PARAMS}}
+
+def params_set_path(path: str, backend: str = 'xgboost') -> str:
+    return f"{path}_params.json" if backend == 'xgboost' else f"{path}_{backend}_params.json"
+
+def load_params_set(path: str, backend: str = 'xgboost') -> dict:
+    '''
+    Hyperparameters of the base models: the ones exported by the tuning (models/tuning.py) or by models/stacking.py
+    in {path}_params.json if it exists, DEFAULT_PARAMS_SET otherwise (or for the models missing from the file).
+    The parameters of the other backends are in {path}_{backend}_params.json (default: DEFAULT_PARAMS_SETS[backend])
+    '''
+    params_set = {name: dict(params) for name, params in DEFAULT_PARAMS_SETS[backend].items()}
+    if os.path.exists(params_set_path(path, backend)):
+        with open(params_set_path(path, backend)) as f:
+            params_set.update(json.load(f))
+    return params_set
+
+# base models of the blend: (name, wtc of the rows it is trained on and predicts, None for all the rows)
+# the params of each model are params_{name} in the params set, more base models can be added (and blended) with models/stacking.py
+BASE_MODELS = [("wtc0", 0),
+               ("wtc1", 1),
+               ("basic", None)]
+
+def set_route(model, name: str, wtc) -> None:
+    '''
+    Records the name and the wtc of the rows of a base model in it (saved with the model)
+    '''
+    backend_of(model).set_route(model, name, wtc)
+
+def model_route(model, i: int) -> tuple:
+    '''
+    (name, wtc) of the i-th base model, the position in BASE_MODELS for models saved without them
+    '''
+    route = backend_of(model).route(model)
+    return BASE_MODELS[i] if route is None else route
+
+def train_models(data: pd.DataFrame, params_set: dict = None, early_stopping_rounds: int = None, validation_fraction: float = 0.2, backend: str = 'xgboost') -> list:
+    '''
+    Trains the three models of BASE_MODELS: [model on wtc == 0, model on wtc == 1, model on all the data]
+    with the backend (see models/backends.py) and its params_set (default: DEFAULT_PARAMS_SETS[backend])
+
+    With early_stopping_rounds, validation_fraction of the rows of each model are held out,
+    and each model stops adding trees when its validation rmse stops improving (the best iteration is recorded in the model).
+    The wall-clock training time of each model is reported.
+    '''
+    backend = get_backend(backend)
+    if params_set is None:
+        params_set = DEFAULT_PARAMS_SETS[backend.name]
+
+    # one float32 matrix, the subsets of each model are views of it
+    matrix = FeatureMatrix.from_frame(data, validation_fraction=validation_fraction if early_stopping_rounds else 0.0)
 
-    model_list = [model_wtc0,model_wtc1,model]
+    model_list = []
+    for name, wtc in BASE_MODELS:
+        params = params_set[f"params_{name}"]
+        X, y = matrix.subset(wtc)
+
+        eval_set = None
+        if early_stopping_rounds:
+            eval_set = [matrix.subset(wtc, validation=True)]
+
+        start = time.perf_counter()
+        model = backend.fit(X, y, params, eval_set=eval_set, early_stopping_rounds=early_stopping_rounds, feature_names=matrix.columns, feature_types=matrix.feature_types)
+        duration = time.perf_counter() - start
+
+        print("-"*100)
+        if early_stopping_rounds:
+            best_iteration, val_rmse = backend.validation_summary(model)
+            print(f"Model {name} ({backend.name}) trained in {duration:.1f}s: best iteration {best_iteration} / {int(params['n_estimators'])}, validation rmse {val_rmse:.1f}")
+        else:
+            print(f"Model {name} ({backend.name}) trained in {duration:.1f}s ({int(params['n_estimators'])} trees)")
+        print("-"*100)
+
+        set_route(model, name, wtc)
+        model_list.append(model)
 
     return model_list
 
 # predict the tow
 
-def predict_tow(data: pd.DataFrame, model_list: list) -> np.array:
-    try:
-        data = data.drop(columns=['Unnamed: 0'])
-    except:
-        pass
+BLEND_WEIGHTS = [0.4951629,0.5048371] # [wtc routed models, basic model]
+
+def blend_path(path: str) -> str:
+    return f"{path}_blend.json"
+
+def default_blend_weights(model_list: list) -> list:
+    '''
+    Weight of each base model without fitted blend weights: BLEND_WEIGHTS for the three models of train_models,
+    0 for the models added since (they are only used once blended, see models/stacking.py), 1 for a model alone
+    '''
+    if len(model_list) == 1:
+        return [1.0]
+    weights = []
+    for i, model in enumerate(model_list):
+        name, wtc = model_route(model, i)
+        if name not in [base_name for base_name, _ in BASE_MODELS]:
+            weights.append(0.0)
+        else:
+            weights.append(BLEND_WEIGHTS[0] if wtc is not None else BLEND_WEIGHTS[1])
+    return weights
+
+def blended_models_version(path: str) -> str:
+    '''
+    Version of the base models saved in path (see models/prediction_cache.py), recorded with the blend weights fitted for them
+    '''
+    return model_version(path, ('models',))
+
+def load_blend_weights(path: str, model_list: list) -> list:
+    '''
+    Blend weights fitted by models/stacking.py ({path}_blend.json) if they match the base models of model_list
+    and were fitted for the version of the saved models (not for the models saved before a new training),
+    default_blend_weights otherwise
+    '''
+    if os.path.exists(blend_path(path)):
+        with open(blend_path(path)) as f:
+            blend = json.load(f)
+        if blend['models'] != [model_route(model, i)[0] for i, model in enumerate(model_list)]:
+            print(f"The blend weights of {blend_path(path)} do not match the saved models, default weights used")
+        elif blend.get('model_version') != blended_models_version(path):
+            print(f"The blend weights of {blend_path(path)} were fitted for another version of the saved models, default weights used")
+        else:
+            return blend['weights']
+    return default_blend_weights(model_list)
+
+def model_features(model) -> list:
+    '''
+    Columns the model was trained with, in order (None if it was trained without feature names)
+    '''
+    return backend_of(model).features(model)
+
+def predict_tow(data: pd.DataFrame, model_list: list, weights: list = None) -> np.array:
+    '''
+    Blend of the base models: the sum of the predictions of each model (on the rows of its wtc) times its weight
+    (default_blend_weights if weights is None)
+    '''
     try:
         data[["local_departure_hour","local_arrival_hour","lon_adep"]]
     except:
         raise ValueError("The data is not in the right format (missing preprocessing)")
     
-    X = data.drop(columns=['tow'])
-
-    y_pred_wtc = model_list[0].predict(X)*(data['wtc']==0) + model_list[1].predict(X)*(data['wtc'] == 1)
+    # one float32 input buffer, shared by all the models (trained on the same columns), with the rows grouped by wtc
+    matrix = FeatureMatrix.from_frame(data, model_features(model_list[0]))
+    if weights is None:
+        weights = default_blend_weights(model_list)
 
-    w = [0.4951629,0.5048371]
+    # each wtc routed model only predicts the (contiguous) rows of its wtc,
+    # the weighted predictions are summed in float64 and the blend is rounded to float32 once
+    y_pred = np.zeros(len(matrix.values), dtype=np.float64)
+    for i, (model, weight) in enumerate(zip(model_list, weights)):
+        block = matrix.block(model_route(model, i)[1])
+        if weight and block.stop > block.start:
+            y_pred[block] += weight*backend_of(model).predict(model, matrix.values[block]).astype(np.float64)
 
-    y_pred = w[0]*y_pred_wtc + w[1]*model_list[2].predict(X) 
-
-    return y_pred
+    return matrix.restore_order(y_pred.astype(np.float32))
 
 # evaluate the model
 def evaluate_model(data: pd.DataFrame, model_list: list) -> float:
+    from sklearn.metrics import root_mean_squared_error
+
     y = data['tow']
     y_pred = predict_tow(data, model_list)
     rmse = root_mean_squared_error(y, y_pred)
@@ -138,56 +252,76 @@ def evaluate_model(data: pd.DataFrame, model_list: list) -> float:
     return rmse, rel_error
 
 # save the model
+def remove_saved_model(path: str, i: int) -> None:
+    for backend in BACKENDS.values():
+        if os.path.exists(model_file(path, i, backend)):
+            os.remove(model_file(path, i, backend))
+
 def save_model(model_list: list, path: str) -> None:
-    for i in range(3):
-        model_list[i].save_model(f"{path}_model_{i}.json")
+    '''
+    Saves the base models in {path}_model_{i}.json ({path}_model_{i}.{extension} for the other backends than XGBoost),
+    the files of the models of a previous, longer, list are removed
+    '''
+    for i, model in enumerate(model_list):
+        backend = backend_of(model)
+        remove_saved_model(path, i)
+        backend.save(model, model_file(path, i, backend))
+    i = len(model_list)
+    while saved_backend(path, i) is not None:
+        remove_saved_model(path, i)
+        i += 1
 
 # load the model
 def load_model(path: str) -> list:
+    '''
+    Loads the base models saved by save_model, each with its backend
+    (the three models of train_models, the ones added by models/stacking.py, or a single distilled student)
+    '''
     model_list = []
-    for i in range(3):
-        model = XGBRegressor()
-        model.load_model(f"{path}_model_{i}.json")
-        model_list.append(model)
+    with initialization('load_models'):
+        while saved_backend(path, len(model_list)) is not None:
+            backend = saved_backend(path, len(model_list))
+            model_list.append(backend.load(model_file(path, len(model_list), backend)))
+    if not model_list:
+        raise FileNotFoundError(f"No saved model {path}_model_0.json")
     return model_list
 
 # main function
 
-def main():
-    train_df = pd.read_csv('./data/challenge_set.csv',index_col=0)
-    test_df = pd.read_csv('./data/submission_set.csv',index_col=0)
-
-    # preprocessing
-    add_localtime_to_train_and_test(train_df, test_df)
-    compute_lon_lat(train_df, test_df)
-    group_and_rename_countries(train_df, test_df)
-    group_and_rename_airports(train_df, test_df)
-    group_and_rename_aircraft_types(train_df, test_df)
-    
-    # encoding the data
-    columns_to_ohe = [] # A changer
-    one_hot_encoding(train_df, test_df, columns_to_ohe)
-
-    columns_to_hash = ['callsign','country_code_ades', 'country_code_adep', 'adep', 'ades', 'airline','aircraft_type','wtc'] # A changer
-    string_to_int_hashing(train_df, test_df, columns_to_hash)
-
-    columns_to_vc = [] # A changer
-    string_to_value_count(train_df, test_df, columns_to_vc)
-
-    # drop unusefull column:
-    to_drop = ['date','name_adep','name_ades','name_adep','actual_offblock_time','arrival_time','local_departure_time','local_arrival_time']
-    train_df = train_df.drop(columns= to_drop)
-    test_df = test_df.drop(columns= to_drop)
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Train the TOW models and predict the submission set")
+    parser.add_argument("--early-stopping-rounds", type=int, default=None, help="hold out a validation split and stop each model when its rmse has not improved for this number of trees")
+    parser.add_argument("--validation-fraction", type=float, default=0.2)
+    parser.add_argument("--encoding", choices=ENCODINGS, default='hashing', help="categorical: native categorical support of XGBoost instead of int hashing")
+    parser.add_argument("--stats-columns", nargs='*', default=None, help="add the (out-of-fold) frequency of the values of these columns")
+    parser.add_argument("--workers", type=int, default=1, help="processes computing the per-row preprocessing stages (local times) by shards of rows")
+    parser.add_argument("--target-stats", action="store_true", help="also add the (out-of-fold) mean tow of the values of --stats-columns")
+    parser.add_argument("--backend", choices=list(BACKENDS), default='xgboost', help="library the base models are trained with (see models/backends.py)")
+    args = parser.parse_args(argv)
+
+    train_df = load_flights('./data/challenge_set.csv')
+    test_df = load_flights('./data/submission_set.csv')
+    train_record = dataset_record(train_df, './data/challenge_set.csv')
+
+    # preprocessing and encoding (fitted on the training set only)
+    pipeline = PreprocessingPipeline(encoding=args.encoding, stats_columns=args.stats_columns, target_stats=args.target_stats)
+    with ShardExecutor(args.workers) as executor:
+        pipeline.executor = executor if args.workers > 1 else None
+        train_df = pipeline.fit_transform(train_df)
+        test_df = pipeline.transform(test_df)
+    pipeline.executor = None
 
     # train the model
-    model_list = train_models(train_df)
+    model_list = train_models(train_df, load_params_set("models/xgboost_agregation", args.backend), args.early_stopping_rounds, args.validation_fraction, args.backend)
 
-    # save the model
+    # save the model, and the preprocessing state next to it
     save_model(model_list, "models/xgboost_agregation")
+    pipeline.save("models/xgboost_agregation")
+    record_version("models/xgboost_agregation", 'full', [train_record], model_list)
 
 
     # predict the tow
-    y_pred = predict_tow(test_df, model_list)
+    y_pred = predict_tow(test_df, model_list, load_blend_weights("models/xgboost_agregation", model_list))
 
     # save the prediction
 
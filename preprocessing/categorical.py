@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+# string code columns of the challenge data, kept as pandas categoricals from loading to string_to_int_hashing
+CODE_COLUMNS = ['callsign', 'adep', 'ades', 'country_code_adep', 'country_code_ades', 'aircraft_type', 'wtc', 'airline']
+
+
+def to_categorical(series: pd.Series) -> pd.Series:
+    '''
+    Converts series to the category dtype, with sorted categories (like astype('category') on an object series)
+    so that groupby orders do not depend on where the categorical comes from (csv, Parquet dictionaries...)
+    '''
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if series.cat.categories.is_monotonic_increasing:
+            return series
+        return series.cat.reorder_categories(series.cat.categories.sort_values())
+    return series.astype('category')
+
+def categorize_codes(d_frame: pd.DataFrame, columns: list = None) -> pd.DataFrame:
+    '''
+    Converts, once, the code columns of d_frame to the category dtype (sorted categories)
+    '''
+    for column in (columns or CODE_COLUMNS):
+        if column in d_frame.columns:
+            d_frame[column] = to_categorical(d_frame[column])
+    return d_frame
+
+def remap_categorical(series: pd.Series, mapping: dict) -> pd.Series:
+    '''
+    Categorical equivalent of series.replace(mapping)
+
+    Only the categories array is remapped (O(unique) dict lookups), categories mapped to the same value are merged,
+    and the rows are updated with a single take on the integer codes.
+    The new categories are sorted, like the ones of an object series converted with astype('category'),
+    so that groupby orders (and hence the KMeans groupings) are unchanged.
+    Values not in mapping are unchanged. The result is categorical.
+    '''
+    series = to_categorical(series)
+    categories = series.cat.categories
+
+    remapped = pd.Index([mapping.get(category, category) for category in categories], dtype=object)
+    category_codes, new_categories = pd.factorize(remapped, sort=True)
+
+    codes = series.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, category_codes[codes], -1)
+
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories), index=series.index, name=series.name)
+
+def observed_categories(series: pd.Series) -> pd.Index:
+    '''
+    Sorted distinct (non null) values of series, the same as series.astype('category').cat.categories for an object series
+    '''
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        return series.cat.categories[np.unique(codes[codes >= 0])].sort_values()
+    return series.astype('category').cat.categories
@@ -1,7 +1,161 @@
-import airportsdata
+import json
+import os
+
 import pandas as pd
-from sklearn.cluster import KMeans
 import numpy as np
+from functools import lru_cache
+from preprocessing.categorical import remap_categorical, observed_categories
+from preprocessing.profiling import timed_initialization
+
+# airportsdata and sklearn are imported on first use (see load_airports), importing this module does no I/O
+
+@lru_cache(maxsize=1)
+@timed_initialization('airportsdata.load')
+def load_airports() -> dict:
+    '''
+    The airportsdata database (by ICAO code), loaded once per process
+    '''
+    import airportsdata
+    return airportsdata.load()
+
+@lru_cache(maxsize=1)
+@timed_initialization('airport_coordinates_table')
+def airport_coordinates_table():
+    '''
+    Builds (once per process) the ICAO -> (lat, lon) lookup table of the airportsdata database
+
+    Returns:
+        icao: pd.Index of the ICAO codes (hash indexed, for fast batched lookups)
+        coords: float64 array of shape (n_airports, 2), row i holds (lat, lon) of icao[i]
+    '''
+    airports_dict = load_airports()
+    icao = pd.Index(list(airports_dict.keys()))
+    coords = np.array([(airport['lat'], airport['lon']) for airport in airports_dict.values()], dtype=np.float64)
+    return icao, coords
+
+@lru_cache(maxsize=1)
+@timed_initialization('country_coordinates_table')
+def country_coordinates_table() -> pd.DataFrame:
+    '''
+    Mean (lat, lon) of the airports of each country of the airportsdata database, indexed by country code
+    '''
+    airports_dict = load_airports()
+    airports = pd.DataFrame.from_dict(airports_dict, orient='index')
+    return airports.groupby('country')[['lat','lon']].mean()
+
+def airport_coordinates(codes) -> tuple:
+    '''
+    (lat, lon) of each airport code, and whether it was found in the airportsdata database (rows of the missing ones are arbitrary)
+    '''
+    icao, coords = airport_coordinates_table()
+    positions = icao.get_indexer(codes)
+    return coords[positions], positions >= 0
+
+def country_coordinates(codes) -> tuple:
+    '''
+    (lat, lon) of each country code, and whether it was found in the airportsdata database (rows of the missing ones are arbitrary)
+    '''
+    countries = country_coordinates_table()
+    positions = countries.index.get_indexer(codes)
+    return countries[['lat', 'lon']].to_numpy(dtype=np.float64)[positions], positions >= 0
+
+class GroupIndex:
+    '''
+    Spatial index of a fitted grouping: KD-tree over the (lat, lon) of the group centroids (TA0, SA3... or TC0, SC3...)
+    and of the codes kept ungrouped (big and medium airports or countries)
+
+    assign gives, in O(log n) per code, the group nearest to any position, so that codes unseen at fit time
+    are renamed to an existing group instead of being passed through.
+    '''
+
+    def __init__(self, names: list, coords: np.ndarray):
+        from sklearn.neighbors import KDTree
+        self.names = np.asarray(names, dtype=object)
+        self.tree = KDTree(np.asarray(coords, dtype=np.float64))
+
+    @classmethod
+    def from_grouping(cls, renaming: dict, centroids: dict, coordinates):
+        '''
+        renaming, centroids: a grouping fitted by fit_airports_grouping/fit_countries_grouping
+        coordinates: airport_coordinates or country_coordinates
+        '''
+        names = [f'{prefix}{i}' for prefix, group in centroids.items() for i in range(len(group))]
+        points = [np.array([point for group in centroids.values() for point in group], dtype=np.float64).reshape(-1, 2)]
+
+        kept = [code for code, group in renaming.items() if code == group]
+        coords, found = coordinates(kept)
+        names += [code for code, is_found in zip(kept, found) if is_found]
+        points.append(coords[found])
+
+        return cls(names, np.concatenate(points))
+
+    def assign(self, coords: np.ndarray) -> np.ndarray:
+        '''
+        Name of the nearest group of each (lat, lon) row of coords
+        '''
+        _, nearest = self.tree.query(np.asarray(coords, dtype=np.float64).reshape(-1, 2), k=1)
+        return self.names[nearest[:, 0]]
+
+def assign_unseen_codes(d_frame, columns, renaming, index, coordinates, default) -> dict:
+    '''
+    Renaming of the codes of the given columns missing from renaming, to the nearest group of index
+
+    Codes without coordinates are placed at default (lat, lon). Returns a dict {code: group}, to be merged with renaming.
+    index can also be a function returning the GroupIndex, only called if there are unseen codes.
+    '''
+    codes = pd.unique(pd.concat([pd.Series(d_frame[column].unique(), dtype=object) for column in columns]).dropna())
+    unseen = [code for code in codes if code not in renaming]
+    if not unseen:
+        return {}
+    if callable(index):
+        index = index()
+    coords, found = coordinates(unseen)
+    coords = np.where(found[:, None], coords, np.asarray(default, dtype=np.float64))
+    return dict(zip(unseen, index.assign(coords)))
+
+def airports_default_position(centroids: dict) -> np.ndarray:
+    '''
+    Position given to the airports missing from the airportsdata database: the mean of the group centroids
+    '''
+    return np.array([point for group in centroids.values() for point in group], dtype=np.float64).mean(axis=0)
+
+# countries missing from the airportsdata database are placed at (0, 0), as in fit_countries_grouping
+COUNTRIES_DEFAULT_POSITION = (0.0, 0.0)
+
+def lookup_lat_lon(codes: pd.Series):
+    '''
+    Vectorized lookup of the (lat, lon) of each airport code of the series
+
+    The codes are factorized first, so the hash lookup is done once per distinct airport, 
+    and the result is broadcasted back to the rows with a single take.
+    Airports missing from the airportsdata database get (0, 0).
+
+    Returns two float64 arrays (lat, lon) aligned with codes
+    '''
+    icao, coords = airport_coordinates_table()
+
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        codes_idx, uniques = codes.cat.codes.to_numpy(), codes.cat.categories
+    else:
+        codes_idx, uniques = pd.factorize(codes)
+    positions = icao.get_indexer(uniques)
+    unique_coords = np.where((positions >= 0)[:, None], coords[positions], 0.0)
+
+    # append a (0, 0) row for missing codes (factorize returns -1 for NaN)
+    unique_coords = np.vstack([unique_coords, np.zeros((1, 2))])
+    rows_coords = unique_coords[codes_idx]
+    return rows_coords[:, 0], rows_coords[:, 1]
+
+def add_lon_lat(d_frame):
+    '''
+    Adds lon_adep, lat_adep, lon_ades, lat_ades to d_frame, one vectorized join per airport column
+    '''
+    lat_adep, lon_adep = lookup_lat_lon(d_frame['adep'])
+    lat_ades, lon_ades = lookup_lat_lon(d_frame['ades'])
+    d_frame['lon_adep'] = lon_adep
+    d_frame['lat_adep'] = lat_adep
+    d_frame['lon_ades'] = lon_ades
+    d_frame['lat_ades'] = lat_ades
 
 def compute_lon_lat(df_train, df_test):
     '''
@@ -26,43 +180,8 @@ def compute_lon_lat(df_train, df_test):
     except:
         raise Exception('Module airportsdata not found')
     
-    # Load the airports data as a dictionary
-    airports_dict = airportsdata.load()
-    airports = pd.DataFrame.from_dict(airports_dict, orient='index')
-
-    airports_counts = pd.concat([
-                                df_train.groupby('adep').size().reset_index(name = 'total_flights').set_index('adep'),
-                                df_train.groupby('ades').size().reset_index(name = 'total_flights').set_index('ades'),
-                                df_test.groupby('adep').size().reset_index(name = 'total_flights').set_index('adep'),
-                                df_test.groupby('ades').size().reset_index(name = 'total_flights').set_index('ades'),
-
-                                 ])
-    airports_counts = airports_counts[~airports_counts.index.duplicated(keep='first')]
-
-    airports_counts['lon'], airports_counts['lat'] = np.zeros(len(airports_counts)), np.zeros(len(airports_counts))
-
-    for index, row in airports.iterrows():
-        # Ensure lat/lon values are valid
-        airport = row['icao']
-        for (i, a) in enumerate(list(airports_counts.index)):
-            if airport == a:
-                lat = row['lat']
-                lon = row['lon']
-                airports_counts.iloc[i, airports_counts.columns.get_loc('lat')] = lat
-                airports_counts.iloc[i, airports_counts.columns.get_loc('lon')] = lon
-
-
-    # Add new columns
-    df_train['lon_adep'] = df_train['adep'].map(airports_counts['lon'])
-    df_train['lat_adep'] = df_train['adep'].map(airports_counts['lat'])
-    df_train['lon_ades'] = df_train['ades'].map(airports_counts['lon'])
-    df_train['lat_ades'] = df_train['ades'].map(airports_counts['lat'])
-
-    df_test['lon_adep'] = df_test['adep'].map(airports_counts['lon'])
-    df_test['lat_adep'] = df_test['adep'].map(airports_counts['lat'])
-    df_test['lon_ades'] = df_test['ades'].map(airports_counts['lon'])
-    df_test['lat_ades'] = df_test['ades'].map(airports_counts['lat'])
-
+    add_lon_lat(df_train)
+    add_lon_lat(df_test)
 
     print("-"*100)
     print("Columns for lon & lat: ['lon_adep', 'lat_adep', 'lon_ades', 'lat_ades'] successfully created !")
@@ -77,6 +196,7 @@ def group_and_rename_airports(df_train, df_test):
     If the airport is big enough, its code is unchanged
     For small airports, the airports are grouped by proximity and renamed to 30 different small airports (20 airports, SA0, SA1, ..., SA29)
     Same for tiny airports (renamed to AT0, AT1, ..., AT29)
+    Airports without departures in df_train (unseen, or ades only) are renamed to the nearest group (see GroupIndex)
     
     After this process, the columns adep and ades are modified accordingly
     '''
@@ -91,12 +211,32 @@ def group_and_rename_airports(df_train, df_test):
         raise Exception('Column for adep/ades, or lon/lat not found in dataframe df_train')
 
 
+    renaming, centroids = fit_airports_grouping(df_train)
+    index = GroupIndex.from_grouping(renaming, centroids, airport_coordinates)
+    for d_frame in (df_train, df_test):
+        unseen = assign_unseen_codes(d_frame, ['adep', 'ades'], renaming, index, airport_coordinates, airports_default_position(centroids))
+        apply_renaming(d_frame, ['adep', 'ades'], {**renaming, **unseen})
+
+    print("-"*100)
+    print(f"Airports codes successfully grouped ! Different codes left : {len(df_train['adep'].unique())}")
+    print("-"*100)
+
+def fit_airports_grouping(df_train):
+    '''
+    Fits the airports grouping of group_and_rename_airports on df_train
+
+    Returns:
+        renaming: dict {airport code: new airport code}
+        centroids: dict {'TA': centroids of the tiny airports clusters, 'SA': centroids of the small airports clusters}, as [lat, lon] lists
+    '''
+    from sklearn.cluster import KMeans
+
     # Load the airports data 
-    airports_dict = airportsdata.load()
-    airports = pd.DataFrame.from_dict(airports_dict, orient='index')
+    icao, coords = airport_coordinates_table()
+    airports = pd.DataFrame(coords, index=icao, columns=['lat', 'lon'])
 
     # Computes for each airport, the corresponding lon, lat
-    airports_counts = df_train.groupby('adep').size().reset_index(name = 'total_flights').set_index('adep')
+    airports_counts = df_train.groupby('adep', observed=True).size().reset_index(name = 'total_flights').set_index('adep')
     airports_counts['lon'] = airports['lon']
     airports_counts['lat'] = airports['lat']
     airports_counts['lat'] = airports_counts['lat'].fillna(airports_counts['lat'].mean())
@@ -117,6 +257,7 @@ def group_and_rename_airports(df_train, df_test):
     
     X = np.array(tiny_airports[['lat', 'lon']])
     kmeans = KMeans(n_clusters=k_tiny_airports, random_state=0, n_init="auto").fit(X)
+    centroids = {'TA': kmeans.cluster_centers_.tolist()}
 
     for i in range(len(names_tiny_airports)):
         cluster_idx =  kmeans.labels_[i]
@@ -129,6 +270,7 @@ def group_and_rename_airports(df_train, df_test):
 
     X = np.array(small_airports[['lat', 'lon']])
     kmeans = KMeans(n_clusters=k_small_airports, random_state=0, n_init="auto").fit(X)
+    centroids['SA'] = kmeans.cluster_centers_.tolist()
 
     for i in range(len(name_small_airports)):
         cluster_idx =  kmeans.labels_[i]
@@ -141,14 +283,7 @@ def group_and_rename_airports(df_train, df_test):
     renaming.update(renaming_tiny_airports)
     renaming.update(renaming_small_airports)
 
-    df_train['adep'] = df_train['adep'].replace(renaming)
-    df_train['ades'] = df_train['ades'].replace(renaming)
-    df_test['adep'] = df_test['adep'].replace(renaming)
-    df_test['ades'] = df_test['ades'].replace(renaming)
-
-    print("-"*100)
-    print(f"Airports codes successfully grouped ! Different codes left : {len(df_train['adep'].unique())}")
-    print("-"*100)
+    return renaming, centroids
 
 def group_and_rename_countries(df_train, df_test):
     '''
@@ -157,6 +292,7 @@ def group_and_rename_countries(df_train, df_test):
     If the country is big enough, its country code is unchanged
     For small countries, the countries are grounped by proximity and renamed to 10 different small countries (renamed to SC0, SC1, ..., SC9)
     Same for tiny countries (renamed to ST0, ST1, ..., ST9)
+    Countries without departures in df_train are renamed to the nearest group (see GroupIndex)
     
     After this process, the columns country_code_adep and country_code_ades are modified accordingly
     '''
@@ -170,13 +306,31 @@ def group_and_rename_countries(df_train, df_test):
     except:
         raise Exception('Column for adep/ades, or lon/lat not found in dataframe df_train')
 
+    renaming, centroids = fit_countries_grouping(df_train)
+    index = GroupIndex.from_grouping(renaming, centroids, country_coordinates)
+    for d_frame in (df_train, df_test):
+        unseen = assign_unseen_codes(d_frame, ['country_code_adep', 'country_code_ades'], renaming, index, country_coordinates, COUNTRIES_DEFAULT_POSITION)
+        apply_renaming(d_frame, ['country_code_adep', 'country_code_ades'], {**renaming, **unseen})
+
+    print("-"*100)
+    print(f"Country codes successfully grouped ! Different codes left : {len(df_train['country_code_adep'].unique())}")
+    print("-"*100)
+
+def fit_countries_grouping(df_train):
+    '''
+    Fits the countries grouping of group_and_rename_countries on df_train
+
+    Returns:
+        renaming: dict {country code: new country code}
+        centroids: dict {'TC': centroids of the tiny countries clusters, 'SC': centroids of the small countries clusters}, as [lat, lon] lists
+    '''
+    from sklearn.cluster import KMeans
+
     # Load the airports data 
-    airports_dict = airportsdata.load()
-    airports = pd.DataFrame.from_dict(airports_dict, orient='index')
-    countries_localisation = airports.groupby('country')[['lat','lon']].mean()
+    countries_localisation = country_coordinates_table()
     
     # Computes for each airport, the corresponding lon, lat
-    country_counts = df_train.groupby('country_code_adep').size().reset_index(name = 'total_flights').set_index('country_code_adep')
+    country_counts = df_train.groupby('country_code_adep', observed=True).size().reset_index(name = 'total_flights').set_index('country_code_adep')
     country_counts['lon'] = countries_localisation['lon']
     country_counts['lat'] = countries_localisation['lat']
     country_counts = country_counts.fillna(0)
@@ -190,14 +344,13 @@ def group_and_rename_countries(df_train, df_test):
     renaming_big_medium_countries = {name:name for name in big_medium_countries.index.unique()} # dont rename big and medium airports
 
     # Grouping tiny airports to 10 countries
-    from sklearn.cluster import KMeans
-
     k_tiny_countries = 10
     names_tiny_countries = list(tiny_countries.index.unique())
     renaming_tiny_countries = {name:name for name in names_tiny_countries}
 
     X = np.array(tiny_countries[['lat', 'lon']])
     kmeans = KMeans(n_clusters=k_tiny_countries, random_state=0, n_init="auto").fit(X)
+    centroids = {'TC': kmeans.cluster_centers_.tolist()}
 
     for i in range(len(names_tiny_countries)):
         cluster_idx =  kmeans.labels_[i]
@@ -211,6 +364,7 @@ def group_and_rename_countries(df_train, df_test):
 
     X = np.array(small_countries[['lat', 'lon']])
     kmeans = KMeans(n_clusters=k_small_countries, random_state=0, n_init="auto").fit(X)
+    centroids['SC'] = kmeans.cluster_centers_.tolist()
 
     for i in range(len(name_small_countries)):
         cluster_idx =  kmeans.labels_[i]
@@ -222,16 +376,74 @@ def group_and_rename_countries(df_train, df_test):
     renaming.update(renaming_tiny_countries)
     renaming.update(renaming_small_countries)
 
-    df_train['country_code_adep'] = df_train['country_code_adep'].replace(renaming)
-    df_train['country_code_ades'] = df_train['country_code_ades'].replace(renaming)
-    df_test['country_code_adep'] = df_test['country_code_adep'].replace(renaming)
-    df_test['country_code_ades'] = df_test['country_code_ades'].replace(renaming)
+    return renaming, centroids
 
-    print("-"*100)
-    print(f"Country codes successfully grouped ! Different codes left : {len(df_train['country_code_adep'].unique())}")
-    print("-"*100)
+def apply_renaming(d_frame, columns, renaming):
+    '''
+    Renames the codes of the given columns with a fitted renaming dict (codes not in renaming are unchanged)
+
+    The columns are remapped as categoricals (O(unique codes) instead of a replace over all the rows), and stay categorical
+    '''
+    for column in columns:
+        d_frame[column] = remap_categorical(d_frame[column], renaming)
+
+
+
+# mapping table of the aircraft types (see aircraft_type_mapping), can be edited without changing the code
+AIRCRAFT_TYPES_PATH = os.path.join(os.path.dirname(__file__), 'aircraft_types.json')
+
+@lru_cache(maxsize=None)
+@timed_initialization('aircraft_types_table')
+def _read_aircraft_types_table(path):
+    with open(path) as f:
+        return json.load(f)
+
+def load_aircraft_types_table(path=None) -> dict:
+    '''
+    Aircraft types mapping table of path (AIRCRAFT_TYPES_PATH by default):
+        known_types: aircraft types of the training dataset
+        substitutions: {type: similar type} to reduce the number of categories (null for the singular aircrafts,
+                       regrouped in the unknown category)
+        unknown: category of the aircraft types not in known_types
+    '''
+    table = _read_aircraft_types_table(path or AIRCRAFT_TYPES_PATH)
+    try:
+        table['known_types'], table['substitutions'], table['unknown']
+    except KeyError:
+        raise Exception(f"The aircraft types table {path or AIRCRAFT_TYPES_PATH} must have known_types, substitutions and unknown entries")
+    return table
 
+def aircraft_type_mapping(types, table: dict) -> tuple:
+    '''
+    Mapping {original type: new type} of the given (distinct) aircraft types with a mapping table (see load_aircraft_types_table)
+
+    Substituted types are replaced by their similar type (the unknown category for a null one),
+    the types neither known nor substituted fall into the unknown category.
+    Returns the mapping, and the sorted list of the types that fell into the unknown category because they were not in the table
+    '''
+    known_types = set(table['known_types'])
+    substitutions = table['substitutions']
+    mapping, unknown = {}, []
+    for o_type in types:
+        if o_type in substitutions:
+            mapping[o_type] = substitutions[o_type] or table['unknown']
+        elif o_type in known_types:
+            mapping[o_type] = o_type
+        else:
+            mapping[o_type] = table['unknown']
+            unknown.append(o_type)
+    return mapping, sorted(unknown)
+
+def regroup_aircraft_types(series: pd.Series, table: dict = None) -> tuple:
+    '''
+    Regroups the aircraft types of series with the mapping table (load_aircraft_types_table() by default), as a categorical remap:
+    the table is only looked up once per distinct type.
 
+    Returns the regrouped (categorical) series, and the list of the types of series that were not in the table
+    '''
+    table = table or load_aircraft_types_table()
+    mapping, unknown = aircraft_type_mapping(observed_categories(series).tolist(), table)
+    return remap_categorical(series, mapping), unknown
 
 def regroup_aircraft_type(o_type):
     """Match original aicraft types with similar type (to reduce number of one-hot encoding variables)
@@ -239,56 +451,46 @@ def regroup_aircraft_type(o_type):
     Args:
         o_type (str): original type of aicraft
 
-    Returns the new type of the aircraft, the closest one to it. The category XXXX corresponds to the category of singular aircrafts OR aircrafts 
-    not present in the training dataset ("aicraft_types" list).
+    Returns the new type of the aircraft, the closest one to it. The unknown category of the aircraft types table (AIRCRAFT_TYPES_PATH)
+    corresponds to the category of singular aircrafts OR aircrafts not present in the training dataset.
+    Scalar version of regroup_aircraft_types, for a single flight.
     """
-
-    aircraft_types = ['A20N' ,'A21N' ,'A310' ,'A319' ,'A320' ,'A321' ,'A332' ,'A333' ,'A343' ,'A359', 'AT76' 
-    ,'B38M' ,'B39M' ,'B737' ,'B738' ,'B739' ,'B752' ,'B763' ,'B772' ,'B773' ,'B77W' ,'B788' ,'B789' 
-    ,'BCS1' ,'BCS3' ,'C56X' ,'CRJ9' ,'E190' ,'E195' ,'E290'] #list of aircraft_types in the training dataset.
-
-    match o_type :
-        case 'BCS1': return 'BCS3'
-        case 'B737': return 'A320'
-        case 'A332': return 'A333'
-        case 'E190': return 'E195'
-        case 'B739': return 'B38M'
-        case 'A359': return 'B773'
-        case 'B763': return 'A332'
-        case 'B39M': return 'B38M'
-        case 'A343': return 'XXXX'
-        case 'B752': return 'XXXX'
-        case 'A310': return 'A21N'
-        case 'B773': return 'XXXX'
-        case 'C56X': return 'XXXX' # mais c un outlier bizarre
-        case 'E290': return 'E195'
-
-    if o_type not in aircraft_types:
-        return 'XXXX'
-
-    else: return o_type
+    mapping, _ = aircraft_type_mapping([o_type], load_aircraft_types_table())
+    return mapping[o_type]
 
 def group_and_rename_aircraft_types(train_df, test_df):
-    train_df['aircraft_type'] = (train_df['aircraft_type']).apply(regroup_aircraft_type)
-    test_df['aircraft_type'] = (test_df['aircraft_type']).apply(regroup_aircraft_type)
+    table = load_aircraft_types_table()
+    for d_frame in [train_df, test_df]:
+        d_frame['aircraft_type'], unknown = regroup_aircraft_types(d_frame['aircraft_type'], table)
+        if unknown:
+            print(f"Aircraft types not in the aircraft types table, regrouped in {table['unknown']}: {unknown}")
+
+def airline_label(i: int) -> str:
+    '''
+    Spreadsheet-like label of the i-th airline: A, B, ..., Z, AA, AB, ..., AZ, BA...
+    '''
+    label = ''
+    i += 1
+    while i > 0:
+        i, remainder = divmod(i - 1, 26)
+        label = chr(ord('A') + remainder) + label
+    return label
 
 def rename_regroup_airlines(df_train, df_test):
-    """Renaming airlines by Airline A, B, C... 
+    """Renaming airlines by Airline A, B, C... (then AA, AB... past 26 airlines)
     and creating a group of airlines of less then 80 flights per year
     returns the corrected dataset """
     airlines_list = df_train['airline'].value_counts().index
-    renaming_airlines = {}
-    for i,airline in enumerate(list(airlines_list)):
-        renaming_airlines[airline] = "Airline " + chr(ord('A')+i)
-    df_train['airline'] = df_train['airline'].replace( renaming_airlines)
+    renaming_airlines = {airline: "Airline " + airline_label(i) for i, airline in enumerate(airlines_list)}
+    df_train['airline'] = remap_categorical(df_train['airline'], renaming_airlines)
     airline_counts = df_train['airline'].value_counts()
     small_airlines = airline_counts[airline_counts < 80].index
-    df_train['airline'] = df_train['airline'].replace(small_airlines, 'Airline_less80')
+    df_train['airline'] = remap_categorical(df_train['airline'], {airline: 'Airline_less80' for airline in small_airlines})
 
-    df_test['airline'] = df_test['airline'].replace( renaming_airlines)
+    df_test['airline'] = remap_categorical(df_test['airline'], renaming_airlines)
     airline_counts = df_test['airline'].value_counts()
     small_airlines = airline_counts[airline_counts < 80].index
-    df_test['airline'] = df_test['airline'].replace(small_airlines, 'Airline_less80')
+    df_test['airline'] = remap_categorical(df_test['airline'], {airline: 'Airline_less80' for airline in small_airlines})
 
 
 
@@ -1,6 +1,7 @@
 import pandas as pd 
 import numpy as np
 from preprocessing.country_and_airports_codes import group_and_rename_countries, group_and_rename_airports, compute_lon_lat
+from preprocessing.categorical import to_categorical, observed_categories
 
 def one_hot_encoding(df_train, df_test, columns):
     '''
@@ -25,19 +26,100 @@ def string_to_int_hashing(df_train, df_test, columns):
     '''
     String to int encoding with arbitrary hashing
     '''
-    for column in columns:
-        df_train[column] = df_train[column].astype('category')
-        df_test[column] = df_test[column].astype('category')
-        df_test[column] = df_test[column].cat.set_categories(df_train[column].cat.categories)
-
-        df_train[column] = df_train[column].cat.codes
-        df_test[column] = df_test[column].cat.codes
+    categories = fit_categories(df_train, columns)
+    apply_int_hashing(df_train, categories)
+    apply_int_hashing(df_test, categories)
 
-    print(df_test, df_train)
     print("-"*100)
     print(f"Columns {columns} successfully string to int encoded!")
     print("-"*100)
 
+def fit_categories(df_train, columns):
+    '''
+    Fits the category vocabulary of each column on df_train
+
+    Returns a dict {column: list of categories}, the position of a value in the list is its int code
+    '''
+    return {column: observed_categories(df_train[column]).tolist() for column in columns}
+
+def apply_int_hashing(d_frame, categories):
+    '''
+    String to int encoding with fitted categories (values not in the categories are encoded -1)
+    '''
+    for column, column_categories in categories.items():
+        d_frame[column] = to_categorical(d_frame[column]).cat.set_categories(column_categories).cat.codes
+
+def apply_categorical_encoding(d_frame, categories):
+    '''
+    Keeps the columns as pandas categoricals, with the fitted categories in their fitted order
+    (values not in the categories are missing), for the native categorical support of XGBoost
+    '''
+    for column, column_categories in categories.items():
+        d_frame[column] = to_categorical(d_frame[column]).cat.set_categories(column_categories)
+
+STATS_SMOOTHING = 20
+
+def category_statistics(d_frame, column, target=None, smoothing=STATS_SMOOTHING):
+    '''
+    Statistics of each value of column on d_frame:
+        freq: share of the rows with this value
+        mean: mean of target on these rows, smoothed towards the global mean (values seen on few rows get a mean close to it)
+    '''
+    groups = d_frame.groupby(column, observed=True)
+    stats = pd.DataFrame({'freq': groups.size() / len(d_frame)})
+    if target is not None:
+        prior = d_frame[target].mean()
+        count = groups[target].count()
+        stats['mean'] = (groups[target].mean()*count + prior*smoothing) / (count + smoothing)
+    return stats
+
+def lookup_statistic(values, statistic, default):
+    '''
+    statistic (a Series indexed by category) of each value, default for the values it does not know
+    '''
+    positions = statistic.index.get_indexer(values)
+    return np.where(positions >= 0, statistic.to_numpy(dtype=np.float64)[positions], default)
+
+def add_category_statistics(d_frame, stats, prior=None):
+    '''
+    Adds the fitted statistics of each column: {column}_freq, and {column}_target_mean if the target mean was fitted
+    stats is a dict {column: {'freq': {value: freq}, 'mean': {value: mean}}}, prior the global target mean
+    '''
+    for column, column_stats in stats.items():
+        for name, default, suffix in [('freq', 0.0, 'freq'), ('mean', prior, 'target_mean')]:
+            if name in column_stats:
+                d_frame[f'{column}_{suffix}'] = lookup_statistic(d_frame[column], pd.Series(column_stats[name]), default)
+
+def out_of_fold_category_statistics(d_frame, columns, target=None, n_folds=5, random_state=42, smoothing=STATS_SMOOTHING):
+    '''
+    Adds the statistics of add_category_statistics to the training set, computed out-of-fold:
+    the statistics of the rows of each fold are the ones of the other folds, so that a row never sees its own target
+    '''
+    folds = np.random.default_rng(random_state).integers(0, n_folds, len(d_frame))
+    for column in columns:
+        freq = np.empty(len(d_frame))
+        mean = np.empty(len(d_frame))
+        for fold in range(n_folds):
+            in_fold = folds == fold
+            out_of_fold = d_frame[~in_fold]
+            stats = category_statistics(out_of_fold, column, target, smoothing)
+            freq[in_fold] = lookup_statistic(d_frame[column][in_fold], stats['freq'], 0.0)
+            if target is not None:
+                mean[in_fold] = lookup_statistic(d_frame[column][in_fold], stats['mean'], out_of_fold[target].mean())
+        d_frame[f'{column}_freq'] = freq
+        if target is not None:
+            d_frame[f'{column}_target_mean'] = mean
+
+def fit_category_statistics(df_train, columns, target=None, smoothing=STATS_SMOOTHING):
+    '''
+    Statistics of each column on the whole training set (the ones applied to new data), as a dict for add_category_statistics
+    '''
+    fitted = {}
+    for column in columns:
+        stats = category_statistics(df_train, column, target, smoothing)
+        fitted[column] = {name: {str(value): float(stat) for value, stat in stats[name].items()} for name in stats.columns}
+    return fitted
+
 def string_to_value_count(df_train, df_test, columns):
     '''
     String to int encoding based on value_counts.
@@ -50,7 +132,6 @@ def string_to_value_count(df_train, df_test, columns):
         df_train[column] = df_train[column].map(value_to_int)
         df_test[column] = df_test[column].map(value_to_int)
 
-    print(df_test, df_train)
     print("-" * 100)
     print(f"Columns {columns} successfully string-to-int encoded using value counts!")
     print("-" * 100)
@@ -0,0 +1,188 @@
+'''
+Typed ingestion of the challenge and submission sets
+
+The csv files are read once with an explicit schema (categoricals for the codes, datetime64[ns, UTC] for the times,
+int32/float32 for the numerics), and converted by chunks to a cached Parquet file in CACHE_DIR (one per resolved csv path).
+Later runs memory-map the Parquet file and only read the requested columns.
+The cache is rebuilt when the csv changes (its path, size and modification time are stored in the cache), or when SCHEMA_VERSION changes.
+pyarrow is optional: without it, the csv is read with the schema on every run. It is imported on the first load.
+'''
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+import pandas as pd
+
+from preprocessing.categorical import categorize_codes
+
+CACHE_DIR = os.environ.get('ATOW_CACHE_DIR', 'data/cache')
+SCHEMA_VERSION = '2'
+
+# rows of the csv converted to Parquet at once (the conversion never loads the whole csv)
+CONVERT_CHUNK_ROWS = 500_000
+
+INDEX_COLUMN = 'flight_id'
+
+CATEGORICAL_COLUMNS = ['date', 'callsign', 'adep', 'name_adep', 'country_code_adep', 'ades', 'name_ades', 'country_code_ades',
+                       'aircraft_type', 'wtc', 'airline']
+DATETIME_COLUMNS = ['actual_offblock_time', 'arrival_time']
+NUMERIC_COLUMNS = {'flight_duration': 'int32', 'taxiout_time': 'int32', 'flown_distance': 'int32', 'tow': 'float32'}
+
+
+@lru_cache(maxsize=1)
+def _pyarrow() -> tuple:
+    '''
+    (pyarrow, pyarrow.parquet), (None, None) if pyarrow is not installed
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None, None
+    return pa, pq
+
+def read_csv_with_schema(path: str, chunksize: int = None, **kwargs) -> pd.DataFrame:
+    '''
+    Reads a challenge/submission csv with the explicit schema, flight_id as index
+    (with chunksize, an iterator of frames of chunksize rows)
+    '''
+    header = pd.read_csv(path, nrows=0).columns
+    dtype = {column: 'category' for column in CATEGORICAL_COLUMNS if column in header}
+    if chunksize is not None:
+        return (apply_schema(chunk) for chunk in pd.read_csv(path, index_col=INDEX_COLUMN, dtype=dtype, chunksize=chunksize, **kwargs))
+    d_frame = pd.read_csv(path, index_col=INDEX_COLUMN, dtype=dtype, **kwargs)
+    return apply_schema(d_frame)
+
+def apply_schema(d_frame: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Casts the columns of d_frame to the schema (in place, columns missing from d_frame are skipped)
+    '''
+    for column in CATEGORICAL_COLUMNS:
+        if column in d_frame.columns and not isinstance(d_frame[column].dtype, pd.CategoricalDtype):
+            d_frame[column] = d_frame[column].astype('category')
+    for column in DATETIME_COLUMNS:
+        if column in d_frame.columns:
+            d_frame[column] = pd.to_datetime(d_frame[column], utc=True).dt.as_unit('ns')
+    for column, dtype in NUMERIC_COLUMNS.items():
+        if column in d_frame.columns:
+            # integer columns with missing values are kept as float32
+            if dtype.startswith('int') and d_frame[column].isna().any():
+                dtype = 'float32'
+            d_frame[column] = d_frame[column].astype(dtype)
+    return d_frame
+
+def source_key(csv_path: str) -> str:
+    '''
+    Identity of the csv the cache is built from: its resolved absolute path, size and modification time
+    '''
+    stat = os.stat(csv_path)
+    return json.dumps({'path': os.path.realpath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+def parquet_cache_path(csv_path: str, cache_dir: str = None) -> str:
+    '''
+    Cached Parquet file of the csv: one per resolved csv path (two csv files with the same name in different
+    directories have different caches)
+    '''
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    path_hash = hashlib.sha1(os.path.realpath(csv_path).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir or CACHE_DIR, f'{name}_{path_hash}.parquet')
+
+def _cache_is_valid(csv_path: str, parquet_path: str) -> bool:
+    if not os.path.exists(parquet_path):
+        return False
+    _, pq = _pyarrow()
+    metadata = pq.read_schema(parquet_path).metadata or {}
+    return (metadata.get(b'atow_schema_version') == SCHEMA_VERSION.encode()
+            and metadata.get(b'atow_source') == source_key(csv_path).encode())
+
+def _arrow_schema(table):
+    '''
+    Schema of the first converted chunk, with int32 dictionary indices so that the next chunks (with more categories) fit in it
+    '''
+    pa, _ = _pyarrow()
+    fields = [pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type) else field
+              for field in table.schema]
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+def _convert_chunks(csv_path: str, parquet_path: str, chunksize: int):
+    '''
+    Reads the csv by chunks of chunksize rows with the schema, writes each chunk in the Parquet cache and yields it
+
+    The cache file is only put in place once the whole csv has been written (it is dropped if the iteration stops before).
+    '''
+    pa, pq = _pyarrow()
+    os.makedirs(os.path.dirname(parquet_path) or '.', exist_ok=True)
+    tmp_path = f'{parquet_path}.{os.getpid()}.tmp'
+    cache_metadata = {b'atow_schema_version': SCHEMA_VERSION.encode(), b'atow_source': source_key(csv_path).encode()}
+
+    writer, schema, complete = None, None, False
+    try:
+        for chunk in read_csv_with_schema(csv_path, chunksize=chunksize):
+            if schema is None:
+                schema = _arrow_schema(pa.Table.from_pandas(chunk))
+                schema = schema.with_metadata({**(schema.metadata or {}), **cache_metadata})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema))
+            yield chunk
+        complete = True
+    finally:
+        if writer is not None:
+            writer.close()
+        if complete and writer is not None:
+            os.replace(tmp_path, parquet_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def convert_to_parquet(csv_path: str, cache_dir: str = None) -> str:
+    '''
+    Converts the csv to the typed, cached Parquet file (if it is missing or outdated), returns its path
+
+    The csv is converted by chunks of CONVERT_CHUNK_ROWS rows, it is never loaded in memory at once.
+    '''
+    parquet_path = parquet_cache_path(csv_path, cache_dir)
+    if not _cache_is_valid(csv_path, parquet_path):
+        for _ in _convert_chunks(csv_path, parquet_path, CONVERT_CHUNK_ROWS):
+            pass
+    return parquet_path
+
+def load_flights(csv_path: str, columns: list = None, cache_dir: str = None) -> pd.DataFrame:
+    '''
+    Loads a challenge/submission set with the schema (flight_id as index), only the given columns if any
+
+    The first call converts the csv to Parquet, the following ones memory-map the Parquet file.
+    '''
+    _, pq = _pyarrow()
+    if pq is None:
+        d_frame = read_csv_with_schema(csv_path)
+        return d_frame if columns is None else d_frame[columns]
+
+    parquet_path = convert_to_parquet(csv_path, cache_dir)
+    d_frame = pq.read_table(parquet_path, columns=columns, memory_map=True, use_pandas_metadata=True).to_pandas()
+    # the integer columns with missing values in some chunks are read back as float64
+    return apply_schema(categorize_codes(d_frame, CATEGORICAL_COLUMNS))
+
+def iter_flights(csv_path: str, chunksize: int, columns: list = None, cache_dir: str = None):
+    '''
+    Yields the set by chunks of chunksize rows, with the schema (flight_id as index)
+
+    Without a valid Parquet cache, the chunks are read from the csv and written to the cache as they are yielded
+    (the memory stays bounded by the chunk size, and the first chunk comes before the end of the conversion).
+    '''
+    pa, pq = _pyarrow()
+    parquet_path = parquet_cache_path(csv_path, cache_dir) if pq is not None else None
+    if pq is None or not _cache_is_valid(csv_path, parquet_path):
+        chunks = read_csv_with_schema(csv_path, chunksize) if pq is None else _convert_chunks(csv_path, parquet_path, chunksize)
+        for chunk in chunks:
+            yield chunk if columns is None else chunk[columns]
+        return
+
+    parquet_file = pq.ParquetFile(parquet_path, memory_map=True)
+    if columns is not None:
+        columns = list(columns) + [INDEX_COLUMN]
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        chunk = pa.Table.from_batches([batch], schema=batch.schema).to_pandas()
+        if INDEX_COLUMN in chunk.columns:
+            chunk = chunk.set_index(INDEX_COLUMN)
+        yield apply_schema(categorize_codes(chunk, CATEGORICAL_COLUMNS))
@@ -1,14 +1,21 @@
 import pandas as pd
 import numpy as np
 import datetime
+from functools import lru_cache
 
-import airportsdata
-import pytz
-from timezonefinder import TimezoneFinder
+from preprocessing.timezone_cache import lookup_airport_timezones
+from preprocessing.categorical import remap_categorical
+from preprocessing.country_and_airports_codes import load_airports
+from preprocessing.profiling import timed_initialization
 
+# airportsdata, timezonefinder and pytz are imported on first use: most runs resolve the timezones from the on-disk cache
 
-airports = airportsdata.load("ICAO")
-tf = TimezoneFinder()
+
+# airports whose timezone is not resolved (or wrongly resolved) by airportsdata + timezonefinder
+AIRPORT_TZ_PATCHES = {"EGSY": "Europe/London", "OKBK": "Asia/Kuwait"}
+
+NS_PER_HOUR = 3600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
 
 def patch_kuweit(d_frame: pd.DataFrame) -> pd.DataFrame:
     try:
@@ -16,20 +23,30 @@ def patch_kuweit(d_frame: pd.DataFrame) -> pd.DataFrame:
     except:
         raise Exception(f'country_code_adep or country_code_ades column not found in dataframe:{d_frame} in function "patch kuweit')
     # replace all "##" in country_code_adep column by "KW"
-    d_frame['country_code_adep'] = d_frame['country_code_adep'].replace('##', 'KW')
-    d_frame['country_code_ades'] = d_frame['country_code_ades'].replace('##', 'KW')
+    d_frame['country_code_adep'] = remap_categorical(d_frame['country_code_adep'], {'##': 'KW'})
+    d_frame['country_code_ades'] = remap_categorical(d_frame['country_code_ades'], {'##': 'KW'})
     return d_frame
 
 
+def get_airports() -> dict:
+    # the same (ICAO) database as the lon/lat lookups, loaded once
+    return load_airports()
+
+@lru_cache(maxsize=1)
+@timed_initialization('TimezoneFinder')
+def get_timezone_finder():
+    from timezonefinder import TimezoneFinder
+    return TimezoneFinder()
+
 def get_airport_timezone(airport_code: str) -> str:
 
-    airport_info = airports.get(airport_code)
+    airport_info = get_airports().get(airport_code)
     if not airport_info:
         return 'Unknown'
     lat = airport_info['lat']
     lng = airport_info['lon']
 
-    tz_str = tf.timezone_at(lng=lng, lat=lat)
+    tz_str = get_timezone_finder().timezone_at(lng=lng, lat=lat)
     return tz_str
 
 def airport_tz_maps_build(d_frame: pd.DataFrame) -> dict:
@@ -43,11 +60,11 @@ def airport_tz_maps_build(d_frame: pd.DataFrame) -> dict:
 
     union_airport_code = set(ades_airport_code).union(adep_airport_code)
 
-    airport_tz = [get_airport_timezone(airport_code) for airport_code in union_airport_code]
-
-    return dict(zip(union_airport_code,airport_tz))
+    # resolved through the on-disk cache, timezonefinder is only queried for new airports
+    return lookup_airport_timezones(union_airport_code)
 
 def get_country_timezone(country_code: str) -> str:
+    import pytz
     try: 
         return pytz.country_timezones[country_code][0]
     except:
@@ -76,10 +93,7 @@ def add_local_times(d_frame: pd.DataFrame) -> pd.DataFrame:
     
 
     airport_tz_dict = airport_tz_maps_build(d_frame)
-
-    airport_tz_dict["EGSY"]="Europe/London"
-    airport_tz_dict["OKBK"]="Asia/Kuwait"
-
+    airport_tz_dict.update(AIRPORT_TZ_PATCHES)
 
 
     # add localtime based on airport to add precision
@@ -120,18 +134,141 @@ def add_local_times_features(d_frame: pd.DataFrame) -> pd.DataFrame:
 
     return d_frame
 
+def utc_to_local_ns(utc_times: pd.Series, timezones: pd.Series) -> np.ndarray:
+    '''
+    Converts UTC times to naive local times, given the timezone of each row
+
+    The timestamps are parsed once, then the rows are grouped by timezone and each group
+    is converted with a single vectorized tz_convert. Unknown timezones are kept in UTC.
+
+    Returns the local times as int64 nanoseconds since epoch (NaT stays NaT)
+    '''
+    utc_ns = pd.to_datetime(utc_times, utc=True).to_numpy(dtype='datetime64[ns]').view('int64')
+    tz_codes, tz_names = pd.factorize(timezones)
+    return utc_ns_to_local_ns(utc_ns, tz_codes, tz_names)
+
+def utc_ns_to_local_ns(utc_ns: np.ndarray, tz_codes: np.ndarray, tz_names) -> np.ndarray:
+    '''
+    Core of utc_to_local_ns: the timezone of row i is tz_names[tz_codes[i]] (code -1: no timezone, the row stays in UTC)
+    '''
+    local_ns = utc_ns.copy()
+    order = np.argsort(tz_codes, kind='stable')
+    bounds = np.searchsorted(tz_codes[order], np.arange(len(tz_names) + 1))
+
+    for i, tz in enumerate(tz_names):
+        rows = order[bounds[i]:bounds[i+1]]
+        if tz in ('Unknown', 'UTC') or rows.size == 0:
+            continue
+        group = pd.DatetimeIndex(utc_ns[rows], tz='UTC').tz_convert(tz).tz_localize(None)
+        local_ns[rows] = group.asi8
+
+    return local_ns
+
+def calendar_features_from_ns(local_ns: np.ndarray) -> dict:
+    '''
+    Computes hour, day of week, day of year and month from int64 nanoseconds since epoch,
+    with integer arithmetic only (civil-from-days algorithm, proleptic Gregorian calendar)
+    '''
+    return finalize_calendar_fields(calendar_fields_from_ns(local_ns), local_ns)
+
+def calendar_fields_from_ns(local_ns: np.ndarray) -> dict:
+    '''
+    int64 hour, day of week, day of year and month of calendar_features_from_ns (meaningless on NaT rows)
+    '''
+    days = local_ns // NS_PER_DAY
+    hour = (local_ns // NS_PER_HOUR) % 24
+    day_of_week = (days + 3) % 7 # 1970-01-01 is a thursday (monday = 0)
+
+    # civil date from days since epoch
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy_from_march = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy_from_march + 2) // 153
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+
+    # days since epoch of the 1st of january of the same year
+    y = year - 1
+    era = y // 400
+    yoe = y - era * 400
+    jan_first = era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + 306 - 719468
+    day_of_year = days - jan_first + 1
+
+    return {'hour': hour, 'day_of_week': day_of_week, 'day_of_year': day_of_year, 'month': month}
+
+def finalize_calendar_fields(fields: dict, local_ns: np.ndarray) -> dict:
+    '''
+    int32 features, or float ones with NaN on the NaT rows of local_ns if there are any
+    '''
+    nat = local_ns == np.iinfo(np.int64).min
+    features = dict(fields)
+    for name, values in features.items():
+        if nat.any():
+            features[name] = np.where(nat, np.nan, values)
+        else:
+            features[name] = values.astype(np.int32)
+    return features
+
+def add_local_times_grouped(d_frame: pd.DataFrame, airport_tz_dict: dict = None) -> pd.DataFrame:
+    '''
+    Grouped, vectorized equivalent of add_local_times + local_time_to_str + add_local_times_features
+
+    The local times are computed group by group of timezone, and the features
+    are computed from the int64 epoch values, without any string round-trip.
+    '''
+    try:
+        d_frame[["actual_offblock_time","arrival_time","ades","adep"]]
+    except:
+        raise Exception(f'actual_offblock_time, arrival_time, ades or adep column not found in dataframe:{d_frame} in function "add_local_times_grouped"')
+
+    if airport_tz_dict is None:
+        airport_tz_dict = airport_tz_maps_build(d_frame)
+        airport_tz_dict.update(AIRPORT_TZ_PATCHES)
+
+    local_arrival_ns = utc_to_local_ns(d_frame['arrival_time'], d_frame['ades'].map(airport_tz_dict))
+    local_departure_ns = utc_to_local_ns(d_frame['actual_offblock_time'], d_frame['adep'].map(airport_tz_dict))
+
+    return set_local_times(d_frame, local_arrival_ns, local_departure_ns, calendar_features_from_ns(local_arrival_ns), calendar_features_from_ns(local_departure_ns))
+
+def set_local_times(d_frame: pd.DataFrame, local_arrival_ns: np.ndarray, local_departure_ns: np.ndarray, arrival: dict, departure: dict) -> pd.DataFrame:
+    '''
+    Sets the local times and the calendar features columns of add_local_times_grouped
+    '''
+    d_frame['local_arrival_time'] = local_arrival_ns.view('datetime64[ns]')
+    d_frame['local_departure_time'] = local_departure_ns.view('datetime64[ns]')
+
+    d_frame['local_arrival_hour'] = arrival['hour']
+    d_frame['local_departure_hour'] = departure['hour']
+    d_frame['travel_day_of_week'] = arrival['day_of_week']
+    d_frame['travel_day_of_year'] = arrival['day_of_year']
+    d_frame['departure_month'] = arrival['month']
+
+    return d_frame
+
     
 def edit_df_localtime(d_frame: pd.DataFrame) -> pd.DataFrame:
     d_frame= patch_kuweit(d_frame)
-    d_frame = add_local_times(d_frame)
-    d_frame= local_time_to_str(d_frame)
-    d_frame= add_local_times_features(d_frame)
+    d_frame = add_local_times_grouped(d_frame)
 
     return d_frame
 
-def add_localtime_to_train_and_test(df_train: pd.DataFrame, df_test: pd.DataFrame):
-    df_train = edit_df_localtime(df_train)
-    df_test = edit_df_localtime(df_test)
+def add_localtime_to_train_and_test(df_train: pd.DataFrame, df_test: pd.DataFrame, executor=None):
+    '''
+    Adds the local times features to df_train and df_test. With executor (a preprocessing.parallel.ShardExecutor),
+    the rows of both frames are converted together, by shards, in its process pool.
+    '''
+    if executor is None:
+        df_train = edit_df_localtime(df_train)
+        df_test = edit_df_localtime(df_test)
+        return df_train, df_test
+
+    patch_kuweit(df_train)
+    patch_kuweit(df_test)
+    airport_tz_dict = airport_tz_maps_build(pd.concat([df_train[['adep', 'ades']], df_test[['adep', 'ades']]]))
+    airport_tz_dict.update(AIRPORT_TZ_PATCHES)
+    executor.add_local_times([df_train, df_test], airport_tz_dict)
     return df_train, df_test
 
 
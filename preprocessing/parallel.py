@@ -0,0 +1,146 @@
+'''
+Process-parallel execution of the per-row stages of the preprocessing
+
+The local time stage (timezone conversion of the arrival and off-block times, calendar features) only depends on each row:
+ShardExecutor splits the rows of one or several frames (e.g. train and test) in shards of shard_rows rows and converts them in
+a pool of worker processes. The input columns (UTC times as int64 ns, timezone codes) and the outputs (local times, calendar
+fields) are exchanged through shared memory buffers, only the shard bounds and the timezone names are pickled.
+
+The other stages either need all the rows (fitting the KMeans groupings and the category vocabularies) or only
+work on the distinct codes of categorical columns (renamings, aircraft types, lon/lat and hashing lookups):
+they stay in the main process.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.categorical import to_categorical
+from preprocessing.local_time import utc_ns_to_local_ns, calendar_fields_from_ns, finalize_calendar_fields, set_local_times
+
+# rows of the input buffer: UTC times, timezone codes
+ARRIVAL_NS, DEPARTURE_NS, ARRIVAL_TZ, DEPARTURE_TZ = range(4)
+# rows of the output buffer: local times, calendar fields
+LOCAL_ARRIVAL_NS, LOCAL_DEPARTURE_NS = 0, 1
+ARRIVAL_FIELDS = {'hour': 2, 'day_of_week': 3, 'day_of_year': 4, 'month': 5}
+DEPARTURE_HOUR = 6
+N_OUTPUTS = 7
+
+
+def convert_rows(inputs: np.ndarray, outputs: np.ndarray, start: int, stop: int, tz_names: list) -> None:
+    '''
+    Local times and calendar fields of the rows start:stop of the input buffer, written in the output buffer
+    '''
+    local_arrival = utc_ns_to_local_ns(inputs[ARRIVAL_NS, start:stop], inputs[ARRIVAL_TZ, start:stop], tz_names)
+    local_departure = utc_ns_to_local_ns(inputs[DEPARTURE_NS, start:stop], inputs[DEPARTURE_TZ, start:stop], tz_names)
+    outputs[LOCAL_ARRIVAL_NS, start:stop] = local_arrival
+    outputs[LOCAL_DEPARTURE_NS, start:stop] = local_departure
+
+    arrival_fields = calendar_fields_from_ns(local_arrival)
+    for name, row in ARRIVAL_FIELDS.items():
+        outputs[row, start:stop] = arrival_fields[name]
+    outputs[DEPARTURE_HOUR, start:stop] = calendar_fields_from_ns(local_departure)['hour']
+
+def _convert_shard(input_name: str, output_name: str, n_rows: int, start: int, stop: int, tz_names: list) -> None:
+    # the workers share the resource tracker of the main process, which owns (and unlinks) the buffers
+    input_shm = shared_memory.SharedMemory(name=input_name)
+    output_shm = shared_memory.SharedMemory(name=output_name)
+    try:
+        inputs = np.ndarray((4, n_rows), dtype=np.int64, buffer=input_shm.buf)
+        outputs = np.ndarray((N_OUTPUTS, n_rows), dtype=np.int64, buffer=output_shm.buf)
+        convert_rows(inputs, outputs, start, stop, tz_names)
+        del inputs, outputs
+    finally:
+        input_shm.close()
+        output_shm.close()
+
+def timezone_codes(airports: pd.Series, airport_tz: dict, tz_names: pd.Index) -> np.ndarray:
+    '''
+    Position in tz_names of the timezone of the airport of each row (-1 for the airports without timezone)
+    '''
+    airports = to_categorical(airports)
+    category_tz = tz_names.get_indexer(pd.Index(airports.cat.categories, dtype=object).map(airport_tz))
+    codes = airports.cat.codes.to_numpy()
+    return np.where(codes >= 0, category_tz[codes], -1)
+
+def utc_ns(times: pd.Series) -> np.ndarray:
+    return pd.to_datetime(times, utc=True).to_numpy(dtype='datetime64[ns]').view('int64')
+
+
+class ShardExecutor:
+    '''
+    Pool of n_workers processes (default: all cores) running the per-row stages by shards of shard_rows rows
+
+    Frames smaller than one shard, or a single worker, are processed in the main process.
+    Use it as a context manager (or call close) to stop the workers.
+    '''
+
+    def __init__(self, n_workers: int = None, shard_rows: int = 250_000):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.shard_rows = shard_rows
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.n_workers)
+        return self._pool
+
+    def add_local_times(self, d_frames: list, airport_tz: dict) -> list:
+        '''
+        Parallel add_local_times_grouped of each frame of d_frames (modified in place), all the shards of all the frames
+        are converted in the same pass over the pool
+        '''
+        n_rows = sum(len(d_frame) for d_frame in d_frames)
+        tz_names = pd.Index(sorted(set(airport_tz.values())), dtype=object)
+
+        input_shm = shared_memory.SharedMemory(create=True, size=max(1, 4 * n_rows * 8))
+        output_shm = shared_memory.SharedMemory(create=True, size=max(1, N_OUTPUTS * n_rows * 8))
+        try:
+            inputs = np.ndarray((4, n_rows), dtype=np.int64, buffer=input_shm.buf)
+            outputs = np.ndarray((N_OUTPUTS, n_rows), dtype=np.int64, buffer=output_shm.buf)
+
+            bounds = np.cumsum([0] + [len(d_frame) for d_frame in d_frames])
+            for d_frame, start, stop in zip(d_frames, bounds[:-1], bounds[1:]):
+                inputs[ARRIVAL_NS, start:stop] = utc_ns(d_frame['arrival_time'])
+                inputs[DEPARTURE_NS, start:stop] = utc_ns(d_frame['actual_offblock_time'])
+                inputs[ARRIVAL_TZ, start:stop] = timezone_codes(d_frame['ades'], airport_tz, tz_names)
+                inputs[DEPARTURE_TZ, start:stop] = timezone_codes(d_frame['adep'], airport_tz, tz_names)
+
+            shards = [(start, min(start + self.shard_rows, n_rows)) for start in range(0, n_rows, self.shard_rows)]
+            if self.n_workers == 1 or len(shards) <= 1:
+                for start, stop in shards:
+                    convert_rows(inputs, outputs, start, stop, list(tz_names))
+            else:
+                futures = [self.pool().submit(_convert_shard, input_shm.name, output_shm.name, n_rows, start, stop, list(tz_names))
+                           for start, stop in shards]
+                for future in futures:
+                    future.result()
+
+            for d_frame, start, stop in zip(d_frames, bounds[:-1], bounds[1:]):
+                local_arrival_ns = outputs[LOCAL_ARRIVAL_NS, start:stop].copy()
+                local_departure_ns = outputs[LOCAL_DEPARTURE_NS, start:stop].copy()
+                arrival = finalize_calendar_fields({name: outputs[row, start:stop] for name, row in ARRIVAL_FIELDS.items()}, local_arrival_ns)
+                departure = finalize_calendar_fields({'hour': outputs[DEPARTURE_HOUR, start:stop]}, local_departure_ns)
+                set_local_times(d_frame, local_arrival_ns, local_departure_ns, arrival, departure)
+            del inputs, outputs
+        finally:
+            input_shm.close()
+            input_shm.unlink()
+            output_shm.close()
+            output_shm.unlink()
+
+        return d_frames
@@ -0,0 +1,289 @@
+import json
+import os
+from contextlib import nullcontext
+
+import pandas as pd
+
+from preprocessing.country_and_airports_codes import add_lon_lat, apply_renaming, fit_airports_grouping, fit_countries_grouping
+from preprocessing.country_and_airports_codes import load_aircraft_types_table, regroup_aircraft_types
+from preprocessing.country_and_airports_codes import GroupIndex, assign_unseen_codes, airport_coordinates, country_coordinates
+from preprocessing.country_and_airports_codes import airports_default_position, COUNTRIES_DEFAULT_POSITION
+from preprocessing.encoding import fit_categories, apply_int_hashing, apply_categorical_encoding
+from preprocessing.encoding import fit_category_statistics, out_of_fold_category_statistics, add_category_statistics
+from preprocessing.local_time import patch_kuweit, airport_tz_maps_build, add_local_times_grouped, AIRPORT_TZ_PATCHES
+from preprocessing.timezone_cache import lookup_airport_timezones
+from preprocessing.categorical import categorize_codes, observed_categories
+
+COUNTRY_COLUMNS = ['country_code_adep', 'country_code_ades']
+AIRPORT_COLUMNS = ['adep', 'ades']
+COLUMNS_TO_HASH = ['callsign','country_code_ades', 'country_code_adep', 'adep', 'ades', 'airline','aircraft_type','wtc']
+TO_DROP = ['date','name_adep','name_ades','actual_offblock_time','arrival_time','local_departure_time','local_arrival_time']
+
+# hashing: int codes (string_to_int_hashing), categorical: pandas categoricals for the native categorical support of XGBoost
+ENCODINGS = ['hashing', 'categorical']
+
+PIPELINE_FORMAT = 1
+
+
+class PreprocessingPipeline:
+    '''
+    Fit/transform version of the preprocessing chain of main.py
+
+    fit learns, on the training set only:
+        airport_tz: timezone of each airport of the training set
+        country_renaming, country_centroids: grouping of the countries (group_and_rename_countries)
+        airport_renaming, airport_centroids: grouping of the airports (group_and_rename_airports)
+        categories: vocabulary of each hashed column (string_to_int_hashing)
+        category_stats, target_prior: frequency (and tow mean) of the values of stats_columns, if any
+        aircraft_types: the aircraft types mapping table (preprocessing/aircraft_types.json) used at fit time
+    transform then only applies this state, so that new data can be scored without reading the training set.
+
+    encoding is one of ENCODINGS. With stats_columns, {column}_freq (and {column}_target_mean with target_stats) features are added,
+    computed out-of-fold on the training set.
+    If profiler (a preprocessing.profiling.StageProfiler) is set, each stage of fit_transform/transform is recorded by it.
+    If executor (a preprocessing.parallel.ShardExecutor) is set, the local times are computed by row shards in its process pool.
+    The aircraft types missing from the mapping table (regrouped in the unknown category of the table) are reported once, and kept in unknown_aircraft_types.
+    '''
+
+    def __init__(self, columns_to_hash: list = None, to_drop: list = None, encoding: str = 'hashing', stats_columns: list = None, target_stats: bool = False):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+        self.columns_to_hash = list(columns_to_hash or COLUMNS_TO_HASH)
+        self.to_drop = list(to_drop or TO_DROP)
+        self.encoding = encoding
+        self.stats_columns = list(stats_columns or [])
+        self.target_stats = target_stats
+
+        self.airport_tz = None
+        self.country_renaming = None
+        self.country_centroids = None
+        self.airport_renaming = None
+        self.airport_centroids = None
+        self.categories = None
+        self.category_stats = None
+        self.target_prior = None
+        self.aircraft_types = None
+        self.unknown_aircraft_types = set()
+        self._group_indexes = None
+        self.profiler = None
+        self.executor = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.categories is not None
+
+    def fit(self, df_train: pd.DataFrame):
+        self.fit_transform(df_train.copy())
+        return self
+
+    def fit_transform(self, df_train: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Fits the pipeline on df_train and returns df_train preprocessed (df_train is modified in place as well)
+        '''
+        categorize_codes(df_train)
+        with self._stage('add_localtime', df_train):
+            patch_kuweit(df_train)
+            self.airport_tz = airport_tz_maps_build(df_train)
+            self.airport_tz.update(AIRPORT_TZ_PATCHES)
+            self._add_local_times(df_train, self.airport_tz)
+        with self._stage('compute_lon_lat', df_train):
+            add_lon_lat(df_train)
+
+        with self._stage('fit_groupings', df_train):
+            self.country_renaming, self.country_centroids = fit_countries_grouping(df_train)
+            self.airport_renaming, self.airport_centroids = fit_airports_grouping(df_train)
+            self._group_indexes = None
+        self._apply_groupings(df_train)
+
+        self.aircraft_types = load_aircraft_types_table()
+        self._regroup_aircraft_types(df_train)
+
+        if self.stats_columns:
+            with self._stage('category_statistics', df_train):
+                target = 'tow' if self.target_stats else None
+                self.category_stats = fit_category_statistics(df_train, self.stats_columns, target)
+                self.target_prior = float(df_train['tow'].mean()) if self.target_stats else None
+                out_of_fold_category_statistics(df_train, self.stats_columns, target)
+
+        self.categories = fit_categories(df_train, self.columns_to_hash)
+        self._encode(df_train)
+
+        return df_train.drop(columns=self.to_drop)
+
+    def transform(self, d_frame: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Preprocesses and encodes d_frame with the fitted state (d_frame is modified in place as well)
+        '''
+        if not self.is_fitted:
+            raise Exception('The preprocessing pipeline is not fitted, call fit or load first')
+
+        self._preprocess(d_frame)
+        if self.category_stats:
+            with self._stage('category_statistics', d_frame):
+                add_category_statistics(d_frame, self.category_stats, self.target_prior)
+        self._encode(d_frame)
+
+        return d_frame.drop(columns=self.to_drop, errors='ignore')
+
+    def _stage(self, name: str, d_frame: pd.DataFrame):
+        '''
+        Context of a stage, recorded by the profiler (preprocessing.profiling.StageProfiler) if one is set
+        '''
+        return self.profiler.stage(name, len(d_frame)) if self.profiler is not None else nullcontext()
+
+    def _add_local_times(self, d_frame: pd.DataFrame, airport_tz: dict) -> None:
+        if self.executor is not None:
+            self.executor.add_local_times([d_frame], airport_tz)
+        else:
+            add_local_times_grouped(d_frame, airport_tz)
+
+    def _encode(self, d_frame: pd.DataFrame) -> None:
+        with self._stage('encoding', d_frame):
+            if self.encoding == 'categorical':
+                apply_categorical_encoding(d_frame, self.categories)
+            else:
+                apply_int_hashing(d_frame, self.categories)
+
+    def _preprocess(self, d_frame: pd.DataFrame) -> pd.DataFrame:
+        categorize_codes(d_frame)
+        with self._stage('add_localtime', d_frame):
+            patch_kuweit(d_frame)
+            self._add_local_times(d_frame, self.timezones_for(d_frame))
+        with self._stage('compute_lon_lat', d_frame):
+            add_lon_lat(d_frame)
+        self._apply_groupings(d_frame)
+
+        self._regroup_aircraft_types(d_frame)
+        return d_frame
+
+    def _regroup_aircraft_types(self, d_frame: pd.DataFrame) -> None:
+        with self._stage('group_and_rename_aircraft_types', d_frame):
+            d_frame['aircraft_type'], unknown = regroup_aircraft_types(d_frame['aircraft_type'], self.aircraft_types)
+        new_unknown = sorted(set(unknown) - self.unknown_aircraft_types)
+        if new_unknown:
+            print(f"Aircraft types not in the aircraft types table, regrouped in {self.aircraft_types['unknown']}: {new_unknown}")
+            self.unknown_aircraft_types.update(new_unknown)
+
+    def partial_fit(self, d_frame: pd.DataFrame) -> dict:
+        '''
+        Updates the fitted state with new data, without refitting the groupings:
+            - airports and countries unseen so far are mapped to their nearest existing group (see unseen_groups)
+            - values unseen so far in the hashed columns are appended to the vocabularies,
+              so the codes of the known values (and the trained models) stay valid
+        The category statistics are not updated (values unseen at fit time get a zero frequency and the prior tow mean).
+
+        Returns the number of airports, countries and categories added
+        '''
+        if not self.is_fitted:
+            raise Exception('The preprocessing pipeline is not fitted, call fit or load first')
+
+        d_frame = categorize_codes(d_frame.copy())
+        patch_kuweit(d_frame)
+        self.airport_tz = self.timezones_for(d_frame)
+
+        new_countries, new_airports = self.unseen_groups(d_frame)
+        self.country_renaming.update(new_countries)
+        self.airport_renaming.update(new_airports)
+
+        self._preprocess(d_frame)
+        n_new_categories = 0
+        for column in self.columns_to_hash:
+            known = set(self.categories[column])
+            new_values = [value for value in observed_categories(d_frame[column]).tolist() if value not in known]
+            self.categories[column] = self.categories[column] + new_values
+            n_new_categories += len(new_values)
+
+        return {'airports': len(new_airports), 'countries': len(new_countries), 'categories': n_new_categories}
+
+    def group_indexes(self) -> tuple:
+        '''
+        Spatial indexes (GroupIndex) of the fitted country and airport groupings, built once
+        '''
+        if self._group_indexes is None:
+            self._group_indexes = (GroupIndex.from_grouping(self.country_renaming, self.country_centroids, country_coordinates),
+                                   GroupIndex.from_grouping(self.airport_renaming, self.airport_centroids, airport_coordinates))
+        return self._group_indexes
+
+    def unseen_groups(self, d_frame: pd.DataFrame) -> tuple:
+        '''
+        Groups of the countries and airports of d_frame missing from the fitted groupings (unseen, or only seen as ades),
+        assigned to the nearest group centroid or kept airport/country
+
+        Returns two dicts {code: group}: countries, airports
+        '''
+        return self._unseen_countries(d_frame), self._unseen_airports(d_frame)
+
+    def _unseen_countries(self, d_frame: pd.DataFrame) -> dict:
+        # the spatial indexes are only built when there are unseen codes
+        return assign_unseen_codes(d_frame, COUNTRY_COLUMNS, self.country_renaming, lambda: self.group_indexes()[0], country_coordinates, COUNTRIES_DEFAULT_POSITION)
+
+    def _unseen_airports(self, d_frame: pd.DataFrame) -> dict:
+        return assign_unseen_codes(d_frame, AIRPORT_COLUMNS, self.airport_renaming, lambda: self.group_indexes()[1], airport_coordinates,
+                                   airports_default_position(self.airport_centroids))
+
+    def _apply_groupings(self, d_frame: pd.DataFrame) -> None:
+        with self._stage('group_and_rename_countries', d_frame):
+            apply_renaming(d_frame, COUNTRY_COLUMNS, {**self.country_renaming, **self._unseen_countries(d_frame)})
+        with self._stage('group_and_rename_airports', d_frame):
+            apply_renaming(d_frame, AIRPORT_COLUMNS, {**self.airport_renaming, **self._unseen_airports(d_frame)})
+
+    def timezones_for(self, d_frame: pd.DataFrame) -> dict:
+        '''
+        Timezone of each airport of d_frame: fitted ones first, the on-disk cache for airports unseen at fit time
+        '''
+        airports = set(d_frame['adep'].unique()).union(d_frame['ades'].unique())
+        unseen = [airport for airport in airports if airport not in self.airport_tz]
+        airport_tz = lookup_airport_timezones(unseen) if unseen else {}
+        airport_tz.update(self.airport_tz)
+        return airport_tz
+
+    def state_dict(self) -> dict:
+        return {'format': PIPELINE_FORMAT,
+                'columns_to_hash': self.columns_to_hash,
+                'to_drop': self.to_drop,
+                'airport_tz': self.airport_tz,
+                'country_renaming': self.country_renaming,
+                'country_centroids': self.country_centroids,
+                'airport_renaming': self.airport_renaming,
+                'airport_centroids': self.airport_centroids,
+                'categories': self.categories,
+                'encoding': self.encoding,
+                'stats_columns': self.stats_columns,
+                'target_stats': self.target_stats,
+                'category_stats': self.category_stats,
+                'target_prior': self.target_prior,
+                'aircraft_types': self.aircraft_types}
+
+    def save(self, path: str) -> None:
+        '''
+        Saves the fitted state next to the models, in {path}_preprocessing.json
+        '''
+        with open(preprocessing_state_path(path), 'w') as f:
+            json.dump(self.state_dict(), f)
+
+    @classmethod
+    def load(cls, path: str):
+        '''
+        Loads the fitted state saved by save (path is the same prefix as the models one)
+        '''
+        with open(preprocessing_state_path(path)) as f:
+            state = json.load(f)
+        if state.get('format') != PIPELINE_FORMAT:
+            raise ValueError(f"Unsupported preprocessing state format in {preprocessing_state_path(path)}")
+
+        # states saved before the encoding options were added are hashing ones, without statistics
+        pipeline = cls(state['columns_to_hash'], state['to_drop'], state.get('encoding', 'hashing'), state.get('stats_columns'), state.get('target_stats', False))
+        for key in ['airport_tz', 'country_renaming', 'country_centroids', 'airport_renaming', 'airport_centroids', 'categories']:
+            setattr(pipeline, key, state[key])
+        pipeline.category_stats = state.get('category_stats')
+        pipeline.target_prior = state.get('target_prior')
+        # states saved before the aircraft types table was added used the table of the code, the default one
+        pipeline.aircraft_types = state.get('aircraft_types') or load_aircraft_types_table()
+        return pipeline
+
+
+def preprocessing_state_path(path: str) -> str:
+    return f"{path}_preprocessing.json"
+
+def preprocessing_state_exists(path: str) -> bool:
+    return os.path.exists(preprocessing_state_path(path))
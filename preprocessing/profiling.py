@@ -0,0 +1,244 @@
+'''
+Stage-level instrumentation of the preprocessing and prediction runs
+
+StageProfiler.stage wraps a stage (add_localtime, compute_lon_lat, group_and_rename_*, encoding, predict...) and records
+its wall time, CPU time, peak RSS delta (how much the stage raised the peak memory of the process) and rows/sec.
+A stage run several times (e.g. once per chunk in streaming mode) is aggregated under its name.
+report() returns the structured report of the run, save_report writes it as JSON.
+One stage can also be run under cProfile, its stats are dumped (pstats format) with the report.
+
+StartupProfiler reports the startup cost of a run (--profile-startup): the import time of each module imported once it is
+installed, and the time of the initializations (reference data, preprocessing state, models) recorded with initialization.
+'''
+
+import cProfile
+import datetime
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from importlib.machinery import SourceFileLoader, SourcelessFileLoader, ExtensionFileLoader
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb() -> float:
+    '''
+    Peak resident memory of the process so far, in MB (None where the resource module is not available)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class StageProfiler:
+    '''
+    Records the stages of a run, profile_stage (if any) is run under cProfile.
+    Other figures of the run (e.g. the prediction cache hit rate) can be added to metrics, they are saved with the report.
+    '''
+
+    def __init__(self, profile_stage: str = None):
+        self.profile_stage = profile_stage
+        self.stages = {}
+        self.metrics = {}
+        self._profile = cProfile.Profile() if profile_stage else None
+        self._started_at = datetime.datetime.now(datetime.timezone.utc)
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = None):
+        peak_before = peak_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        profiled = self._profile is not None and name == self.profile_stage
+        if profiled:
+            self._profile.enable()
+        try:
+            yield
+        finally:
+            if profiled:
+                self._profile.disable()
+            self._record(name, rows, time.perf_counter() - wall_start, time.process_time() - cpu_start, peak_before)
+
+    def _record(self, name: str, rows: int, wall: float, cpu: float, peak_before: float) -> None:
+        stage = self.stages.setdefault(name, {'calls': 0, 'wall_sec': 0.0, 'cpu_sec': 0.0, 'peak_rss_delta_mb': 0.0, 'rows': 0})
+        stage['calls'] += 1
+        stage['wall_sec'] += wall
+        stage['cpu_sec'] += cpu
+        if peak_before is not None:
+            stage['peak_rss_delta_mb'] += peak_rss_mb() - peak_before
+        else:
+            stage['peak_rss_delta_mb'] = None
+        if rows is not None:
+            stage['rows'] += rows
+
+    def report(self) -> dict:
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, rows_per_sec=stage['rows'] / stage['wall_sec'] if stage['rows'] and stage['wall_sec'] else None)
+        return {'started_at': self._started_at.isoformat(timespec='seconds'),
+                'argv': sys.argv,
+                'total_wall_sec': time.perf_counter() - self._start,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': stages,
+                'metrics': self.metrics}
+
+    def save_report(self, directory: str) -> str:
+        '''
+        Writes the report in directory/run_{start time}.json (and the cProfile stats of the profiled stage
+        in directory/run_{start time}_{stage}.prof), returns the report path
+        '''
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, f"run_{self._started_at.strftime('%Y%m%d_%H%M%S')}")
+        with open(f"{prefix}.json", 'w') as f:
+            json.dump(self.report(), f, indent=4)
+        if self._profile is not None:
+            self._profile.dump_stats(f"{prefix}_{self.profile_stage}.prof")
+        return f"{prefix}.json"
+
+    def print_summary(self) -> None:
+        print("-"*100)
+        print(f"{'stage':<35}{'calls':>6}{'wall':>10}{'cpu':>10}{'peak rss +':>13}{'rows/sec':>14}")
+        for name, stage in self.report()['stages'].items():
+            rss = f"{stage['peak_rss_delta_mb']:.0f} MB" if stage['peak_rss_delta_mb'] is not None else '-'
+            rows_per_sec = f"{stage['rows_per_sec']:.0f}" if stage['rows_per_sec'] else '-'
+            print(f"{name:<35}{stage['calls']:>6}{stage['wall_sec']:>9.2f}s{stage['cpu_sec']:>9.2f}s{rss:>13}{rows_per_sec:>14}")
+        print("-"*100)
+
+
+# the installed StartupProfiler, if any (initialization records into it)
+_startup_profiler = None
+
+
+@contextmanager
+def initialization(name: str):
+    '''
+    Records a one-time initialization (loading reference data, a state, models...) in the installed StartupProfiler, if any
+    '''
+    if _startup_profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    _startup_profiler._initialization_depth += 1
+    try:
+        yield
+    finally:
+        _startup_profiler._initialization_depth -= 1
+        _startup_profiler.record_initialization(name, time.perf_counter() - start)
+
+def timed_initialization(name: str):
+    '''
+    Decorator version of initialization (put it under lru_cache to only record the first call)
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with initialization(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StartupProfiler:
+    '''
+    Import and initialization cost of each module of a run
+
+    install() adds an import hook timing the execution of every module imported from then on:
+    cumulative time (with the modules it imports) and self time (without them), like python -X importtime.
+    '''
+
+    def __init__(self):
+        self.imports = {}
+        self.initializations = {}
+        self._children = []
+        self._initialization_depth = 0
+        self._started_at = datetime.datetime.now(datetime.timezone.utc)
+        self._start = time.perf_counter()
+
+    def install(self):
+        global _startup_profiler
+        _startup_profiler = self
+        sys.meta_path.insert(0, _ImportTimer(self))
+        return self
+
+    def _timed_exec(self, name: str, exec_module):
+        def timed_exec_module(module):
+            start = time.perf_counter()
+            self._children.append(0.0)
+            try:
+                exec_module(module)
+            finally:
+                cumulative = time.perf_counter() - start
+                children = self._children.pop()
+                if self._children:
+                    self._children[-1] += cumulative
+                self.imports[name] = {'cumulative_ms': cumulative * 1000, 'self_ms': (cumulative - children) * 1000, 'top_level': not self._children}
+        return timed_exec_module
+
+    def record_initialization(self, name: str, duration: float) -> None:
+        # nested initializations (e.g. airportsdata.load in airport_coordinates_table) are not counted twice in the total
+        step = self.initializations.setdefault(name, {'calls': 0, 'ms': 0.0, 'top_level_ms': 0.0})
+        step['calls'] += 1
+        step['ms'] += duration * 1000
+        if self._initialization_depth == 0:
+            step['top_level_ms'] += duration * 1000
+
+    def report(self) -> dict:
+        imports = dict(sorted(self.imports.items(), key=lambda item: -item[1]['cumulative_ms']))
+        return {'started_at': self._started_at.isoformat(timespec='seconds'),
+                'argv': sys.argv,
+                'total_wall_sec': time.perf_counter() - self._start,
+                'import_ms': sum(module['cumulative_ms'] for module in imports.values() if module['top_level']),
+                'initialization_ms': sum(step['top_level_ms'] for step in self.initializations.values()),
+                'initializations': self.initializations,
+                'imports': imports}
+
+    def save_report(self, directory: str) -> str:
+        '''
+        Writes the report in directory/startup_{start time}.json, returns its path
+        '''
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"startup_{self._started_at.strftime('%Y%m%d_%H%M%S')}.json")
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+        return path
+
+    def print_summary(self, n_modules: int = 20) -> None:
+        report = self.report()
+        print("-"*100)
+        print(f"Startup: {report['import_ms']:.0f} ms of imports, {report['initialization_ms']:.0f} ms of initializations")
+        print(f"{'module':<60}{'cumulative':>14}{'self':>12}")
+        for name, module in list(report['imports'].items())[:n_modules]:
+            print(f"{name:<60}{module['cumulative_ms']:>11.1f} ms{module['self_ms']:>9.1f} ms")
+        print(f"{'initialization':<60}{'calls':>14}{'time':>12}")
+        for name, step in report['initializations'].items():
+            print(f"{name:<60}{step['calls']:>14}{step['ms']:>9.1f} ms")
+        print("-"*100)
+
+
+class _ImportTimer:
+    '''
+    Meta path finder of StartupProfiler: finds the modules with the other finders, and times the exec_module of their loader
+    '''
+
+    def __init__(self, profiler: StartupProfiler):
+        self.profiler = profiler
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            # file loaders are created for each module (builtin, frozen and custom loaders may be shared, they are not timed)
+            if isinstance(spec.loader, (SourceFileLoader, SourcelessFileLoader, ExtensionFileLoader)):
+                spec.loader.exec_module = self.profiler._timed_exec(name, spec.loader.exec_module)
+            return spec
+        return None
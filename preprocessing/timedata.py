@@ -22,10 +22,11 @@ def add_timefeature(d_frame: pd.DataFrame) -> pd.DataFrame:
 
     return d_frame
     
-df_train = pd.read_csv("./data/challenge_set.csv")
+if __name__ == "__main__":
+    df_train = pd.read_csv("./data/challenge_set.csv")
 
-df_train = add_timefeature(df_train)
+    df_train = add_timefeature(df_train)
 
-print(df_train.tail(4))
+    print(df_train.tail(4))
 
 
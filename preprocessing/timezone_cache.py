@@ -0,0 +1,152 @@
+'''
+Persistent on-disk cache of the airport (ICAO) -> IANA timezone resolutions
+
+The cache is one file in CACHE_DIR, airport_tz.bin, loaded by memory-map:
+    - a small JSON header: format/library versions and the list of timezone names (tz ids index this list)
+    - the table: structured array (icao: S4, tz: int16) sorted by icao
+The header and the table are written together and replace the previous file at once, so that a reader never sees
+a table with the timezone list of another version of the cache.
+
+The table is built lazily: codes missing from the cache are resolved with get_airport_timezone
+(airportsdata + timezonefinder), then appended to the cache. The cache is dropped when the installed
+airportsdata/timezonefinder versions differ from the ones it was built with.
+'''
+
+import json
+import os
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+
+from preprocessing.profiling import initialization
+
+CACHE_DIR = os.environ.get('ATOW_CACHE_DIR', 'data/cache')
+CACHE_FORMAT = 2
+MAGIC = b'ATOWTZ\x00\x00'
+ALIGNMENT = 64
+UNKNOWN_TZ = 'Unknown'
+
+TABLE_DTYPE = np.dtype([('icao', 'S4'), ('tz', '<i2')])
+
+_table = None
+_timezones = None
+
+
+def _package_version(name: str) -> str:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return 'missing'
+
+def cache_versions() -> dict:
+    return {'format': CACHE_FORMAT,
+            'airportsdata': _package_version('airportsdata'),
+            'timezonefinder': _package_version('timezonefinder')}
+
+def cache_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, 'airport_tz.bin')
+
+def load_cache(cache_dir: str = None):
+    '''
+    Loads (memory-mapped) the cached table, or an empty one if the cache is missing or outdated
+
+    Returns the table (structured array sorted by icao) and the list of timezone names
+    '''
+    try:
+        raw = np.memmap(cache_path(cache_dir or CACHE_DIR), dtype=np.uint8, mode='r')
+        if raw[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError('not a timezone cache')
+        header_size = int(raw[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header = json.loads(raw[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].tobytes())
+        if header['versions'] != cache_versions():
+            raise ValueError('outdated timezone cache')
+        data_start = _data_start(header_size)
+        table = raw[data_start:data_start + header['rows'] * TABLE_DTYPE.itemsize].view(TABLE_DTYPE)
+        assert len(table) == header['rows']
+        return table, list(header['timezones'])
+    except (OSError, ValueError, KeyError, AssertionError):
+        return np.empty(0, dtype=TABLE_DTYPE), [UNKNOWN_TZ]
+
+def _data_start(header_size: int) -> int:
+    return -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+
+def save_cache(table: np.ndarray, timezones: list, cache_dir: str = None) -> None:
+    '''
+    Writes the header and the table in one file (atomically, so that concurrent readers never see a partial file,
+    or a table and a header of two different writes)
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir)
+
+    header_bytes = json.dumps({'versions': cache_versions(), 'timezones': timezones, 'rows': len(table)}).encode()
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.seek(_data_start(len(header_bytes)))
+        f.write(np.ascontiguousarray(table, dtype=TABLE_DTYPE).tobytes())
+    os.replace(tmp_path, path)
+
+def _get_table():
+    global _table, _timezones
+    if _table is None:
+        with initialization('timezone_cache'):
+            _table, _timezones = load_cache()
+    return _table, _timezones
+
+def _encode(codes) -> np.ndarray:
+    return np.array([str(code).encode('ascii', 'replace') for code in codes], dtype='S4')
+
+def _is_cacheable(code) -> bool:
+    return isinstance(code, str) and len(code) == 4 and code.isascii()
+
+def lookup_airport_timezones(codes, resolve=None) -> dict:
+    '''
+    Returns a dict {airport code: timezone name} for the given (unique) airport codes
+
+    Codes found in the cache are answered with a binary search in the memory-mapped table.
+    Missing ones are resolved with resolve (default: local_time.get_airport_timezone) and added to the cache.
+    '''
+    global _table, _timezones
+    table, timezones = _get_table()
+
+    codes = list(codes)
+    cacheable = [code for code in codes if _is_cacheable(code)]
+    keys = _encode(cacheable)
+
+    result = {}
+    if len(table) and len(keys):
+        positions = np.minimum(np.searchsorted(table['icao'], keys), len(table) - 1)
+        found = table['icao'][positions] == keys
+        tz_ids = table['tz'][positions]
+        result = {code: timezones[tz] for code, tz, hit in zip(cacheable, tz_ids, found) if hit}
+
+    misses = [code for code in dict.fromkeys(codes) if code not in result]
+    if not misses:
+        return result
+
+    if resolve is None:
+        from preprocessing.local_time import get_airport_timezone
+        resolve = get_airport_timezone
+
+    new_rows = []
+    for code in misses:
+        tz = resolve(code) or UNKNOWN_TZ
+        result[code] = tz
+        if _is_cacheable(code):
+            if tz not in timezones:
+                timezones = timezones + [tz]
+            new_rows.append((code.encode('ascii'), timezones.index(tz)))
+
+    if new_rows:
+        table = np.concatenate([np.asarray(table), np.array(new_rows, dtype=TABLE_DTYPE)])
+        table = table[np.argsort(table['icao'], kind='stable')]
+        try:
+            save_cache(table, timezones)
+        except OSError:
+            pass # read-only location: the cache stays in memory for this process
+        _table, _timezones = table, timezones
+
+    return result
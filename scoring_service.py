@@ -0,0 +1,237 @@
+################################# LICENSING ####################################
+# XGBoost Model to predict airplane TOW, ATOW ML Contest, PRC Data Challenge.
+# Copyright (C) 2024 Hadrien Crassous, Eymeric Giabicani, Dariia Haryfullina, Léo le Douarec.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+#################################################################################
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas
+
+from preprocessing.pipeline import PreprocessingPipeline
+from models.xgboost_agregation import predict_tow, load_model, load_blend_weights, model_features
+from models.prediction_cache import PredictionCache, STORE_PATH as CACHE_STORE_PATH, MAX_ENTRIES as CACHE_ENTRIES
+
+MODEL_PATH = "models/xgboost_agregation"
+
+
+class ScoringService:
+    '''
+    Long-lived scorer: loads the preprocessing state and the models once,
+    and coalesces the concurrent requests into small batches.
+
+    A request waits at most max_wait_ms for other requests to join its batch (up to max_batch_size flights),
+    then the whole batch is preprocessed and predicted at once by the batching thread
+    (a malformed request only fails itself, see _score_batch).
+    With a prediction cache (models/prediction_cache.py), only the flights whose features are not cached are predicted.
+    '''
+
+    def __init__(self, model_path: str = MODEL_PATH, max_batch_size: int = 64, max_wait_ms: float = 5.0, latency_window: int = 10000, cache: PredictionCache = None):
+        self.pipeline = PreprocessingPipeline.load(model_path)
+        self.models_list = load_model(model_path)
+        self.weights = load_blend_weights(model_path, self.models_list)
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._n_requests = 0
+        self._n_flights = 0
+        self._n_batches = 0
+
+        self._worker = threading.Thread(target=self._batching_loop, daemon=True)
+        self._worker.start()
+
+    def score(self, records: list) -> np.ndarray:
+        '''
+        Scores a list of flight records (dicts with the columns of the submission set), blocking until done
+        '''
+        future = Future()
+        self._queue.put((records, future, time.perf_counter()))
+        return future.result()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        n_flights = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while n_flights < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_flights += len(request[0])
+        return batch
+
+    def _score_records(self, records: list) -> np.ndarray:
+        d_frame = self.pipeline.transform(pandas.DataFrame.from_records(records))
+        return self._predict(d_frame)
+
+    def _score_batch(self, batch: list) -> list:
+        '''
+        Predictions (or the exception raised) of each request of the batch
+
+        The batch is scored at once. If that fails, each request is scored on its own, so that one malformed request
+        only fails itself and not the valid requests it was coalesced with.
+        '''
+        records = [record for request in batch for record in request[0]]
+        try:
+            y_pred = self._score_records(records)
+        except Exception as e:
+            if len(batch) == 1:
+                return [e]
+            results = []
+            for request_records, _, _ in batch:
+                try:
+                    results.append(self._score_records(request_records))
+                except Exception as request_error:
+                    results.append(request_error)
+            return results
+
+        bounds = np.cumsum([0] + [len(request[0]) for request in batch])
+        return [y_pred[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def _batching_loop(self) -> None:
+        while True:
+            batch = self._next_batch()
+            results = self._score_batch(batch)
+
+            done = time.perf_counter()
+            n_scored = 0
+            for (request_records, future, received), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    continue
+                future.set_result(result)
+                n_scored += len(request_records)
+                with self._lock:
+                    self._latencies.append(done - received)
+
+            with self._lock:
+                self._n_requests += len(batch)
+                self._n_flights += n_scored
+                self._n_batches += 1
+
+    def _predict(self, d_frame: pandas.DataFrame) -> np.ndarray:
+        predict = lambda d_frame: predict_tow(d_frame, self.models_list, self.weights)
+        if self.cache is None:
+            return predict(d_frame)
+        return self.cache.predict(d_frame, predict, model_features(self.models_list[0]))
+
+    def stats(self) -> dict:
+        '''
+        Latency percentiles (over the last requests) and throughput counters since start (and the prediction cache counters)
+        '''
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            elapsed = time.perf_counter() - self._started
+            return {'requests': self._n_requests,
+                    'flights': self._n_flights,
+                    'batches': self._n_batches,
+                    'mean_batch_size': self._n_flights / self._n_batches if self._n_batches else 0.0,
+                    'latency_p50_ms': float(np.percentile(latencies, 50)) if latencies.size else None,
+                    'latency_p99_ms': float(np.percentile(latencies, 99)) if latencies.size else None,
+                    'flights_per_sec': self._n_flights / elapsed,
+                    'uptime_sec': elapsed,
+                    'prediction_cache': self.cache.stats() if self.cache is not None else None}
+
+
+def make_handler(service: ScoringService):
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        '''
+        POST /predict: a flight record (JSON object) or a micro-batch of records (JSON list),
+                       returns {"predictions": [{"flight_id": ..., "tow": ...}, ...]}
+        GET /stats: latency and throughput counters
+        '''
+
+        def _send_json(self, code: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._send_json(404, {'error': f'unknown path {self.path}'})
+            self._send_json(200, service.stats())
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._send_json(404, {'error': f'unknown path {self.path}'})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                records = payload if isinstance(payload, list) else [payload]
+                if not records:
+                    return self._send_json(200, {'predictions': []})
+                y_pred = service.score(records)
+            except Exception as e:
+                return self._send_json(400, {'error': str(e)})
+
+            predictions = [{'flight_id': record.get('flight_id'), 'tow': float(tow)} for record, tow in zip(records, y_pred)]
+            self._send_json(200, {'predictions': predictions})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON scoring service for the TOW models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--max-batch-size", type=int, default=64, help="maximum number of flights predicted together")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="latency budget spent waiting for other requests to batch with")
+    parser.add_argument("--prediction-cache", action="store_true", help="reuse the predictions of the flights whose features and models did not change")
+    parser.add_argument("--cache-store", default=CACHE_STORE_PATH, help="sqlite file of the prediction cache kept between runs (\"\" for an in-memory cache only)")
+    parser.add_argument("--cache-entries", type=int, default=CACHE_ENTRIES, help="maximum number of predictions of the in-memory cache")
+    args = parser.parse_args(argv)
+
+    # the version of the models is read before they are loaded
+    cache = PredictionCache.for_models(args.model_path, args.cache_entries, args.cache_store or None) if args.prediction_cache else None
+    service = ScoringService(args.model_path, args.max_batch_size, args.max_wait_ms, cache=cache)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+
+    print("-"*100)
+    print(f"Scoring service listening on http://{args.host}:{args.port} (POST /predict, GET /stats)")
+    print("-"*100)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import pandas as pd
+
+from preprocessing.country_and_airports_codes import regroup_aircraft_types, load_aircraft_types_table
+
+
+def test_singular_and_missing_types_fall_into_the_unknown_category_of_the_table():
+    table = {'unknown': 'ZZZZ', 'known_types': ['A320', 'B752'], 'substitutions': {'B752': None, 'BCS1': 'A320'}}
+    series = pd.Series(['A320', 'B752', 'BCS1', 'C172'], dtype='category')
+
+    regrouped, unknown = regroup_aircraft_types(series, table)
+    assert regrouped.tolist() == ['A320', 'ZZZZ', 'A320', 'ZZZZ']
+    assert unknown == ['C172']
+
+
+def test_default_table_regroups_the_dash_8():
+    table = load_aircraft_types_table()
+    regrouped, unknown = regroup_aircraft_types(pd.Series(['DH8D', 'B773'], dtype='category'), table)
+
+    assert regrouped.tolist() == ['AT76', table['unknown']]
+    assert unknown == []
@@ -0,0 +1,61 @@
+import json
+import shutil
+
+import numpy as np
+
+from models.xgboost_agregation import train_model, set_route, save_model, load_model, load_blend_weights, blend_path
+from models.xgboost_agregation import blended_models_version, default_blend_weights, BASE_MODELS
+
+PARAMS = {'colsample_bytree': 1.0, 'gamma': 0.0, 'learning_rate': 0.3, 'max_depth': 2, 'min_child_weight': 1,
+          'n_estimators': 3, 'reg_alpha': 0.0, 'reg_lambda': 1.0, 'subsample': 1.0}
+
+
+def small_models(n_estimators: int = 3) -> list:
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 1, (200, 2)).astype(np.float32)
+    y = (1000 * X[:, 0]).astype(np.float32)
+    params = dict(PARAMS, n_estimators=n_estimators)
+    model_list = []
+    for name, wtc in BASE_MODELS:
+        model = train_model(X, y, params, feature_names=['a', 'b'])
+        set_route(model, name, wtc)
+        model_list.append(model)
+    return model_list
+
+
+def write_blend(path: str, weights: list) -> None:
+    with open(blend_path(path), 'w') as f:
+        json.dump({'models': [name for name, _ in BASE_MODELS], 'weights': weights,
+                   'model_version': blended_models_version(path)}, f)
+
+
+def test_blend_weights_of_the_saved_models_are_used(tmp_path):
+    path = str(tmp_path / "model")
+    save_model(small_models(), path)
+    write_blend(path, [0.1, 0.2, 0.7])
+
+    assert load_blend_weights(path, load_model(path)) == [0.1, 0.2, 0.7]
+
+
+def test_blend_weights_of_previous_models_fall_back_to_the_defaults(tmp_path):
+    path = str(tmp_path / "model")
+    save_model(small_models(), path)
+    write_blend(path, [0.1, 0.2, 0.7])
+
+    # a new training saves other models, the blend weights were fitted for the previous ones
+    model_list = small_models(n_estimators=4)
+    save_model(model_list, path)
+
+    assert load_blend_weights(path, load_model(path)) == default_blend_weights(model_list)
+
+
+def test_blend_weights_of_copied_models_are_used(tmp_path):
+    path, copy_path = str(tmp_path / "model"), str(tmp_path / "copy")
+    save_model(small_models(), path)
+    write_blend(path, [0.1, 0.2, 0.7])
+
+    # same content in another directory, with new modification times
+    for role in ['model_0.json', 'model_1.json', 'model_2.json', 'blend.json']:
+        shutil.copy(f"{path}_{role}", f"{copy_path}_{role}")
+
+    assert load_blend_weights(copy_path, load_model(copy_path)) == [0.1, 0.2, 0.7]
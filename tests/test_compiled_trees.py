@@ -0,0 +1,46 @@
+import shutil
+
+import pytest
+
+from models.compiled_trees import CompiledEnsemble, export_compiled
+from models.xgboost_agregation import save_model
+
+from test_blend_weights import small_models, write_blend
+
+
+def test_compiled_ensemble_of_the_saved_models_loads(tmp_path):
+    path = str(tmp_path / "model")
+    save_model(small_models(), path)
+    export_compiled(path)
+
+    assert [model['name'] for model in CompiledEnsemble.load(path).models] == ['wtc0', 'wtc1', 'basic']
+
+
+def test_compiled_ensemble_of_copied_models_loads(tmp_path):
+    path, copy_path = str(tmp_path / "model"), str(tmp_path / "copy")
+    save_model(small_models(), path)
+    write_blend(path, [0.1, 0.2, 0.7])
+    export_compiled(path)
+
+    # a deployment copies all the artifacts (new paths and modification times, same content)
+    for role in ['model_0.json', 'model_1.json', 'model_2.json', 'blend.json', 'compiled.bin']:
+        shutil.copy(f"{path}_{role}", f"{copy_path}_{role}")
+
+    assert [model['weight'] for model in CompiledEnsemble.load(copy_path).models] == [0.1, 0.2, 0.7]
+
+
+def test_compiled_ensemble_of_previous_models_is_refused(tmp_path):
+    path = str(tmp_path / "model")
+    save_model(small_models(), path)
+    export_compiled(path)
+
+    # the blend weights fitted since the export are not in the compiled file
+    write_blend(path, [0.1, 0.2, 0.7])
+    with pytest.raises(ValueError, match="export the models again"):
+        CompiledEnsemble.load(path)
+
+    export_compiled(path)
+    # a new training saves other models
+    save_model(small_models(n_estimators=4), path)
+    with pytest.raises(ValueError, match="export the models again"):
+        CompiledEnsemble.load(path)
@@ -0,0 +1,55 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from models.prediction_cache import PredictionCache, model_version
+from models.xgboost_agregation import save_model
+
+from test_blend_weights import small_models, write_blend
+
+
+def small_frame(n_rows: int = 50) -> pd.DataFrame:
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({'a': rng.uniform(0, 1, n_rows).astype(np.float32),
+                         'b': rng.uniform(0, 1, n_rows).astype(np.float32),
+                         'wtc': rng.integers(0, 2, n_rows)})
+
+
+def copy_models(path: str, copy_path: str) -> None:
+    for role in ['model_0.json', 'model_1.json', 'model_2.json', 'blend.json']:
+        shutil.copy(f"{path}_{role}", f"{copy_path}_{role}")
+
+
+def test_copied_models_keep_their_version_and_cached_predictions(tmp_path):
+    path, copy_path = str(tmp_path / "model"), str(tmp_path / "copy")
+    store_path = str(tmp_path / "predictions.sqlite")
+    model_list = small_models()
+    save_model(model_list, path)
+    write_blend(path, [0.1, 0.2, 0.7])
+    data = small_frame()
+    calls = []
+
+    def predict(d_frame):
+        calls.append(len(d_frame))
+        return np.asarray(d_frame['a'] * 1000, dtype=np.float32)
+
+    cache = PredictionCache.for_models(path, store_path=store_path)
+    y_pred = cache.predict(data, predict, ['a', 'b'])
+    cache.close()
+
+    # a deployment copies the model files (new paths and modification times, same content)
+    copy_models(path, copy_path)
+    assert model_version(copy_path) == model_version(path)
+    cache = PredictionCache.for_models(copy_path, store_path=store_path)
+    assert np.array_equal(cache.predict(data, predict, ['a', 'b']), y_pred)
+    assert calls == [len(data)] and cache.store_hits == len(data)
+
+
+def test_models_of_other_content_have_another_version(tmp_path):
+    path = str(tmp_path / "model")
+    save_model(small_models(), path)
+    version = model_version(path)
+
+    save_model(small_models(n_estimators=4), path)
+    assert model_version(path) != version
@@ -0,0 +1,57 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_flights
+from models.xgboost_agregation import train_models, save_model, DEFAULT_PARAMS_SET
+from preprocessing.pipeline import PreprocessingPipeline
+from scoring_service import ScoringService
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    '''
+    Preprocessing state and three small models saved in a temporary directory
+    '''
+    path = str(tmp_path_factory.mktemp("models") / "model")
+    pipeline = PreprocessingPipeline()
+    train_df = pipeline.fit_transform(generate_flights(100_000, 0))
+    params_set = {name: dict(params, n_estimators=5, max_depth=3) for name, params in DEFAULT_PARAMS_SET.items()}
+    save_model(train_models(train_df.iloc[:5000], params_set), path)
+    pipeline.save(path)
+    return path
+
+
+def request_records(n_rows: int, seed: int) -> list:
+    '''
+    Flights of the submission set schema as the service receives them (json records)
+    '''
+    d_frame = generate_flights(n_rows, seed, with_tow=False).reset_index()
+    return json.loads(d_frame.to_json(orient='records', date_format='iso'))
+
+
+def test_malformed_request_only_fails_itself(model_path):
+    service = ScoringService(model_path, max_wait_ms=500.0)
+    good = request_records(3, 1)
+    bad = [dict(good[0], actual_offblock_time='not a time')]
+    results = {}
+
+    def send(name, records):
+        try:
+            results[name] = service.score(records)
+        except Exception as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=send, args=args) for args in [('bad', bad), ('good', good)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # both requests were coalesced into one batch
+    assert service.stats()['batches'] == 1
+    assert isinstance(results['bad'], Exception)
+    assert isinstance(results['good'], np.ndarray) and len(results['good']) == 3
+    assert np.array_equal(results['good'], service.score(good))
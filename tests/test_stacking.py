@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from models.stacking import OofCache, compute_oof
+
+from test_blend_weights import small_models, PARAMS
+
+
+def small_training_frame(n_rows: int = 200) -> pd.DataFrame:
+    rng = np.random.default_rng(2)
+    d_frame = pd.DataFrame({'a': rng.uniform(0, 1, n_rows).astype(np.float32),
+                            'b': rng.uniform(0, 1, n_rows).astype(np.float32),
+                            'wtc': rng.integers(0, 2, n_rows)},
+                           index=pd.Index(np.arange(n_rows), name='flight_id'))
+    d_frame['tow'] = (1000 * d_frame['a']).astype(np.float32)
+    return d_frame
+
+
+def test_oof_predictions_are_computed_again_for_another_preprocessing_state(tmp_path):
+    data, model_list = small_training_frame(), small_models()
+    params_set = {f"params_{name}": PARAMS for name in ['wtc0', 'wtc1', 'basic']}
+    cache = OofCache(str(tmp_path / "oof"))
+
+    assert compute_oof(data, model_list, params_set, cache, 'state 1', n_folds=2) == ['wtc0', 'wtc1', 'basic']
+    assert compute_oof(data, model_list, params_set, cache, 'state 1', n_folds=2) == []
+
+    # the preprocessing state was fitted again (new groupings, another encoding): the features changed
+    assert not OofCache(str(tmp_path / "oof")).is_valid_for(data.index.to_numpy(), 2, 'state 2')
+    assert compute_oof(data, model_list, params_set, cache, 'state 2', n_folds=2) == ['wtc0', 'wtc1', 'basic']
+    assert OofCache(str(tmp_path / "oof")).meta['preprocessing'] == 'state 2'
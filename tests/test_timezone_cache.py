@@ -0,0 +1,36 @@
+import numpy as np
+
+from preprocessing import timezone_cache
+
+
+def test_saved_table_is_read_back_with_its_timezones(tmp_path):
+    table = np.array([(b'EGLL', 1), (b'LFPG', 2)], dtype=timezone_cache.TABLE_DTYPE)
+    timezone_cache.save_cache(table, ['Unknown', 'Europe/London', 'Europe/Paris'], str(tmp_path))
+
+    loaded, timezones = timezone_cache.load_cache(str(tmp_path))
+    assert loaded.tolist() == table.tolist()
+    assert timezones == ['Unknown', 'Europe/London', 'Europe/Paris']
+    assert list(tmp_path.iterdir()) == [tmp_path / 'airport_tz.bin']
+
+
+def test_truncated_cache_is_a_miss(tmp_path):
+    table = np.array([(b'EGLL', 1), (b'LFPG', 2)], dtype=timezone_cache.TABLE_DTYPE)
+    timezone_cache.save_cache(table, ['Unknown', 'Europe/London', 'Europe/Paris'], str(tmp_path))
+    path = timezone_cache.cache_path(str(tmp_path))
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 1)
+
+    loaded, timezones = timezone_cache.load_cache(str(tmp_path))
+    assert len(loaded) == 0 and timezones == [timezone_cache.UNKNOWN_TZ]
+
+
+def test_lookups_resolve_the_misses_and_cache_them(tmp_path, monkeypatch):
+    monkeypatch.setattr(timezone_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(timezone_cache, '_table', None)
+    resolved = {'LFPG': 'Europe/Paris', 'EGLL': 'Europe/London'}
+
+    assert timezone_cache.lookup_airport_timezones(['LFPG', 'EGLL'], resolved.get) == resolved
+
+    # a new process reads them from the cache, without resolving them again
+    monkeypatch.setattr(timezone_cache, '_table', None)
+    assert timezone_cache.lookup_airport_timezones(['EGLL', 'LFPG'], lambda code: None) == resolved
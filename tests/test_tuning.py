@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from models import tuning
+
+
+def small_training_set(n_rows: int = 300, seed: int = 0) -> pd.DataFrame:
+    '''
+    Preprocessed-like frame: float32 features, wtc codes and a float32 tow (as load_flights types it)
+    '''
+    rng = np.random.default_rng(seed)
+    d_frame = pd.DataFrame({'flight_duration': rng.uniform(30, 600, n_rows).astype(np.float32),
+                            'flown_distance': rng.uniform(100, 5000, n_rows).astype(np.float32),
+                            'wtc': rng.integers(0, 2, n_rows)})
+    d_frame['tow'] = (50_000 + 30 * d_frame['flown_distance'] + 20_000 * d_frame['wtc']).astype(np.float32)
+    return d_frame
+
+
+def test_record_trial_stores_float32_loss_as_real(tmp_path):
+    store = tuning.open_store(str(tmp_path / "trials.sqlite"))
+    tuning.record_trial(store, 'basic', 0, {'max_depth': 3.0}, np.float32(1234.5), 'ok', 0.1)
+
+    assert store.execute('SELECT typeof(loss) FROM trials').fetchone()[0] == 'real'
+    assert tuning.stored_trials(store, 'basic') == [(0, {'max_depth': 3.0}, 1234.5, 'ok')]
+
+
+def test_search_resumes_from_the_store(tmp_path):
+    store_path = str(tmp_path / "trials.sqlite")
+    train_df = small_training_set()
+
+    tuning.tune(train_df, 'basic', 2, store_path, n_workers=1)
+    # resumed: the stored trials are read back, and the search goes on with new batches
+    tuning.tune(train_df, 'basic', 4, store_path, n_workers=1)
+
+    store = tuning.open_store(store_path)
+    trials = tuning.stored_trials(store, 'basic')
+    assert [tid for tid, _, _, _ in trials] == [0, 1, 2, 3]
+    assert all(status == 'ok' and isinstance(loss, float) for _, _, loss, status in trials)
+
+
+def test_failed_trial_reports_its_error(monkeypatch):
+    # the data of the worker processes
+    monkeypatch.setattr(tuning, '_data', tuning.split_for_model(small_training_set(), 'basic'))
+
+    loss, status, _, error = tuning._evaluate({'max_depth': 3.0}, 1)
+    assert (loss, status) == (None, 'fail')
+    assert error == "KeyError: 'colsample_bytree'"